@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, gzip, importlib.util
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from loguru import logger
+
+# Import local modules from the run directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run'))
+import meshregrid, colorramp, coverage, pyramid, isobands, vectortile, tiles
+import synthmesh
+
+# Fraction of the area of a band that decoding may gain or lose to snapping to tile coordinates, besides the rings smaller
+# than the minimum area that encoding leaves out
+AREA_FRACTION = 0.02
+
+# Decode a gzip compressed vector tile with the reference decoder, with y going down like the encoded tile coordinates
+def decodeTile(data):
+    import mapbox_vector_tile
+    return(mapbox_vector_tile.decode(gzip.decompress(data), default_options={'y_coord_down': True}))
+
+# Check that the outer rings of decoded polygons are clockwise and their holes counterclockwise, with y going down, as the
+# vector tile specification requires. The reference decoder does not check winding, so a polygon with the wrong winding
+# decodes the same, but other clients drop it or fill its holes
+def checkWinding(geometry):
+    for polygon in shapely.get_parts(geometry):
+        # Clockwise with y going down is counterclockwise with y going up, as shapely sees it
+        if not shapely.is_ccw(polygon.exterior) or any(shapely.is_ccw(ring) for ring in polygon.interiors):
+            return(False)
+    return(True)
+
+# Check that a square with a hole, and a ring that collapses, decode to the polygon that was encoded, with its properties
+def checkRings():
+    problems = []
+    outer = [[0, 0], [0, 100], [100, 100], [100, 0]]
+    hole = [[20, 20], [60, 20], [60, 60], [20, 60]]
+    collapsed = [[200, 200], [300, 200], [400, 200]]
+    properties = {'band': 3, 'lower': 0.5, 'upper': 1.25, 'color': '#1f2e3d'}
+    rings = (outer + hole + collapsed, [4, 4, 3], [True, False, True])
+    data = vectortile.encodeTile([vectortile.encodeLayer(isobands.LAYER, [(rings, properties)])])
+
+    layer = decodeTile(data).get(isobands.LAYER)
+    if layer is None or len(layer['features']) != 1:
+        return(['The polygon did not decode to one feature'])
+    if layer['extent'] != vectortile.EXTENT:
+        problems.append('The layer has extent '+str(layer['extent'])+' instead of '+str(vectortile.EXTENT))
+    feature = layer['features'][0]
+    geometry = shape(feature['geometry'])
+    expected = shapely.Polygon(outer, [hole])
+    if not geometry.is_valid or not geometry.equals(expected):
+        problems.append('The polygon decoded as '+geometry.wkt+' instead of '+expected.wkt)
+    elif not checkWinding(geometry):
+        problems.append('The polygon rings have the wrong winding')
+    if feature['properties'] != properties:
+        problems.append('The polygon properties decoded as '+str(feature['properties'])+' instead of '+str(properties))
+    return(problems)
+
+# Check that the isoband tiles of a synthetic mesh decode to valid polygons, with the properties of their bands, and about
+# the area of their bands in the tile
+def checkBands(product, nodes, zlstart, zlstop):
+    x, y, tri = synthmesh.synthMesh(nodes)
+    values = synthmesh.synthValues(product, x, y)
+    values[values == synthmesh.FILL_VALUE] = np.nan
+    mesh = meshregrid.MeshGeometry(x, y, tri)
+    wx, wy = isobands.worldCoords(mesh.x, mesh.y)
+
+    ramp = colorramp.getColorRamp(product, 'discrete', colorramp.valueStats(values))
+    limits = isobands.bandLimits(ramp)
+    properties = isobands.bandProperties(limits, colorramp.buildLookup(ramp))
+    logger.info('Check '+product+' isobands of '+str(len(x))+' nodes in '+str(len(limits))+' bands, zoom levels '+str(zlstart)+' to '+str(zlstop))
+
+    problems = []
+    counts = {'tiles': 0, 'features': 0}
+    minArea = isobands.MIN_AREA_PIXELS * (vectortile.EXTENT / tiles.TILE_SIZE) ** 2
+
+    def checkTile(z, tx, ty, tile):
+        data = isobands.encodeBands(tile, properties, z, tx, ty)
+        if data is None:
+            return
+        counts['tiles'] += 1
+        name = str(z)+'/'+str(tx)+'/'+str(ty)
+        layer = decodeTile(data).get(isobands.LAYER)
+        if layer is None:
+            problems.append('Tile '+name+' has no '+isobands.LAYER+' layer')
+            return
+
+        # Expected band areas are those of the band geometry clipped to the tile buffer, in tile coordinates
+        n = 2 ** z
+        box = shapely.box(*isobands.tileBox(z, tx, ty))
+        seen = set()
+        for feature in layer['features']:
+            counts['features'] += 1
+            band = feature['properties'].get('band')
+            if band not in tile['bands'] or band in seen:
+                problems.append('Tile '+name+' has an unexpected or repeated feature of band '+str(band))
+                continue
+            seen.add(band)
+            if feature['properties'] != properties[band]:
+                problems.append('Tile '+name+' band '+str(band)+' has properties '+str(feature['properties'])+' instead of '+str(properties[band]))
+            geometry = shape(feature['geometry'])
+            if geometry.geom_type not in ('Polygon', 'MultiPolygon') or not geometry.is_valid:
+                problems.append('Tile '+name+' band '+str(band)+' decoded as a '+geometry.geom_type+' that is not valid: '+shapely.is_valid_reason(geometry))
+                continue
+            if not checkWinding(geometry):
+                problems.append('Tile '+name+' band '+str(band)+' has rings with the wrong winding')
+            expected = shapely.transform(shapely.intersection(tile['bands'][band], box), lambda coords: (coords * n - [tx, ty]) * vectortile.EXTENT)
+            tolerance = AREA_FRACTION * expected.area + minArea * len(shapely.get_rings(shapely.get_parts(expected)))
+            if abs(geometry.area - expected.area) > tolerance:
+                problems.append('Tile '+name+' band '+str(band)+' has area '+'{:.0f}'.format(geometry.area)+' instead of '+'{:.0f}'.format(expected.area))
+
+    cover = coverage.meshCoverage(mesh, values, zlstart, zlstop)
+    pyramid.buildPyramid(cover, lambda z, tx, ty: isobands.renderBands(mesh, values, wx, wy, limits, z, tx, ty), isobands.reduceBands, checkTile)
+    logger.info('Checked '+str(counts['features'])+' features in '+str(counts['tiles'])+' tiles')
+    if counts['features'] == 0:
+        problems.append('No isoband features were encoded')
+    return(problems)
+
+@logger.catch
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', format='{time:HH:mm:ss} {message}')
+
+    if importlib.util.find_spec('mapbox_vector_tile') is None:
+        logger.info('Checking isobands needs the mapbox_vector_tile reference decoder: pip install mapbox-vector-tile')
+        sys.exit(1)
+
+    problems = checkRings()
+    for product in args.products:
+        problems += checkBands(product, args.nodes, args.zlstart, args.zlstop)
+    for problem in problems:
+        logger.info(problem)
+    if problems:
+        logger.info('Isoband check found '+str(len(problems))+' problems')
+        sys.exit(1)
+    logger.info('Isoband tiles decode to valid bands')
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--products", help="Products of the synthetic meshes", action="store", dest="products", nargs='+', choices=sorted(synthmesh.VALUE_RANGES), default=['maxele', 'maxwvel'])
+    parser.add_argument("--nodes", help="Approximate number of mesh nodes", action="store", dest="nodes", type=int, default=20000)
+    parser.add_argument("--zlstart", help="Start zoom level", action="store", dest="zlstart", type=int, default=4)
+    parser.add_argument("--zlstop", help="Stop zoom level", action="store", dest="zlstop", type=int, default=8)
+
+    args = parser.parse_args()
+    main(args)
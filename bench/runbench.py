@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, json, time, socket, platform, subprocess, tempfile, itertools, statistics
+from loguru import logger
+
+# Import local modules
+import synthmesh
+
+# Directories of the benchmark and of the scripts it runs
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+RUN_DIR = os.path.join(BENCH_DIR, '..', 'run')
+
+# Scripts that are benchmarked
+SCRIPTS = ('adcirc2geotiff', 'geotiff2mbtiles', 'adcirc2mbtiles')
+
+# Case parameters of the presets. Resolutions are tiff pixel sizes in degrees, and zoom ranges are zlstart:zlstop
+PRESETS = {'quick': {'nodes': [10000, 100000], 'products': ['maxele'], 'resolutions': [0.01], 'zooms': ['0:6'], 'cpus': [1],
+                     'repeats': 3},
+           'full': {'nodes': [10000, 100000, 1000000], 'products': ['maxele', 'maxwvel', 'swan_HS_max'],
+                    'resolutions': [0.01, 0.005, 0.002], 'zooms': ['0:6', '0:9'], 'cpus': [1, 4], 'repeats': 5}}
+
+# Compared values of runs and stages, with the smallest difference that counts as a regression, so that noise in short
+# stages is not reported. Runs have the peak resident memory of the process, and stages the growth of the peak
+COMPARED = (('wallSeconds', 0.05), ('peakRssBytes', 16 * 2**20), ('peakRssGrowthBytes', 16 * 2**20))
+
+# Get the environment of a benchmark run, so that results from different machines or images are not mistaken for a regression
+def getEnvironment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCH_DIR, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    import numpy
+    return({'commit': commit, 'image': os.getenv('IMAGE_TAG'), 'host': socket.gethostname(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'numpy': numpy.__version__, 'cpuCount': os.cpu_count()})
+
+# Get the cases of a benchmark run. adcirc2geotiff cases vary the mesh, product, resolution and CPUs, geotiff2mbtiles cases
+# tile the tiff of a resolution over a zoom range, and adcirc2mbtiles cases render the mesh over a zoom range in one process
+def getCases(scripts, nodes, products, resolutions, zooms, cpus, engine):
+    cases = []
+    for script in scripts:
+        for n, product in itertools.product(nodes, products):
+            case = {'script': script, 'nodes': n, 'product': product}
+            if script == 'adcirc2geotiff':
+                cases += [dict(case, resolution=resolution, cpu=cpu, engine=engine) for resolution, cpu in itertools.product(resolutions, cpus)]
+            elif script == 'geotiff2mbtiles':
+                cases += [dict(case, resolution=resolution, zoom=zoom, cpu=cpu) for resolution, zoom, cpu in itertools.product(resolutions, zooms, cpus)]
+            else:
+                cases += [dict(case, zoom=zoom) for zoom in zooms]
+    return(cases)
+
+# Get the key of a case, which identifies it in results files
+def caseKey(case):
+    return(' '.join(key+'='+str(case[key]) for key in sorted(case)))
+
+# Get the synthetic netCDF file of a mesh size and product, writing it once per work directory
+def getInputDir(workDir, nodes, product, extent):
+    inputDir = os.path.join(workDir, 'input', str(nodes), '')
+    inputFile = product+'.63.nc'
+    if not os.path.exists(inputDir+inputFile):
+        synthmesh.writeSynthFile(inputDir+inputFile, product, nodes, extent)
+    return(inputDir)
+
+# Get the arguments of a case of a script
+def caseArgs(case, workDir, extent):
+    inputDir = getInputDir(workDir, case['nodes'], case['product'], extent)
+    inputFile = case['product']+'.63.nc'
+    caseDir = os.path.join(workDir, 'output', caseKey(case).replace(' ', '.').replace('=', '-'), '')
+    if case['script'] == 'adcirc2geotiff':
+        return(['--inputFile', inputFile, '--inputDir', inputDir, '--outputDir', caseDir+'tiff', '--finalDir', caseDir+'final',
+                '--regrid', case['engine'], '--styler', case['engine'], '--cpu', str(case['cpu']),
+                '--mapUnitsPerPixel', str(case['resolution'])])
+
+    zlstart, zlstop = case['zoom'].split(':')
+    if case['script'] == 'adcirc2mbtiles':
+        return(['--inputFile', inputFile, '--zlstart', zlstart, '--zlstop', zlstop, '--inputDir', inputDir, '--outputDir', caseDir+'mbtiles',
+                '--finalDir', caseDir+'final'])
+
+    # geotiff2mbtiles tiles the styled tiff of the resolution, which is made once with the NumPy engines
+    tiffDir = os.path.join(workDir, 'tiff', str(case['nodes']), str(case['resolution']), '')
+    if not os.path.exists(tiffDir+case['product']+'.63.tif'):
+        logger.info('Make '+case['product']+' tiff with resolution '+str(case['resolution'])+' for geotiff2mbtiles')
+        tiffCase = {'script': 'adcirc2geotiff', 'nodes': case['nodes'], 'product': case['product'], 'resolution': case['resolution'],
+                    'cpu': 1, 'engine': 'numpy'}
+        args = caseArgs(tiffCase, workDir, extent)
+        args[args.index('--outputDir') + 1] = tiffDir
+        runScript('adcirc2geotiff', args, workDir)
+    return(['--inputFile', case['product']+'.63.tif', '--zlstart', zlstart, '--zlstop', zlstop, '--cpu', str(case['cpu']), '--inputDir', tiffDir,
+            '--outputDir', caseDir+'mbtiles', '--finalDir', caseDir+'final', '--tiler', 'native'])
+
+# Run a script in a new process, so that each run starts cold and its peak memory is its own, returning the return code,
+# the wall time and the end of its error output
+def runScript(script, args, workDir):
+    env = dict(os.environ, LOG_PATH=os.path.join(workDir, 'logs'))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.join(RUN_DIR, script+'.py')] + args, cwd=RUN_DIR, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    return(proc.returncode, time.perf_counter() - start, proc.stderr[-2000:])
+
+# Run one repeat of a case, returning its result
+def runCase(case, repeat, workDir, extent, environment, runId):
+    args = caseArgs(case, workDir, extent)
+    metricsFile = os.path.join(workDir, 'metrics', runId+'.json')
+    if os.path.exists(metricsFile):
+        os.remove(metricsFile)
+
+    logger.info('Run '+caseKey(case)+' repeat '+str(repeat))
+    returncode, seconds, error = runScript(case['script'], args+['--metricsFile', metricsFile], workDir)
+    result = {'run': runId, 'key': caseKey(case), 'case': case, 'repeat': repeat, 'time': time.time(), 'environment': environment,
+              'status': 'done', 'wallSeconds': seconds, 'peakRssBytes': None, 'stages': {}}
+
+    # The scripts exit without an error status on some failures, so a run without a metrics file failed as well
+    if returncode != 0 or not os.path.exists(metricsFile):
+        result.update(status='failed', returncode=returncode, error=error)
+        logger.info('Failed '+caseKey(case)+': '+error)
+        return(result)
+    with open(metricsFile) as f:
+        metrics = json.load(f)
+    result['peakRssBytes'] = metrics['peakRssBytes']
+    result['stages'] = metrics['reports'][0]['stages'] if metrics['reports'] else {}
+    logger.info('Ran '+caseKey(case)+' in '+'{:.2f}'.format(seconds)+' seconds, with '+'{:.0f}'.format(result['peakRssBytes'] / 2**20)+' MB peak RSS')
+    return(result)
+
+# Run the cases of a benchmark, appending each result to a JSON lines results file
+def runBench(cases, repeats, workDir, resultsFile, extent):
+    environment = getEnvironment()
+    runId = time.strftime('%Y%m%dT%H%M%S')+'-'+str(os.getpid())
+    os.makedirs(os.path.dirname(os.path.abspath(resultsFile)), exist_ok=True)
+    logger.info('Benchmark run '+runId+' of '+str(len(cases))+' cases with '+str(repeats)+' repeats, writing '+resultsFile)
+
+    failed = 0
+    for case in cases:
+        for repeat in range(repeats):
+            result = runCase(case, repeat, workDir, extent, environment, runId)
+            failed += result['status'] == 'failed'
+            with open(resultsFile, 'a') as f:
+                f.write(json.dumps(result)+'\n')
+    return(failed)
+
+# Read the results of the done runs in a results file, keeping only the latest run unless allRuns is set
+def readResults(resultsFile, allRuns=False):
+    with open(resultsFile) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    results = [result for result in results if result['status'] == 'done']
+    if not allRuns and results:
+        latest = max(results, key=lambda result: result['time'])['run']
+        results = [result for result in results if result['run'] == latest]
+    return(results)
+
+# Get the median of each compared value of each case, for the whole run and for each of its stages
+def summarize(results):
+    values = {}
+    for result in results:
+        entries = [('total', result)] + list(result['stages'].items())
+        for name, record in entries:
+            for field, _ in COMPARED:
+                if record.get(field) is not None:
+                    values.setdefault((result['key'], name, field), []).append(record[field])
+    return({key: statistics.median(samples) for key, samples in values.items()})
+
+# Compare the current results with the baseline results, returning the regressions, which are values that grew by more
+# than the threshold fraction and the smallest difference of the value
+def compareResults(baseline, current, threshold):
+    minimums = dict(COMPARED)
+    regressions = []
+    for key, value in sorted(current.items()):
+        base = baseline.get(key)
+        if base is None:
+            continue
+        change = (value - base) / base if base > 0 else 0.0
+        regressed = change > threshold and value - base > minimums[key[2]]
+        logger.info(('REGRESSION ' if regressed else '')+key[0]+' '+key[1]+' '+key[2]+': '+'{:.4g}'.format(base)+' -> '+'{:.4g}'.format(value)
+                    +' ('+'{:+.1%}'.format(change)+')')
+        if regressed:
+            regressions.append({'key': key[0], 'stage': key[1], 'field': key[2], 'baseline': base, 'current': value, 'change': change})
+    return(regressions)
+
+@logger.catch
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level='INFO', format='{time:HH:mm:ss} {message}')
+
+    resultsFile = args.resultsFile or os.path.join(args.workDir, 'results.jsonl')
+    if args.action == 'run':
+        preset = PRESETS[args.preset]
+        cases = getCases(args.scripts, args.nodes or preset['nodes'], args.products or preset['products'], args.resolutions or preset['resolutions'],
+                         args.zooms or preset['zooms'], args.cpus or preset['cpus'], args.engine)
+        failed = runBench(cases, args.repeats or preset['repeats'], args.workDir, resultsFile, tuple(args.extent))
+        if failed:
+            logger.info(str(failed)+' benchmark runs failed')
+            sys.exit(1)
+    else:
+        if not args.baseline:
+            sys.exit('Comparing needs --baseline')
+        regressions = compareResults(summarize(readResults(args.baseline, args.allRuns)), summarize(readResults(resultsFile, args.allRuns)),
+                                     args.threshold)
+        logger.info(str(len(regressions))+' regressions above '+'{:.0%}'.format(args.threshold))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("action", help="Run benchmark cases (run), or compare results with a baseline (compare)", choices=['run', 'compare'])
+    parser.add_argument("--workDIR", "--workDir", help="Work directory path, holding synthetic meshes, outputs and logs", action="store", dest="workDir", default=os.path.join(tempfile.gettempdir(), 'adcirc2mbtiles-bench'))
+    parser.add_argument("--resultsFILE", "--resultsFile", help="JSON lines results file path, by default results.jsonl in the work directory", action="store", dest="resultsFile")
+    parser.add_argument("--preset", help="Case parameters used when not given", action="store", dest="preset", choices=sorted(PRESETS), default='quick')
+    parser.add_argument("--scripts", help="Benchmarked scripts", action="store", dest="scripts", nargs='+', choices=SCRIPTS, default=list(SCRIPTS))
+    parser.add_argument("--nodes", help="Approximate numbers of mesh nodes", action="store", dest="nodes", nargs='+', type=int)
+    parser.add_argument("--products", help="Products", action="store", dest="products", nargs='+', choices=sorted(synthmesh.VALUE_RANGES))
+    parser.add_argument("--resolutions", help="Tiff pixel sizes in degrees", action="store", dest="resolutions", nargs='+', type=float)
+    parser.add_argument("--zooms", help="Zoom ranges as zlstart:zlstop", action="store", dest="zooms", nargs='+')
+    parser.add_argument("--cpus", help="Numbers of CPUs", action="store", dest="cpus", nargs='+', type=int)
+    parser.add_argument("--repeats", help="Number of runs of each case", action="store", dest="repeats", type=int)
+    parser.add_argument("--engine", help="Regrid and styling engine of adcirc2geotiff", action="store", dest="engine", choices=['qgis', 'numpy'], default='numpy')
+    parser.add_argument("--extent", help="Synthetic mesh extent as west south east north", action="store", dest="extent", nargs=4, type=float, default=list(synthmesh.EXTENT))
+    parser.add_argument("--baseline", help="Baseline results file path to compare with", action="store", dest="baseline")
+    parser.add_argument("--threshold", help="Fraction by which a median may grow before it is a regression", action="store", dest="threshold", type=float, default=0.1)
+    parser.add_argument("--allRuns", help="Compare all runs in the results files, instead of the latest run of each", action="store_true", dest="allRuns")
+
+    args = parser.parse_args()
+    main(args)
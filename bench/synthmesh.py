@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse
+import numpy as np
+import netCDF4 as nc
+from loguru import logger
+
+# Import local modules from the run directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run'))
+import meshregrid
+
+# Fill value of ADCIRC node values, used for dry nodes
+FILL_VALUE = -99999.0
+
+# Range of the values of each product, from calm to the peak of the storm
+VALUE_RANGES = {'maxele': (0.0, 3.0), 'maxwvel': (0.0, 60.0), 'swan_HS_max': (0.0, 12.0)}
+
+# Default extent of synthetic meshes, as west, south, east, north
+EXTENT = (-80.0, 30.0, -75.0, 35.0)
+
+# Create the nodes and triangles of a synthetic mesh, which is a jittered grid split into triangles. Node spacing gets
+# finer toward the coast, at the west edge, like ADCIRC meshes, and an island hole is cut out of the triangles
+def synthMesh(nodes, extent=EXTENT, seed=0):
+    rng = np.random.RandomState(seed)
+    west, south, east, north = extent
+    n = max(2, int(round(np.sqrt(nodes))))
+
+    # Refine columns toward the west edge, and jitter nodes by a fraction of their spacing
+    u = np.linspace(0.0, 1.0, n) ** 1.5
+    v = np.linspace(0.0, 1.0, n)
+    ux, vy = np.meshgrid(u, v)
+    jitter = 0.3 / n
+    ux[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (n - 2, n - 2)) * ux[1:-1, 1:-1]
+    vy[1:-1, 1:-1] += rng.uniform(-jitter, jitter, (n - 2, n - 2))
+    x = west + ux.ravel() * (east - west)
+    y = south + vy.ravel() * (north - south)
+
+    # Split each grid cell into two triangles
+    index = np.arange(n * n).reshape(n, n)
+    a = index[:-1, :-1].ravel()
+    b = index[:-1, 1:].ravel()
+    c = index[1:, :-1].ravel()
+    d = index[1:, 1:].ravel()
+    tri = np.concatenate((np.stack((a, b, d), axis=1), np.stack((a, d, c), axis=1)))
+
+    # Cut out an island
+    cx = x[tri].mean(axis=1)
+    cy = y[tri].mean(axis=1)
+    radius = 0.08 * min(east - west, north - south)
+    island = (cx - (west + 0.6 * (east - west))) ** 2 + (cy - (south + 0.4 * (north - south))) ** 2 < radius ** 2
+    return(x, y, tri[~island])
+
+# Create synthetic node values of a product, which are a storm peak over a smooth background. maxele and swan_HS_max
+# nodes on land, near the west edge, are dry and get the fill value
+def synthValues(product, x, y, extent=EXTENT, seed=0):
+    rng = np.random.RandomState(seed + 1)
+    west, south, east, north = extent
+    u = (x - west) / (east - west)
+    v = (y - south) / (north - south)
+    low, high = VALUE_RANGES[product]
+    field = 0.3 + 0.1 * np.sin(6 * np.pi * u) * np.cos(4 * np.pi * v) + 0.7 * np.exp(-((u - 0.35) ** 2 + (v - 0.5) ** 2) / 0.02)
+    values = low + (high - low) * np.clip(field + rng.normal(0.0, 0.01, len(x)), 0.0, 1.0)
+    if product != 'maxwvel':
+        values[u + 0.05 * np.sin(8 * np.pi * v) < 0.08] = FILL_VALUE
+    return(values)
+
+# Write a synthetic ADCIRC netCDF file with the mesh and the maximum values of a product
+def writeSynthFile(outputFile, product, nodes, extent=EXTENT, seed=0):
+    x, y, tri = synthMesh(nodes, extent, seed)
+    values = synthValues(product, x, y, extent, seed)
+    logger.info('Write synthetic '+product+' file '+outputFile+' with '+str(len(x))+' nodes and '+str(len(tri))+' elements')
+
+    os.makedirs(os.path.dirname(os.path.abspath(outputFile)), exist_ok=True)
+    ds = nc.Dataset(outputFile, 'w', format='NETCDF4')
+    ds.createDimension('time', None)
+    ds.createDimension('node', len(x))
+    ds.createDimension('nele', len(tri))
+    ds.createDimension('nvertex', 3)
+    ds.createDimension('mesh', 1)
+
+    # UGRID mesh topology, which QGIS uses to read ADCIRC files
+    mesh = ds.createVariable('adcirc_mesh', 'i4', ('mesh',))
+    mesh.cf_role = 'mesh_topology'
+    mesh.topology_dimension = 2
+    mesh.node_coordinates = 'x y'
+    mesh.face_node_connectivity = 'element'
+
+    time = ds.createVariable('time', 'f8', ('time',))
+    time.units = 'seconds since 2022-01-01 00:00:00'
+    time[:] = [0.0]
+    xvar = ds.createVariable('x', 'f8', ('node',))
+    xvar.standard_name = 'longitude'
+    xvar.units = 'degrees_east'
+    xvar[:] = x
+    yvar = ds.createVariable('y', 'f8', ('node',))
+    yvar.standard_name = 'latitude'
+    yvar.units = 'degrees_north'
+    yvar[:] = y
+
+    # ADCIRC element numbers are 1 based
+    element = ds.createVariable('element', 'i4', ('nele', 'nvertex'))
+    element.cf_role = 'face_node_connectivity'
+    element.start_index = 1
+    element[:] = tri + 1
+
+    var = ds.createVariable(meshregrid.MESH_VARIABLES[product], 'f8', ('node',), fill_value=FILL_VALUE)
+    var.mesh = 'adcirc_mesh'
+    var.location = 'node'
+    var[:] = values
+    ds.close()
+    return(outputFile)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--outputFILE", "--outputFile", help="Output netCDF file path, such as maxele.63.nc", action="store", dest="outputFile", required=True)
+    parser.add_argument("--product", help="Product", action="store", dest="product", choices=sorted(VALUE_RANGES), default='maxele')
+    parser.add_argument("--nodes", help="Approximate number of mesh nodes", action="store", dest="nodes", type=int, default=100000)
+    parser.add_argument("--extent", help="Mesh extent as west south east north", action="store", dest="extent", nargs=4, type=float, default=list(EXTENT))
+    parser.add_argument("--seed", help="Random seed", action="store", dest="seed", type=int, default=0)
+
+    args = parser.parse_args()
+    writeSynthFile(args.outputFile, args.product, args.nodes, tuple(args.extent), args.seed)
@@ -18,6 +18,10 @@ from functools import wraps
 from matplotlib.colors import LinearSegmentedColormap
 from PIL import Image
 from colour import Color
+from osgeo import gdal
+
+# Import local modules
+import meshregrid, meshcache, rasterfile, colorramp, regions, resultcache, stagemetrics
 
 # Import QGIS modules
 from PyQt5.QtGui import QColor
@@ -35,7 +39,7 @@ from qgis.core import (
     QgsColorRampShader,
     QgsRasterShader,
     QgsSingleBandPseudoColorRenderer,
-    QgsRasterHistogram,
+    QgsRectangle,
     QgsErrorMessage
 )
 
@@ -78,29 +82,46 @@ def makeDirs(outputDir):
     else:
         logger.info('Directory '+outputDir+' already made.')
 
-# Define parameters used in creating tiff
+# Define parameters used in creating tiff. INPUT_EXTENT is the extent to regrid, as xmin,xmax,ymin,ymax, or null to regrid
+# the extent of the mesh
 def getParameters(inputDir, inputFile, outputDir):
     tifFile = inputFile.split('.')[0]+'.raw.'+inputFile.split('.')[1]+'.tif'
-    parms = '{"INPUT_EXTENT" : "-97.85833,-60.040029999999994,7.909559999999999,45.83612", "INPUT_GROUP" : 1, "INPUT_LAYER" : "'+inputDir+inputFile+'", "INPUT_TIMESTEP" : 0,  "OUTPUT_RASTER" : "'+outputDir+tifFile+'", "MAP_UNITS_PER_PIXEL" : 0.001}'
+    parms = '{"INPUT_EXTENT" : null, "INPUT_GROUP" : 1, "INPUT_LAYER" : "'+inputDir+inputFile+'", "INPUT_TIMESTEP" : 0,  "OUTPUT_RASTER" : "'+outputDir+tifFile+'", "MAP_UNITS_PER_PIXEL" : 0.001}'
     return(json.loads(parms))
 
+# Clip the extent of a mesh, as xmin, xmax, ymin, ymax, to the INPUT_EXTENT parameter, if it is set
+def clipExtent(xmin, xmax, ymin, ymax, parameters):
+    if parameters['INPUT_EXTENT']:
+        exmin, exmax, eymin, eymax = [float(value) for value in parameters['INPUT_EXTENT'].split(',')]
+        xmin, xmax, ymin, ymax = max(xmin, exmin), min(xmax, exmax), max(ymin, eymin), min(ymax, eymax)
+        if xmin >= xmax or ymin >= ymax:
+            raise Exception('INPUT_EXTENT '+parameters['INPUT_EXTENT']+' does not overlap the mesh')
+        logger.info('Regrid extent '+','.join(str(value) for value in (xmin, xmax, ymin, ymax))+' of INPUT_EXTENT')
+    return(xmin, xmax, ymin, ymax)
+
+# Open netCDF file, and check its dimensions. If dimensions are incorrect exit program
+def checkDimensions(inputLayer):
+    logger.info('Check INPUT_LAYER dimensions')
+    ds = nc.Dataset(inputLayer)
+    for dim in ds.dimensions.values():
+        if dim.size == 0:
+            logger.info('The netCDF file '+Path(inputLayer).parts[-1]+' has an invalid dimension value of 0, so the program will exit')
+            sys.exit(1)
+    ds.close()
+
 # Convert mesh layer as raster and save as a GeoTiff
 @ignore_warnings
-def exportRaster(parameters, tmpDir):
+def exportRaster(parameters, tmpDir, memory=None):
     # Open layer from INPUT_LAYER 
     logger.info('Open layer from INPUT_LAYER') 
     inputFile = 'Ugrid:'+'"'+parameters['INPUT_LAYER']+'"'
     meshfile = Path(inputFile).parts[-1]
     meshlayer = meshfile.split('.')[0]
-    layer = QgsMeshLayer(inputFile, meshlayer, 'mdal')
+    with stagemetrics.stage('open'):
+        layer = QgsMeshLayer(inputFile, meshlayer, 'mdal')
 
-    # Open INPUT_LAYER with netCDF4, and check its dimensions. If dimensions are incorrect exit program
-    logger.info('Check INPUT_LAYER dimensions')
-    ds = nc.Dataset(parameters['INPUT_LAYER'])
-    for dim in ds.dimensions.values():
-        if dim.size == 0:
-            logger.info('The netCDF file '+meshfile.split('"')[0]+' has an invalid dimension value of 0, so the program will exit')
-            sys.exit(1)
+        # Open INPUT_LAYER with netCDF4, and check its dimensions. If dimensions are incorrect exit program
+        checkDimensions(parameters['INPUT_LAYER'])
 
     # Check if layer is valid
     if layer.isValid() is True:
@@ -110,6 +131,8 @@ def exportRaster(parameters, tmpDir):
         timestep = parameters['INPUT_TIMESTEP']
         mupp = parameters['MAP_UNITS_PER_PIXEL'] 
         extent = layer.extent()
+        xmin, xmax, ymin, ymax = clipExtent(extent.xMinimum(), extent.xMaximum(), extent.yMinimum(), extent.yMaximum(), parameters)
+        extent = QgsRectangle(xmin, ymin, xmax, ymax)
         output_layer = parameters['OUTPUT_RASTER']
         width = extent.width()/mupp 
         height = extent.height()/mupp 
@@ -121,43 +144,149 @@ def exportRaster(parameters, tmpDir):
         transform_context = QgsProject.instance().transformContext()
         output_format = QgsRasterFileWriter.driverForExtension(os.path.splitext(output_layer)[1])
 
+        # Write Int16 and Cloud Optimized GeoTiff output to a temporary float file first, and convert it afterwards
+        if rasterfile.needsConversion(parameters):
+            output_layer = parameters['OUTPUT_RASTER']+'.qgis.tif'
+        floatParameters = dict(parameters, DATA_TYPE='Float32' if parameters['DATA_TYPE'] == 'Float32' else 'Float64', COG=False)
+
         # Open output file for writing
         logger.info('Open output file')
         rfw = QgsRasterFileWriter(output_layer)
         rfw.setOutputProviderKey('gdal') 
         rfw.setOutputFormat(output_format) 
+        rfw.setCreateOptions(rasterfile.getCreateOptions(floatParameters))
 
         # Create one band raster
         logger.info('Create one band raster')
-        rdp = rfw.createOneBandRaster( Qgis.Float64, width, height, extent, crs)
+        dataType = Qgis.Float32 if floatParameters['DATA_TYPE'] == 'Float32' else Qgis.Float64
+        rdp = rfw.createOneBandRaster( dataType, width, height, extent, crs)
 
         # Get dataset index
         logger.info('Get data set index')
         dataset_index = QgsMeshDatasetIndex(dataset, timestep)
 
-        # Regred mesh layer to raster
-        logger.info('Regrid mesh layer')
+        # Regrid mesh layer to raster, one window at a time, and write each window to the GeoTiff file
+        windows = meshregrid.getWindows(int(width), int(height), memory, 24)
         os.chdir(tmpDir)
-        block = QgsMeshUtils.exportRasterBlock( layer, dataset_index, crs,
-                transform_context, mupp, extent) 
+        for xoff, yoff, xsize, ysize in windows:
+            logger.info('Regrid mesh layer window at row '+str(yoff)+' of '+str(int(height)))
+            if len(windows) > 1:
+                window = QgsRectangle(extent.xMinimum(), extent.yMaximum() - (yoff + ysize) * mupp,
+                        extent.xMaximum(), extent.yMaximum() - yoff * mupp)
+            else:
+                window = extent
+            with stagemetrics.stage('regrid', pixels=int(xsize) * int(ysize)):
+                block = QgsMeshUtils.exportRasterBlock( layer, dataset_index, crs,
+                        transform_context, mupp, window) 
+
+            # Write raster to GeoTiff file
+            logger.info('Write raster Geotiff file')
+            with stagemetrics.stage('write'):
+                rdp.writeBlock(block, 1, xoff, yoff)
         os.chdir('/home/nru/repos/adcirc2mbtiles/run')
 
-        # Write raster to GeoTiff file
-        logger.info('Write raster Geotiff file')
-        rdp.writeBlock(block, 1)
         rdp.setNoDataValue(1, block.noDataValue())
         rdp.setEditable(False)
+        del rdp
+
+        if rasterfile.needsConversion(parameters):
+            with stagemetrics.stage('convert'):
+                rasterfile.convertRaster(output_layer, parameters['OUTPUT_RASTER'], parameters)
+            os.remove(output_layer)
+            output_layer = parameters['OUTPUT_RASTER']
 
-        logger.info('Regridded mesh data in '+meshfile.split('"')[0]+' to float64 grid, and saved to tiff ('+output_layer+') file.')
+        logger.info('Regridded mesh data in '+meshfile.split('"')[0]+' to '+parameters['DATA_TYPE']+' grid, and saved to tiff ('+output_layer+') file.')
 
         return(output_layer)
 
     if layer.isValid() is False: 
         raise Exception('Invalid mesh')
 
+# Convert mesh layer as raster with the NumPy regrid engine, and save as a GeoTiff
+def exportRasterNumpy(parameters, memory=None, cpu=1, meshCache=None, meshes=None):
+    # Read mesh geometry and node values from INPUT_LAYER
+    logger.info('Open layer from INPUT_LAYER')
+    inputLayer = parameters['INPUT_LAYER']
+    meshfile = Path(inputLayer).parts[-1]
+    meshlayer = meshfile.split('.')[0]
+    with stagemetrics.stage('open'):
+        checkDimensions(inputLayer)
+        if meshes is not None:
+            mesh = meshes.get(inputLayer, meshCache)
+        elif meshCache:
+            mesh = meshcache.loadMesh(inputLayer, meshCache)
+        else:
+            mesh = meshregrid.loadMesh(inputLayer)
+        values = meshregrid.readValues(inputLayer, meshlayer, parameters['INPUT_TIMESTEP'])
+
+    # Get parameters for processing, using the mesh extent clipped to INPUT_EXTENT as the raster extent
+    logger.info('Get parameters')
+    mupp = parameters['MAP_UNITS_PER_PIXEL']
+    output_layer = parameters['OUTPUT_RASTER']
+    xmin, xmax, ymin, ymax = clipExtent(*mesh.extent(), parameters)
+    width = int((xmax - xmin)/mupp)
+    height = int((ymax - ymin)/mupp)
+
+    # Open output file for writing
+    logger.info('Open output file')
+    geotransform = (xmin, (xmax - xmin)/width, 0, ymax, 0, -(ymax - ymin)/height)
+    ds = rasterfile.createRaster(output_layer, width, height, geotransform, parameters)
+
+    # Regrid mesh to raster, one window at a time, and write each window to the GeoTiff file. When
+    # using several processes, the memory budget is shared by the windows being regridded at once.
+    # Windows of tiled rasters are aligned to whole rows of tiles
+    xs, ys = meshregrid.pixelCenters(xmin, ymin, xmax, ymax, width, height)
+    align = rasterfile.BLOCK_SIZE if parameters['TILED'] or parameters['COG'] else 1
+    if cpu > 1:
+        windows = meshregrid.getWindows(width, height, memory and memory // (cpu + 1), 8, cpu * 4, align)
+    else:
+        windows = meshregrid.getWindows(width, height, memory, 8, 1, align)
+    blocks = meshregrid.regridWindows(mesh, values, xs, ys, windows, cpu)
+    for window, block in stagemetrics.iterStage('regrid', blocks, lambda item: {'pixels': item[0][2] * item[0][3]}):
+        xoff, yoff, xsize, ysize = window
+        logger.info('Write raster Geotiff file window at row '+str(yoff)+' of '+str(height))
+        with stagemetrics.stage('write'):
+            rasterfile.writeBlock(ds, block, xoff, yoff)
+
+    with stagemetrics.stage('convert'):
+        rasterfile.closeRaster(ds, output_layer, parameters)
+
+    logger.info('Regridded mesh data in '+meshfile+' to '+parameters['DATA_TYPE']+' grid with NumPy, and saved to tiff ('+output_layer+') file.')
+
+    return(output_layer)
+
+# Compare two rasters of the same grid, and check that they are equal within a tolerance
+def validateRaster(filename, reference, tolerance):
+    logger.info('Validate '+filename+' against '+reference)
+    ds = gdal.Open(filename)
+    rds = gdal.Open(reference)
+    if (ds.RasterXSize, ds.RasterYSize) != (rds.RasterXSize, rds.RasterYSize):
+        logger.info('Raster sizes differ: '+str((ds.RasterXSize, ds.RasterYSize))+' and '+str((rds.RasterXSize, rds.RasterYSize)))
+        return(False)
+
+    # Compare rasters one strip of rows at a time
+    nodatadiff = 0
+    maxdiff = 0.0
+    rows = max(1, 16000000 // ds.RasterXSize)
+    for yoff in range(0, ds.RasterYSize, rows):
+        ysize = min(rows, ds.RasterYSize - yoff)
+        a = rasterfile.readBlock(ds, 0, yoff, ds.RasterXSize, ysize)
+        b = rasterfile.readBlock(rds, 0, yoff, ds.RasterXSize, ysize)
+        avalid = np.isfinite(a)
+        bvalid = np.isfinite(b)
+        nodatadiff += int(np.count_nonzero(avalid != bvalid))
+        both = avalid & bvalid
+        if both.any():
+            maxdiff = max(maxdiff, float(np.abs(a[both] - b[both]).max()))
+
+    # Pixels on the mesh boundary may be counted as inside by one engine and outside by the other
+    nodatafraction = nodatadiff / (ds.RasterXSize * ds.RasterYSize)
+    logger.info('Maximum difference '+str(maxdiff)+', fraction of pixels with different coverage '+str(nodatafraction))
+    return(maxdiff <= tolerance and nodatafraction <= 0.001)
+
 # Add color and set transparency to GeoTiff
 @ignore_warnings
-def styleRaster(filename, colorscaling, tmpDir):
+def styleRaster(filename, colorscaling, tmpDir, stats=None):
     # Create outfile name
     outfile = "".join(filename.strip().split('.raw'))
 
@@ -173,128 +302,22 @@ def styleRaster(filename, colorscaling, tmpDir):
         logger.info('Layer is valid for styling')
         provider = rlayer.dataProvider()
 
-        if colorscaling == 'interpolated':            
-            # Get bottom and top color values from bin values, calculate values for bottom middle, 
-            # and top middle color values, and create color dictionary
-            logger.info('Get interpolated color values, used for styling')
-            if rasterlayer == 'maxele':
-                bottomvalue = 0.0
-                topvalue =  2.0
-
-                # Calculate range value between the bottom and top color values
-                if bottomvalue < 0:
-                    vrange = topvalue + bottomvalue
-                else:
-                    vrange = topvalue - bottomvalue 
-
-                bottommiddle = vrange * 0.3333
-                topmiddle = vrange * 0.6667
-                colDic = {'bottomcolor':'#0000ff', 'bottommiddle':'#00ffff', 'topmiddle':'#ffff00', 'topcolor':'#ff0000'}
-            else:
-                # Calculate histrogram
-                logger.info('Calculate histogram')
-                provider.initHistogram(QgsRasterHistogram(),1,100)
-                hist = provider.histogram(1)
-
-                # Get histograms stats
-                nbins = hist.binCount
-                minv = hist.minimum
-                maxv = hist.maximum
-
-                # Create histogram array, bin array, and histogram index
-                hista = np.array(hist.histogramVector)
-                bins = np.arange(minv, maxv, (maxv - minv)/nbins)
-                index = np.where(hista > 5)
-
-                bottomvalue = bins[index[0][0]]
-                topvalue = bins[index[0][-1]]
-
-                # Calculate range value between the bottom and top color values
-                if bottomvalue < 0:
-                    vrange = topvalue + bottomvalue
-                else:
-                    vrange = topvalue - bottomvalue 
-
-                bottommiddle = vrange * 0.375
-                topmiddle = vrange * 0.75
-                colDic = {'bottomcolor':'#000000', 'bottommiddle':'#ff0000', 'topmiddle':'#ffff00', 'topcolor':'#ffffff'}
-
-            # Create list of color values
-            valueList = [bottomvalue, bottommiddle, topmiddle, topvalue]
+        # Get color ramp values and colors
+        if colorscaling not in ('interpolated', 'discrete'):
+            logger.info('Incorrect colorscaling value')
+            sys.exit('Incorrect colorscaling value')
+        ramp = colorramp.getColorRamp(rasterlayer, colorscaling, stats)
+        valueList = ramp['valueList']
 
-            # Create color ramp function and add colors
-            logger.info('Create interpolated color ramp')
-            fnc = QgsColorRampShader()
+        # Create color ramp function and add colors
+        logger.info('Create '+colorscaling+' color ramp')
+        fnc = QgsColorRampShader()
+        if colorscaling == 'interpolated':
             fnc.setColorRampType(QgsColorRampShader.Interpolated)
-            lst = [QgsColorRampShader.ColorRampItem(valueList[0], QColor(colDic['bottomcolor'])),\
-                   QgsColorRampShader.ColorRampItem(valueList[1], QColor(colDic['bottommiddle'])), \
-                   QgsColorRampShader.ColorRampItem(valueList[2], QColor(colDic['topmiddle'])), \
-                   QgsColorRampShader.ColorRampItem(valueList[3], QColor(colDic['topcolor']))]
-            fnc.setColorRampItemList(lst)
-
-        elif colorscaling == 'discrete':
-            # Calculate values for bottom middle, and top middle color values, and create color dictionary
-            logger.info('Get descrete color values, used for styling')
-            if rasterlayer == 'maxele':
-                # Defind color values
-                minv = 0.0
-                maxv = 2.0
-                bottomvalue = 0.0
-                topvalue =  2.0
-                bottomcolor = Color('#0000ff')
-                topcolor = Color('#ff0000')
-                colorramp=list(bottomcolor.range_to(topcolor, 32))
-		
-                # Create list of color values and colorramp
-                valueList = np.append(np.arange(bottomvalue, topvalue, topvalue/31), topvalue)
-
-            else:
-                # Calculate histrogram
-                logger.info('Calculate histogram')
-                provider.initHistogram(QgsRasterHistogram(),1,100)
-                hist = provider.histogram(1)
-
-                # Get histograms stats
-                nbins = hist.binCount
-                minv = hist.minimum
-                maxv = hist.maximum
-
-                # Create histogram array, bin array, and histogram index
-                hista = np.array(hist.histogramVector)
-                bins = np.arange(minv, maxv, (maxv - minv)/nbins)
-                index = np.where(hista > 5)
-
-                # Define color values
-                bottomvalue = 0.0
-                topvalue = bins[index[0][-1]]
-                bottomcolor = Color('#000000')
-                bottommiddle = Color('#ff0000')
-                topmiddle = Color('#ffff00')
-                topcolor = Color('#ffffff')
-                colorrampbottom=list(bottomcolor.range_to(bottommiddle, 11))
-                colorrampmmiddle=list(bottommiddle.range_to(topmiddle, 12))
-                colorramptop=list(topmiddle.range_to(topcolor, 11))
-                colorramp = colorrampbottom + colorrampmmiddle[1:-1] + colorramptop
-
-                # Create list of color values and colorramp
-                valueList = np.arange(bottomvalue, topvalue, topvalue/32)
-
-            # Create color ramp function and add colors
-            logger.info('Create descrete color ramp')
-            fnc = QgsColorRampShader()
-            fnc.setColorRampType(QgsColorRampShader.Discrete)
-            lst = []
-            lst.append(QgsColorRampShader.ColorRampItem(minv, QColor(colorramp[0].hex_l)))
-            logger.info('Check valueList '+str(len(valueList))+' and colorramp '+str(len(colorramp))+' length ')
-            for i in range(len(valueList)):
-                lst.append(QgsColorRampShader.ColorRampItem(valueList[i], QColor(colorramp[i].hex_l)))
-                
-            lst.append(QgsColorRampShader.ColorRampItem(maxv, QColor(colorramp[-1].hex_l)))
-            fnc.setColorRampItemList(lst)
-        
         else:
-            logger.info('Incorrect colorscaling value')
-            sys.exit('Incorrect colorscaling value')
+            fnc.setColorRampType(QgsColorRampShader.Discrete)
+        lst = [QgsColorRampShader.ColorRampItem(value, QColor(color)) for value, color in zip(ramp['values'], ramp['colors'])]
+        fnc.setColorRampItemList(lst)
 
         os.chdir(tmpDir)
 
@@ -305,7 +328,7 @@ def styleRaster(filename, colorscaling, tmpDir):
 
         # Create color render and set opacity
         renderer = QgsSingleBandPseudoColorRenderer(provider, 1, shader)
-        renderer.setOpacity(0.75)
+        renderer.setOpacity(colorramp.OPACITY)
 
         # Get output format
         output_format = QgsRasterFileWriter.driverForExtension(os.path.splitext(outfile)[1])
@@ -349,6 +372,63 @@ def styleRaster(filename, colorscaling, tmpDir):
 
     return(valueList)
 
+# Parse style variants given as colorscaling[:opacity[:name]], such as discrete or interpolated:0.5:interp50
+def parseStyles(styles):
+    variants = []
+    for style in styles:
+        fields = style.split(':')
+        variants.append({'colorscaling': fields[0],
+                         'opacity': float(fields[1]) if len(fields) > 1 and fields[1] else colorramp.OPACITY,
+                         'name': fields[2] if len(fields) > 2 else ''})
+    return(variants)
+
+# Get the styled tiff file name of a style variant
+def styledFile(filename, variant):
+    if variant['name']:
+        return(filename.strip().replace('.raw.', '.'+variant['name']+'.'))
+    return("".join(filename.strip().split('.raw')))
+
+# Add color and set transparency to GeoTiff with the NumPy colorizer, writing one styled tiff per style variant in a single
+# pass over the raw tiff
+def styleRasterNumpy(filename, styles, parameters, stats=None):
+    # Open raw tiff
+    logger.info('Open raw tiff for styling')
+    rasterfilename = Path(filename).parts[-1].strip()
+    rasterlayer = rasterfilename.split('.')[0]
+    src = gdal.Open(filename)
+    if src is None:
+        logger.info('Invalid raster')
+        raise Exception('Invalid raster')
+
+    # Create a lookup table and an output file for each style variant. The first variant writes the same file as styleRaster
+    outputs = []
+    for variant in parseStyles(styles):
+        if variant['colorscaling'] not in ('interpolated', 'discrete'):
+            logger.info('Incorrect colorscaling value')
+            sys.exit('Incorrect colorscaling value')
+        ramp = colorramp.getColorRamp(rasterlayer, variant['colorscaling'], stats)
+        lookup = colorramp.buildLookup(ramp, variant['opacity'])
+        outfile = styledFile(filename, variant)
+        logger.info('Open output file '+outfile)
+        ds = rasterfile.createRgbaRaster(outfile, src.RasterXSize, src.RasterYSize, src.GetGeoTransform(), parameters)
+        outputs.append((ramp, lookup, ds, outfile))
+
+    # Colorize the raw tiff one strip of rows at a time, and write each strip to every styled tiff
+    rows = rasterfile.BLOCK_SIZE * 4
+    for yoff in range(0, src.RasterYSize, rows):
+        ysize = min(rows, src.RasterYSize - yoff)
+        block = rasterfile.readBlock(src, 0, yoff, src.RasterXSize, ysize)
+        for ramp, lookup, ds, outfile in outputs:
+            rgba = colorramp.applyLookup(block, lookup)
+            for band in range(4):
+                ds.GetRasterBand(band + 1).WriteArray(rgba[..., band], 0, yoff)
+
+    for ramp, lookup, ds, outfile in outputs:
+        ds.FlushCache()
+        logger.info('Conveted data in '+rasterfilename+' to 8bit, added color palette and saved to tiff ('+outfile+') file')
+
+    return(outputs[0][0]['valueList'])
+
 # Move raw tiff to final tiff directory
 def moveRaw(inputFile, outputDir, finalDir):
     # Create final/tiff directory path if it does not exist
@@ -535,6 +615,175 @@ def create_colorbar(cmap,values,unit,barPathFile):
     img_rt_270 = rotate_img(barPathFile, 270)
     img_rt_270.save(barPathFile)
 
+# Define tmp directory of a netCDF file
+def getTmpDir(inputDir, inputFile):
+    return("/".join(inputDir.split("/")[:-2])+"/"+inputFile.split('.')[0]+"_qgis_tmp/")
+
+# Set QGIS environment, and create the tmp directory
+def setEnvironment(tmpDir):
+    os.environ['QT_QPA_PLATFORM']='offscreen'
+    xdg_runtime_dir = '/home/nru/adcirc2geotiff'
+    os.makedirs(xdg_runtime_dir, exist_ok=True)
+    os.environ['XDG_RUNTIME_DIR']=xdg_runtime_dir
+    os.makedirs(tmpDir, exist_ok=True)
+    os.environ['TMPDIR'] = tmpDir
+    logger.info('Set QGIS enviroment.')
+
+    # Check if tmpDir exists
+    if not os.path.exists(tmpDir):
+        logger.error('The tmpDir: '+tmpDir+' does not exist')
+        sys.exit(1)
+    elif os.path.exists(tmpDir):
+        logger.info('The tmpDir: '+tmpDir+' does exist')
+    else:
+        logger.error('Checked for tmpDir: '+tmpDir+', and else statement happened')
+        sys.exit(1)
+
+# Check if QGIS is needed, which is only by the QGIS regrid and styling engines
+def needsQgis(args):
+    return(args.regrid == 'qgis' or args.validate or args.styler == 'qgis')
+
+# Initialize QGIS
+def startQgis():
+    app = initialize_qgis_application() 
+    app.initQgis()
+    app, processing = initialize_processing(app)
+    logger.info('Initialzed QGIS.')
+    return(app)
+
+# Create the raw tiff, styled tiff and colorbar of a netCDF file, and move them to the final directory. QGIS must have been
+# initialized if needsQgis(args). Meshes loaded by an earlier file on the same grid are reused from meshes, if given
+def convertFile(inputFile, inputDir, outputDir, finalDir, tmpDir, args, meshes=None):
+    # Make output directory
+    makeDirs(outputDir.strip())
+
+    # get parameters to create tiff from ADCIRC mesh file
+    parameters = getParameters(inputDir, inputFile.strip(), outputDir.strip())
+    logger.info('Got mesh regrid paramters for '+inputDir+inputFile.strip())
+
+    # Add raw tiff output parameters
+    parameters.update({'DATA_TYPE': args.dataType, 'COMPRESS': args.compress, 'TILED': args.tiled, 'COG': args.cog, 'SCALE': args.scale,
+                       'MAP_UNITS_PER_PIXEL': args.mapUnitsPerPixel})
+
+    # Regrid only the bounds of the regions, if they are given
+    regionList = regions.getRegions(args)
+    if regionList:
+        parameters['INPUT_EXTENT'] = regions.regionExtent(regionList)
+
+    # Reuse the outputs of an earlier conversion of the same file contents with the same parameters, if they are cached
+    outputs = outputFiles(parameters['OUTPUT_RASTER'], finalDir, args)
+    key = None
+    if args.resultCache:
+        with stagemetrics.stage('cache'):
+            key = resultcache.resultKey(args.resultCache, inputDir+inputFile, 'adcirc2geotiff', resultParameters(parameters, args))
+            if resultcache.fetch(args.resultCache, key, outputs):
+                return(convertedFiles(parameters['OUTPUT_RASTER'], finalDir))
+            resultcache.unlinkOutputs(outputs)
+
+    # Create raw tiff file
+    if args.regrid == 'numpy':
+        filename = exportRasterNumpy(parameters, args.memory, args.cpu, args.meshCache, meshes)
+
+        # Regrid with QGIS as well, and compare the two rasters
+        if args.validate:
+            reference = parameters['OUTPUT_RASTER'].replace('.raw.', '.raw.qgis.')
+            with stagemetrics.stage('validate'):
+                exportRaster(dict(parameters, OUTPUT_RASTER=reference), tmpDir, args.memory)
+                if validateRaster(filename, reference, args.tolerance):
+                    logger.info('NumPy regrid matches QGIS regrid')
+                else:
+                    logger.info('NumPy regrid does not match QGIS regrid')
+                os.remove(reference)
+    else:
+        if args.cpu > 1:
+            logger.info('The QGIS regrid engine uses one CPU, use --regrid numpy to regrid with '+str(args.cpu)+' CPUs')
+        filename = exportRaster(parameters, tmpDir, args.memory)
+
+    # Get color ramp statistics of the node values, which set the color values of products other than maxele. The
+    # statistics are saved in a sidecar file next to the netCDF file or in --statsDir, which later runs on the same file reuse
+    with stagemetrics.stage('stats'):
+        stats = colorramp.loadStats(inputDir+inputFile, colorramp.statsFile(inputDir+inputFile, args.statsDir), args.percentiles)
+
+    # A product without wet nodes has nothing to style, so only its raw tiff is kept
+    if not colorramp.hasValues(stats):
+        logger.info(inputFile+' has no wet node values, skip styling and the colorbar')
+        with stagemetrics.stage('move'):
+            moveRaw(inputFile, outputDir, finalDir)
+        return({'rawTiff': finalDir+Path(filename).parts[-1]})
+
+    # Create raw color file
+    with stagemetrics.stage('style'):
+        if args.styler == 'numpy':
+            valueList = styleRasterNumpy(filename, args.styles, parameters, stats)
+        else:
+            valueList = styleRaster(filename, 'discrete', tmpDir, stats)
+
+    # Define color bar path and color bar variable name
+    barPathFile = colorbarFile(filename)
+    barVar = Path(filename).parts[-1].strip().split('.')[0]
+
+    # Define hexList and units for each type of color bar variable 
+    if barVar == 'maxele':
+        hexList = ['#0000ff', '#00ffff', '#ffff00', '#ff0000']
+        unit = 'meters'
+    elif barVar == 'maxwvel':
+        hexList = ['#000000', '#ff0000', '#ffff00', '#ffffff']
+        unit = 'meters per second'
+    elif barVar == 'swan_HS_max':
+        hexList = ['#000000', '#ff0000', '#ffff00', '#ffffff']
+        unit = 'meters'
+    else:
+        logger.info('Incorrect rlayer name')
+
+    # Get color map
+    with stagemetrics.stage('colorbar'):
+        cmap = get_discrete_cmap(valueList, barVar)
+        #cmap = get_continuous_cmap(hexList)
+
+        # Create color bar
+        create_colorbar(cmap,valueList,unit,barPathFile)
+
+    with stagemetrics.stage('move'):
+        # Move raw tiff file to final tiff directory
+        moveRaw(inputFile, outputDir, finalDir)
+        logger.info('Moved float64 tiff file')
+
+        # Move color bar to final tiff directory 
+        moveBar(barPathFile, outputDir, finalDir)
+        logger.info('Moved colorbar png file')
+
+    # Add the outputs to the result cache
+    if key:
+        with stagemetrics.stage('cache'):
+            resultcache.store(args.resultCache, key, outputs, {'command': 'adcirc2geotiff', 'inputFile': inputDir+inputFile},
+                              args.resultCacheSize)
+
+    return(convertedFiles(filename, finalDir))
+
+# Get the color bar file name of a raw tiff
+def colorbarFile(filename):
+    return(".".join("".join(filename.strip().split('.raw')).split('.')[0:-1])+'.colorbar.png')
+
+# Get the raw tiff, styled tiff and colorbar paths returned by convertFile
+def convertedFiles(filename, finalDir):
+    return({'rawTiff': finalDir+Path(filename).parts[-1], 'styledTiff': styledFile(filename, {'name': ''}),
+            'colorbar': finalDir+Path(colorbarFile(filename)).parts[-1]})
+
+# Get the output files of a conversion, as a dictionary of file names and paths, which are the raw tiff and colorbar in the
+# final directory, and the styled tiff of each style variant next to the raw tiff
+def outputFiles(filename, finalDir, args):
+    outputs = {Path(filename).parts[-1]: finalDir+Path(filename).parts[-1],
+               Path(colorbarFile(filename)).parts[-1]: finalDir+Path(colorbarFile(filename)).parts[-1]}
+    for variant in (parseStyles(args.styles) if args.styler == 'numpy' else [{'name': ''}]):
+        outputs[Path(styledFile(filename, variant)).parts[-1]] = styledFile(filename, variant)
+    return(outputs)
+
+# Get the parameters that change the outputs of a conversion, which key its cached result
+def resultParameters(parameters, args):
+    keys = ('INPUT_EXTENT', 'INPUT_TIMESTEP', 'MAP_UNITS_PER_PIXEL', 'DATA_TYPE', 'COMPRESS', 'TILED', 'COG', 'SCALE')
+    return(dict({key: parameters[key] for key in keys}, regrid=args.regrid, styler=args.styler,
+                styles=args.styles if args.styler == 'numpy' else ['discrete'], percentiles=list(args.percentiles)))
+
 @logger.catch
 def main(args):
     # get input variables from args
@@ -544,7 +793,7 @@ def main(args):
     finalDir = os.path.join(args.finalDir, '')
 
     # Define tmp directory
-    tmpDir = "/".join(inputDir.split("/")[:-2])+"/"+inputFile.split('.')[0]+"_qgis_tmp/"
+    tmpDir = getTmpDir(inputDir, inputFile)
 
     # Remove old logger and start new one
     logger.remove()
@@ -556,79 +805,21 @@ def main(args):
         # When error exit program
         logger.add(lambda _: sys.exit(0), level="ERROR")
 
-        # Make output directory
-        makeDirs(outputDir.strip())
-
-        # Set QGIS environment
-        os.environ['QT_QPA_PLATFORM']='offscreen'
-        xdg_runtime_dir = '/home/nru/adcirc2geotiff'
-        os.makedirs(xdg_runtime_dir, exist_ok=True)
-        os.environ['XDG_RUNTIME_DIR']=xdg_runtime_dir
-        os.makedirs(tmpDir, exist_ok=True)
-        os.environ['TMPDIR'] = tmpDir
-        logger.info('Set QGIS enviroment.')
-
-        # Check if tmpDir exists
-        if not os.path.exists(tmpDir):
-            logger.error('The tmpDir: '+tmpDir+' does not exist')
-            sys.exit(1)
-        elif os.path.exists(tmpDir):
-            logger.info('The tmpDir: '+tmpDir+' does exist')
-        else:
-            logger.error('Checked for tmpDir: '+tmpDir+', and else statement happened')
-            sys.exit(1)
-
-        # Initialize QGIS
-        app = initialize_qgis_application() 
-        app.initQgis()
-        app, processing = initialize_processing(app)
-        logger.info('Initialzed QGIS.')
-
-        # get parameters to create tiff from ADCIRC mesh file
-        parameters = getParameters(inputDir, inputFile.strip(), outputDir.strip())
-        logger.info('Got mesh regrid paramters for '+inputDir+inputFile.strip())
-
-        # Create raw tiff file
-        filename = exportRaster(parameters, tmpDir)
-
-        # Create raw color file
-        valueList = styleRaster(filename, 'discrete', tmpDir)
-
-        # Define color bar path and color bar variable name
-        barPathFile = ".".join("".join(filename.strip().split('.raw')).split('.')[0:-1])+'.colorbar.png'
-        barVar = Path(filename).parts[-1].strip().split('.')[0]
-
-        # Define hexList and units for each type of color bar variable 
-        if barVar == 'maxele':
-            hexList = ['#0000ff', '#00ffff', '#ffff00', '#ff0000']
-            unit = 'meters'
-        elif barVar == 'maxwvel':
-            hexList = ['#000000', '#ff0000', '#ffff00', '#ffffff']
-            unit = 'meters per second'
-        elif barVar == 'swan_HS_max':
-            hexList = ['#000000', '#ff0000', '#ffff00', '#ffffff']
-            unit = 'meters'
-        else:
-            logger.info('Incorrect rlayer name')
+        # Set QGIS environment, and profile stages if requested
+        setEnvironment(tmpDir)
+        stagemetrics.setProfileDir(args.profileDir)
 
-        # Get color map
-        cmap = get_discrete_cmap(valueList, barVar)
-        #cmap = get_continuous_cmap(hexList)
+        # Initialize QGIS, which is only needed by the QGIS regrid and styling engines
+        app = startQgis() if needsQgis(args) else None
 
-        # Create color bar
-        create_colorbar(cmap,valueList,unit,barPathFile)
+        # Create raw tiff, styled tiff and colorbar, and write the stage metrics
+        convertFile(inputFile, inputDir, outputDir, finalDir, tmpDir, args)
+        stagemetrics.writeMetrics(args.metricsFile, args.prometheusFile, {'script': 'adcirc2geotiff', 'product': inputFile.split('.')[0]})
 
         # Quit QGIS
-        app.exitQgis()
-        logger.info('Quit QGIS')
-
-        # Move raw tiff file to final tiff directory
-        moveRaw(inputFile, outputDir, finalDir)
-        logger.info('Moved float64 tiff file')
-
-        # Move color bar to final tiff directory 
-        moveBar(barPathFile, outputDir, finalDir)
-        logger.info('Moved colorbar png file')
+        if app is not None:
+            app.exitQgis()
+            logger.info('Quit QGIS')
     else:
          logger.info(inputDir+inputFile+' does not exist')
          if inputFile.startswith("swan"):
@@ -636,8 +827,30 @@ def main(args):
          else:
              sys.exit(1)
 
-if __name__ == "__main__":
-    """ This is executed when run from the command line """
+# Add the arguments that set how netCDF files are converted, which are shared with batch2geotiff.py
+def addArguments(parser):
+    parser.add_argument("--regrid", help="Regrid engine", action="store", dest="regrid", choices=['qgis', 'numpy'], default='qgis')
+    parser.add_argument("--validate", help="Compare the NumPy regrid with the QGIS regrid", action="store_true", dest="validate")
+    parser.add_argument("--tolerance", help="Maximum difference allowed when validating", action="store", dest="tolerance", type=float, default=1e-4)
+    parser.add_argument("--memory", help="Memory budget in MB for regridding, which is done one window at a time", action="store", dest="memory", type=int, default=None)
+    parser.add_argument("--meshCACHE", "--meshCache", help="Mesh geometry cache directory path", action="store", dest="meshCache", default=os.getenv('MESH_CACHE_DIR'))
+    parser.add_argument("--styler", help="Styling engine", action="store", dest="styler", choices=['qgis', 'numpy'], default='qgis')
+    parser.add_argument("--styles", help="Style variants written by the NumPy styling engine, as colorscaling[:opacity[:name]]", action="store", dest="styles", nargs='+', default=['discrete'])
+    parser.add_argument("--percentiles", help="Percentiles of the node values used as the bottom and top color values", action="store", dest="percentiles", nargs=2, type=float, default=list(colorramp.PERCENTILES))
+    parser.add_argument("--statsDIR", "--statsDir", help="Directory path of the color ramp statistics sidecar files, the input directory by default", action="store", dest="statsDir", default=os.getenv('STATS_DIR'))
+    parser.add_argument("--mapUnitsPerPixel", help="Pixel size of the tiffs in degrees", action="store", dest="mapUnitsPerPixel", type=float, default=0.001)
+    parser.add_argument("--dataType", help="Data type of the raw tiff, Int16 values are scaled by --scale", action="store", dest="dataType", choices=['Float64', 'Float32', 'Int16'], default='Float64')
+    parser.add_argument("--scale", help="Scale of Int16 raw tiff values", action="store", dest="scale", type=float, default=0.001)
+    parser.add_argument("--compress", help="Compression of the raw tiff", action="store", dest="compress", choices=['NONE', 'DEFLATE', 'ZSTD', 'LZW'], default='NONE')
+    parser.add_argument("--tiled", help="Write the raw tiff with internal tiles", action="store_true", dest="tiled")
+    parser.add_argument("--cog", help="Write the raw tiff as a Cloud Optimized GeoTiff with internal overviews", action="store_true", dest="cog")
+    parser.add_argument("--cpu", "--workers", help="Number of CPUs to use for regridding with the NumPy engine", action="store", dest="cpu", type=int, default=1)
+    regions.addArguments(parser)
+    resultcache.addArguments(parser)
+    stagemetrics.addArguments(parser)
+
+# Get the command line argument parser, which is also used to parse the arguments of worker jobs
+def getParser():
     parser = argparse.ArgumentParser()
 
     # Optional argument which requires a parameter (eg. -d test)
@@ -645,7 +858,10 @@ if __name__ == "__main__":
     parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
     parser.add_argument("--outputDIR", "--outputDir", help="Output directory path", action="store", dest="outputDir", required=True)
     parser.add_argument("--finalDIR", "--finalDir", help="Final directory path", action="store", dest="finalDir", required=True)
+    addArguments(parser)
+    return(parser)
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    args = getParser().parse_args()
     main(args)
-
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, json, shutil
+from pathlib import Path
+from loguru import logger
+
+# Import local modules
+import meshregrid, meshcache, colorramp, mbtiles, coverage, pyramid, isobands, regions, stagemetrics
+
+# Get the file name of the isobands mbtiles file of a netCDF file, such as maxele.63.isobands.0.12.mbtiles
+def isobandsFile(inputFile, zlstart, zlstop):
+    return(".".join(inputFile.split('.')[0:2])+'.isobands.'+zlstart+'.'+zlstop+'.mbtiles')
+
+# This function computes filled contour bands of the node values of an ADCIRC mesh file, at the values of the discrete
+# color ramp, and writes them as vector tiles to an mbtiles file. Bands of the top zoom level are computed from the
+# triangles of the mesh, and bands of lower zoom levels by joining the bands of their child tiles. With regions, only tiles
+# overlapping a region are computed, up to the top zoom level of the region
+def mesh2isobands(inputFile, zlstart, zlstop, inputDir, outputDir, finalDir, meshCache=None, percentiles=colorramp.PERCENTILES,
+                  regionList=None, statsDir=None):
+    # Create mbtiles directory path
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir, exist_ok=True)
+        logger.info('Made directory '+Path(outputDir).parts[-1]+ '.')
+    else:
+        logger.info('Directory '+Path(outputDir).parts[-1]+' already made.')
+
+    # Check if output file exist, and remove it if it does exist
+    outputFile = isobandsFile(inputFile, zlstart, zlstop)
+    if os.path.exists(outputDir+outputFile):
+        os.remove(outputDir+outputFile)
+        logger.info('Removed old mbtiles file '+outputDir+outputFile+'.')
+    logger.info('Mbtiles path '+outputDir+outputFile+'.')
+
+    # Read mesh geometry and node values
+    product = inputFile.split('.')[0]
+    with stagemetrics.stage('open'):
+        if meshCache:
+            mesh = meshcache.loadMesh(inputDir+inputFile, meshCache)
+        else:
+            mesh = meshregrid.loadMesh(inputDir+inputFile)
+        values = meshregrid.readValues(inputDir+inputFile, product)
+    wx, wy = isobands.worldCoords(mesh.x, mesh.y)
+
+    # Get the bands of the discrete color ramp, with statistics of the node values from the sidecar file
+    with stagemetrics.stage('stats'):
+        stats = colorramp.loadStats(inputDir+inputFile, colorramp.statsFile(inputDir+inputFile, statsDir), percentiles, values)
+    if not colorramp.hasValues(stats):
+        logger.info(inputFile+' has no wet node values, no bands to compute')
+        return
+    ramp = colorramp.getColorRamp(product, 'discrete', stats)
+    limits = isobands.bandLimits(ramp)
+    properties = isobands.bandProperties(limits, colorramp.buildLookup(ramp))
+    logger.info('Compute '+str(len(limits))+' bands with upper limits '+', '.join('{:g}'.format(limit) for limit in limits))
+
+    def emitTile(z, x, y, tile):
+        with stagemetrics.stage('encode', tiles=1):
+            data = isobands.encodeBands(tile, properties, z, x, y)
+        if data is not None:
+            writer.addTile(z, x, y, data)
+
+    # Compute the bands of the tiles of each zoom level that are covered by wet triangles of the mesh
+    xmin, xmax, ymin, ymax = mesh.extent()
+    with stagemetrics.stage('coverage'):
+        if regionList:
+            cover = regions.regionCoverage(regionList, int(zlstart), int(zlstop),
+                                           lambda bounds, z: coverage.meshCoverage(mesh, values, int(zlstart), z, bounds=bounds))
+        else:
+            cover = coverage.meshCoverage(mesh, values, int(zlstart), int(zlstop))
+    writer = mbtiles.MbtilesWriter(outputDir+outputFile, threaded=True)
+    with stagemetrics.stage('tiling') as counts:
+        pyramid.buildPyramid(cover, lambda z, x, y: isobands.renderBands(mesh, values, wx, wy, limits, z, x, y), isobands.reduceBands, emitTile)
+        metadata = mbtiles.tileMetadata(outputFile.split('.mbtiles')[0], 'pbf', xmin, ymin, xmax, ymax, int(zlstart), int(zlstop),
+                                        'ADCIRC '+product+' isobands computed from '+inputFile)
+        metadata['json'] = json.dumps(isobands.vectorLayers(int(zlstart), int(zlstop)))
+        writer.setMetadata(metadata)
+        writer.close()
+        counts['tiles'] = writer.count
+    logger.info('Created mbtiles file '+outputFile+' from mesh file '+inputFile+'.')
+
+    # Create final directory path
+    if not os.path.exists(finalDir):
+        os.makedirs(finalDir, exist_ok=True)
+        logger.info('Made directory '+Path(finalDir).parts[-1]+ '.')
+    else:
+        logger.info('Directory '+Path(finalDir).parts[-1]+' already made.')
+
+    # Move mbtiles file to final mbtiles directory
+    with stagemetrics.stage('move'):
+        shutil.move(outputDir+outputFile, finalDir+outputFile)
+    logger.info('Moved mbtiles file to '+Path(finalDir).parts[-1]+' directory.')
+
+@logger.catch
+def main(args):
+    # get input variables from args
+    inputFile = args.inputFile
+    zlstart = args.zlstart
+    zlstop = args.zlstop
+    inputDir = os.path.join(args.inputDir, '')
+    outputDir = os.path.join(args.outputDir, '')
+    finalDir = os.path.join(args.finalDir, '')
+
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'adcirc2isobands.log', level='DEBUG')
+
+    # Check if input file exist, and then run mesh2isobands function
+    if os.path.exists(inputDir+inputFile):
+        # When error exit program
+        logger.add(lambda _: sys.exit(0), level="ERROR")
+
+        logger.info('Create isobands mbtiles file, with zoom levels '+zlstart+' to '+zlstop+', from mesh file '+inputFile+'.')
+
+        stagemetrics.setProfileDir(args.profileDir)
+        mesh2isobands(inputFile, zlstart, zlstop, inputDir, outputDir, finalDir, args.meshCache, args.percentiles, regions.getRegions(args),
+                      args.statsDir)
+        stagemetrics.writeMetrics(args.metricsFile, args.prometheusFile, {'script': 'adcirc2isobands', 'product': inputFile.split('.')[0]})
+
+    else:
+        logger.info(inputDir+inputFile+' does not exist')
+        if inputFile.startswith("swan"):
+            sys.exit(0)
+        else:
+            sys.exit(1)
+
+# Get the command line argument parser
+def getParser():
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--inputFILE", "--inputFile", help="Input file name", action="store", dest="inputFile", required=True)
+    parser.add_argument("--zlstart", help="Start zoom level", action="store", dest="zlstart", required=True)
+    parser.add_argument("--zlstop", help="Stop zoom level", action="store", dest="zlstop", required=True)
+    parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
+    parser.add_argument("--outputDIR", "--outputDir", help="Output directory path", action="store", dest="outputDir", required=True)
+    parser.add_argument("--finalDIR", "--finalDir", help="Final directory path", action="store", dest="finalDir", required=True)
+    parser.add_argument("--percentiles", help="Percentiles of the node values used as the top band value", action="store", dest="percentiles", nargs=2, type=float, default=list(colorramp.PERCENTILES))
+    parser.add_argument("--statsDIR", "--statsDir", help="Directory path of the color ramp statistics sidecar files, the input directory by default", action="store", dest="statsDir", default=os.getenv('STATS_DIR'))
+    parser.add_argument("--meshCACHE", "--meshCache", help="Mesh geometry cache directory path", action="store", dest="meshCache", default=os.getenv('MESH_CACHE_DIR'))
+    regions.addArguments(parser)
+    stagemetrics.addArguments(parser)
+    return(parser)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    args = getParser().parse_args()
+    main(args)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, json, shutil
+import numpy as np
+from pathlib import Path
+from loguru import logger
+
+# Import local modules
+import meshregrid, meshcache, meshdiff, colorramp, mbtiles, tiles, coverage, pyramid, tileencode, regions, resultcache, stagemetrics
+
+# Regrid the mesh onto the pixels of a tile, returning None if the tile has no values
+def renderTile(mesh, values, z, x, y):
+    with stagemetrics.stage('render', tiles=1):
+        return(renderTileValues(mesh, values, z, x, y))
+
+# Regrid the mesh onto the pixels of a tile, without recording the stage
+def renderTileValues(mesh, values, z, x, y):
+    west, south, east, north = tiles.tileBounds(z, x, y)
+    index = mesh.trianglesIn(west, south, east, north)
+    if len(index) == 0:
+        return(None)
+
+    lons, lats = tiles.tilePixelCenters(z, x, y)
+    block = meshregrid.regridGrid(mesh.x, mesh.y, mesh.tri[index], values, lons, lats, np.float32)
+    if not np.isfinite(block).any():
+        return(None)
+
+    return(block)
+
+# Get the file name of the mbtiles file of a netCDF file, which is the same as the one geotiff2mbtiles.py uses, such as
+# maxele.63.0.9.mbtiles, or has the value encoding in it for value encoded tiles, such as maxele.63.terrainrgb.0.9.mbtiles
+def mbtilesFile(inputFile, zlstart, zlstop, encoding='color'):
+    name = ".".join(inputFile.split('.')[0:2])
+    if encoding != 'color':
+        name += '.'+encoding
+    return(name+'.'+zlstart+'.'+zlstop+'.mbtiles')
+
+# Get the scale and offset of a value encoding, which are the defaults of the encoding unless they are given
+def valueScale(encoding, scale=None, offset=None):
+    defaultScale, defaultOffset = tileencode.VALUE_SCALES[encoding]
+    return(defaultScale if scale is None else scale, defaultOffset if offset is None else offset)
+
+# This function renders tiles of an ADCIRC mesh file directly into an mbtiles file, based on inputs. With a value encoding
+# other than color, tiles hold the values of their pixels, which clients decode and style with the scale, offset and value
+# ranges in the mbtiles metadata. With regions, only tiles overlapping a region are rendered, up to the top zoom level of
+# the region
+def mesh2mbtiles(inputFile, zlstart, zlstop, inputDir, outputDir, finalDir, colorscaling, meshCache=None, reduction='none',
+                 tileFormat='png', optimize=False, percentiles=colorramp.PERCENTILES, meshes=None, resultCache=None,
+                 resultCacheSize=resultcache.DEFAULT_SIZE, incremental=False, encoding='color', scale=None, offset=None,
+                 regionList=None, statsDir=None):
+    # Create mbtiles directory path
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir, exist_ok=True)
+        logger.info('Made directory '+Path(outputDir).parts[-1]+ '.')
+    else:
+        logger.info('Directory '+Path(outputDir).parts[-1]+' already made.')
+
+    # Define output file name
+    outputFile = mbtilesFile(inputFile, zlstart, zlstop, encoding)
+    if encoding == 'uint16' and tileFormat != 'png':
+        raise Exception('16 bit value tiles can only be written as png, not '+tileFormat)
+
+    # The node values of an incrementally updated mbtiles file are kept next to it, and cached with it. Other runs write the
+    # mbtiles file without them, so the node values of a previous run are removed
+    outputs = {outputFile: finalDir+outputFile}
+    if incremental:
+        outputs[meshdiff.nodesFile(outputFile)] = meshdiff.nodesFile(finalDir+outputFile)
+    else:
+        meshdiff.removeNodes(finalDir+outputFile)
+
+    # Reuse the mbtiles file of an earlier run on the same file contents with the same parameters, if it is cached
+    parameters = {'zlstart': zlstart, 'zlstop': zlstop, 'colorscaling': colorscaling, 'pyramid': reduction, 'format': tileFormat,
+                  'optimize': optimize, 'percentiles': list(percentiles)}
+    if encoding != 'color':
+        scale, offset = valueScale(encoding, scale, offset)
+        parameters.update({'encoding': encoding, 'scale': scale, 'offset': offset})
+    if regionList:
+        parameters['regions'] = regions.describeRegions(regionList)
+    key = None
+    if resultCache:
+        with stagemetrics.stage('cache'):
+            key = resultcache.resultKey(resultCache, inputDir+inputFile, 'adcirc2mbtiles', dict(parameters, incremental=incremental))
+            if resultcache.fetch(resultCache, key, outputs):
+                return
+
+    # Check if output file exist, and remove it if it does exist
+    if os.path.exists(outputDir+outputFile):
+        os.remove(outputDir+outputFile)
+        logger.info('Removed old mbtiles file '+outputDir+outputFile+'.')
+    logger.info('Mbtiles path '+outputDir+outputFile+'.')
+
+    # Read mesh geometry and node values
+    product = inputFile.split('.')[0]
+    with stagemetrics.stage('open'):
+        if meshes is not None:
+            mesh = meshes.get(inputDir+inputFile, meshCache)
+        elif meshCache:
+            mesh = meshcache.loadMesh(inputDir+inputFile, meshCache)
+        else:
+            mesh = meshregrid.loadMesh(inputDir+inputFile)
+        values = meshregrid.readValues(inputDir+inputFile, product)
+
+    # Get color ramp, with color values from statistics of the node values, which are saved in a sidecar file next to the
+    # netCDF file or in statsDir
+    with stagemetrics.stage('stats'):
+        stats = colorramp.loadStats(inputDir+inputFile, colorramp.statsFile(inputDir+inputFile, statsDir), percentiles, values)
+    if not colorramp.hasValues(stats):
+        logger.info(inputFile+' has no wet node values, no tiles to render')
+        return
+    ramp = colorramp.getColorRamp(product, colorscaling, stats)
+    lookup = colorramp.buildLookup(ramp) if encoding == 'color' else None
+
+    # Classify tile values to palette indices of the lookup table, or quantize them to the codes of the value encoding, and
+    # encode them
+    encoder = tileencode.TileEncoder(tileFormat, optimize)
+    def addTile(z, x, y, block):
+        with stagemetrics.stage('encode', tiles=1):
+            if lookup is not None:
+                data = encoder.encodeIndexed(colorramp.classify(block, lookup), lookup['palette'])
+            else:
+                data = encoder.encodeValues(block, encoding, scale, offset)
+        writer.addTile(z, x, y, data)
+
+    # Find the node values of the previous mbtiles file, if it can be updated. Lower zoom levels of a pyramid are reduced from
+    # every child tile, so only mbtiles files that render each zoom level are updated
+    previous = None
+    if incremental:
+        with stagemetrics.stage('diff'):
+            fingerprint = meshcache.gridFingerprint(mesh.x, mesh.y, mesh.tri)
+            if reduction == 'none':
+                previous = meshdiff.previousValues(finalDir+outputFile, fingerprint, values, lookup, parameters)
+            else:
+                logger.info('Can not update mbtiles files built with --pyramid '+reduction+', rendering every tile')
+
+    # Render, colorize and encode the tiles of each zoom level that are covered by wet triangles of the mesh. When updating
+    # the previous mbtiles file, only tiles over triangles with changed node values are rendered again, in a copy of the file
+    xmin, xmax, ymin, ymax = mesh.extent()
+    with stagemetrics.stage('coverage'):
+        if previous is not None:
+            changed = meshdiff.changedNodes(previous, values)
+            coverFunction = lambda bounds, z: coverage.changedCoverage(mesh, changed, int(zlstart), z, bounds=bounds)
+            shutil.copyfile(finalDir+outputFile, outputDir+outputFile)
+        else:
+            coverFunction = lambda bounds, z: coverage.meshCoverage(mesh, values, int(zlstart), z, bounds=bounds)
+        if regionList:
+            cover = regions.regionCoverage(regionList, int(zlstart), int(zlstop), coverFunction)
+        else:
+            cover = coverFunction(None, int(zlstop))
+    writer = mbtiles.MbtilesWriter(outputDir+outputFile, threaded=True)
+    with stagemetrics.stage('tiling') as counts:
+        if previous is not None:
+            for z, x, y in cover.iterTiles():
+                block = renderTile(mesh, values, z, x, y)
+                if block is not None:
+                    addTile(z, x, y, block)
+                else:
+                    writer.removeTile(z, x, y)
+            writer.pruneImages()
+        elif reduction == 'none':
+            for z, x, y in cover.iterTiles():
+                block = renderTile(mesh, values, z, x, y)
+                if block is not None:
+                    addTile(z, x, y, block)
+        else:
+            # Render only the top zoom level, and build lower zoom levels by reducing their child tiles
+            pyramid.buildPyramid(cover, lambda z, x, y: renderTile(mesh, values, z, x, y),
+                                 lambda childTiles: pyramid.reduceValueTiles(childTiles, reduction), addTile)
+
+        metadata = mbtiles.tileMetadata(outputFile.split('.mbtiles')[0], encoder.mbtilesFormat(), xmin, ymin, xmax, ymax,
+                                        int(zlstart), int(zlstop), 'ADCIRC '+product+' rendered from '+inputFile)
+
+        # Value encoded tiles are decoded with the encoding, scale and offset, and styled with the value ranges
+        if encoding != 'color':
+            valueEncoding = tileencode.valueMetadata(encoding, scale, offset)
+            metadata.update({'encoding': encoding, 'scale': scale, 'offset': offset, 'unit': colorramp.UNITS.get(product)})
+            metadata['json'] = json.dumps({'value_encoding': valueEncoding, 'value_ranges': colorramp.valueRanges(product, stats)})
+        writer.setMetadata(metadata)
+        writer.close()
+        counts['tiles'] = writer.count
+    encoder.logStats()
+
+    if previous is not None:
+        logger.info('Updated mbtiles file '+outputFile+' from mesh file '+inputFile+'.')
+    else:
+        logger.info('Created mbtiles file '+outputFile+' from mesh file '+inputFile+'.')
+
+    # Create final directory path
+    if not os.path.exists(finalDir):
+        os.makedirs(finalDir, exist_ok=True)
+        logger.info('Made directory '+Path(finalDir).parts[-1]+ '.')
+    else:
+        logger.info('Directory '+Path(finalDir).parts[-1]+' already made.')
+
+    # Move mbtiles file to final mbtiles directory
+    with stagemetrics.stage('move'):
+        shutil.move(outputDir+outputFile, finalDir+outputFile)
+    logger.info('Moved mbtiles file to '+Path(finalDir).parts[-1]+' directory.')
+
+    # Keep the node values next to the mbtiles file, so that the next run can update it
+    if incremental:
+        meshdiff.writeNodes(finalDir+outputFile, fingerprint, values, lookup, parameters)
+
+    # Add the mbtiles file to the result cache
+    if key:
+        with stagemetrics.stage('cache'):
+            resultcache.store(resultCache, key, outputs, {'command': 'adcirc2mbtiles', 'inputFile': inputDir+inputFile}, resultCacheSize)
+
+@logger.catch
+def main(args):
+    # get input variables from args
+    inputFile = args.inputFile
+    zlstart = args.zlstart
+    zlstop = args.zlstop
+    inputDir = os.path.join(args.inputDir, '')
+    outputDir = os.path.join(args.outputDir, '')
+    finalDir = os.path.join(args.finalDir, '')
+
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'adcirc2mbtiles.log', level='DEBUG')
+
+    # Check if input file exist, and then run mesh2mbtiles function
+    if os.path.exists(inputDir+inputFile):
+        # When error exit program
+        logger.add(lambda _: sys.exit(0), level="ERROR")
+
+        logger.info('Create mbtiles file, with zoom levels '+zlstart+' to '+zlstop+', from mesh file '+inputFile+'.')
+
+        stagemetrics.setProfileDir(args.profileDir)
+        mesh2mbtiles(inputFile, zlstart, zlstop, inputDir, outputDir, finalDir, args.colorscaling, args.meshCache, args.pyramid,
+                     args.tileFormat, args.optimize, args.percentiles, None, args.resultCache, args.resultCacheSize, args.incremental,
+                     args.encoding, args.valueScale, args.valueOffset, regions.getRegions(args), args.statsDir)
+        stagemetrics.writeMetrics(args.metricsFile, args.prometheusFile, {'script': 'adcirc2mbtiles', 'product': inputFile.split('.')[0]})
+
+    else:
+        logger.info(inputDir+inputFile+' does not exist')
+        if inputFile.startswith("swan"):
+            sys.exit(0)
+        else:
+            sys.exit(1)
+
+# Get the command line argument parser, which is also used to parse the arguments of worker jobs
+def getParser():
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--inputFILE", "--inputFile", help="Input file name", action="store", dest="inputFile", required=True)
+    parser.add_argument("--zlstart", help="Start zoom level", action="store", dest="zlstart", required=True)
+    parser.add_argument("--zlstop", help="Stop zoom level", action="store", dest="zlstop", required=True)
+    parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
+    parser.add_argument("--outputDIR", "--outputDir", help="Output directory path", action="store", dest="outputDir", required=True)
+    parser.add_argument("--finalDIR", "--finalDir", help="Final directory path", action="store", dest="finalDir", required=True)
+    parser.add_argument("--colorscaling", help="Color scaling", action="store", dest="colorscaling", choices=['discrete', 'interpolated'], default='discrete')
+    parser.add_argument("--pyramid", help="Render every zoom level (none), or build lower zoom levels from the top zoom level with a reduction", action="store", dest="pyramid", choices=('none',) + pyramid.VALUE_REDUCTIONS, default='none')
+    parser.add_argument("--percentiles", help="Percentiles of the node values used as the bottom and top color values", action="store", dest="percentiles", nargs=2, type=float, default=list(colorramp.PERCENTILES))
+    parser.add_argument("--statsDIR", "--statsDir", help="Directory path of the color ramp statistics sidecar files, the input directory by default", action="store", dest="statsDir", default=os.getenv('STATS_DIR'))
+    parser.add_argument("--format", help="Tile format", action="store", dest="tileFormat", choices=tileencode.TILE_FORMATS, default='png')
+    parser.add_argument("--encoding", help="Encode the colors of pixels (color), or their values as Terrain-RGB (terrainrgb) or 16 bit grayscale PNG (uint16) data tiles", action="store", dest="encoding", choices=('color',) + tileencode.VALUE_ENCODINGS, default='color')
+    parser.add_argument("--valueScale", help="Value of one code of value encoded tiles, 0.001 for terrainrgb and 0.002 for uint16 by default", action="store", dest="valueScale", type=float, default=None)
+    parser.add_argument("--valueOffset", help="Value of code 0 of value encoded tiles, -10000 for terrainrgb and -20 for uint16 by default", action="store", dest="valueOffset", type=float, default=None)
+    parser.add_argument("--optimize", help="Spend more time compressing tiles, for smaller tiles", action="store_true", dest="optimize")
+    parser.add_argument("--incremental", help="Update the previous mbtiles file in the final directory, rendering only tiles whose node values changed", action="store_true", dest="incremental")
+    parser.add_argument("--meshCACHE", "--meshCache", help="Mesh geometry cache directory path", action="store", dest="meshCache", default=os.getenv('MESH_CACHE_DIR'))
+    regions.addArguments(parser)
+    resultcache.addArguments(parser)
+    stagemetrics.addArguments(parser)
+    return(parser)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    args = getParser().parse_args()
+    main(args)
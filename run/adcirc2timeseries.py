@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, shutil
+import numpy as np
+from loguru import logger
+
+# Import local modules
+import meshregrid, meshcache, rasterfile, colorramp, mbtiles, tiles, coverage, tileencode, stagemetrics
+
+# Products whose color ramps are used for the tiles of each time series file, by file number
+STYLE_PRODUCTS = {'63': 'maxele', '64': 'maxwvel', '73': 'maxwvel', '74': 'maxwvel'}
+
+# Get the timesteps to render, from the first to the last timestep, both included
+def getTimesteps(count, first=0, last=None, step=1):
+    last = count - 1 if last is None else min(last, count - 1)
+    return(range(first, last + 1, step))
+
+# Get the file name of a timestep, such as fort.raw.63.0005.tif or fort.63.0005.0.9.mbtiles
+def timestepFile(inputFile, timestep, suffix, raw=False):
+    name, number = inputFile.split('.')[0:2]
+    return(name+('.raw.' if raw else '.')+number+'.'+'{:04d}'.format(timestep)+'.'+suffix)
+
+# Move the file of a timestep to the final directory
+def moveFile(filename, outputDir, finalDir):
+    os.makedirs(finalDir, exist_ok=True)
+    with stagemetrics.stage('move'):
+        shutil.move(outputDir+filename, finalDir+filename)
+
+# Regrid a chunk of timesteps into one raw tiff per timestep. The interpolation weights of each window of the raster are
+# computed by the first chunk, and reused by later chunks if they fit in the memory budget
+def writeTiffChunk(inputFile, mesh, steps, chunk, xs, ys, windows, geotransform, weights, parameters, outputDir, finalDir):
+    filenames = [timestepFile(inputFile, timestep, 'tif', True) for timestep in steps]
+    datasets = [rasterfile.createRaster(outputDir+filename, len(xs), len(ys), geotransform, parameters) for filename in filenames]
+    for window in windows:
+        xoff, yoff, xsize, ysize = window
+        with stagemetrics.stage('weights'):
+            windowWeights = weights.get(window, lambda: meshregrid.windowWeights(mesh, xs, ys, window))
+        for ds, values in zip(datasets, chunk):
+            with stagemetrics.stage('regrid', pixels=xsize * ysize):
+                block = windowWeights.apply(values)
+            with stagemetrics.stage('write'):
+                rasterfile.writeBlock(ds, block, xoff, yoff)
+
+    for ds, filename in zip(datasets, filenames):
+        with stagemetrics.stage('convert'):
+            rasterfile.closeRaster(ds, outputDir+filename, parameters)
+        moveFile(filename, outputDir, finalDir)
+    logger.info('Wrote raw tiffs of timesteps '+str(steps[0])+' to '+str(steps[-1]))
+
+# Render a chunk of timesteps into one mbtiles file per timestep. The interpolation weights of each tile are computed by
+# the first chunk, and reused by later chunks if they fit in the memory budget
+def writeMbtilesChunk(inputFile, mesh, steps, chunk, cover, lookup, encoder, weights, zlstart, zlstop, outputDir, finalDir):
+    filenames = [timestepFile(inputFile, timestep, zlstart+'.'+zlstop+'.mbtiles') for timestep in steps]
+    for filename in filenames:
+        if os.path.exists(outputDir+filename):
+            os.remove(outputDir+filename)
+    writers = [mbtiles.MbtilesWriter(outputDir+filename, threaded=True) for filename in filenames]
+
+    with stagemetrics.stage('tiling') as counts:
+        for z, x, y in cover.iterTiles():
+            with stagemetrics.stage('weights'):
+                tileWeights = weights.get((z, x, y), lambda: tileGridWeights(mesh, z, x, y))
+            for writer, values in zip(writers, chunk):
+                with stagemetrics.stage('render', tiles=1):
+                    block = tileWeights.apply(values, np.float32)
+                if not np.isfinite(block).any():
+                    continue
+                with stagemetrics.stage('encode', tiles=1):
+                    data = encoder.encodeIndexed(colorramp.classify(block, lookup), lookup['palette'])
+                writer.addTile(z, x, y, data)
+
+        xmin, xmax, ymin, ymax = mesh.extent()
+        for writer, filename, timestep in zip(writers, filenames, steps):
+            writer.setMetadata(mbtiles.tileMetadata(filename.split('.mbtiles')[0], encoder.mbtilesFormat(), xmin, ymin, xmax, ymax,
+                                                    int(zlstart), int(zlstop), 'ADCIRC timestep '+str(timestep)+' rendered from '+inputFile))
+            writer.close()
+            counts['tiles'] = counts.get('tiles', 0) + writer.count
+
+    for filename in filenames:
+        moveFile(filename, outputDir, finalDir)
+    logger.info('Wrote mbtiles files of timesteps '+str(steps[0])+' to '+str(steps[-1]))
+
+# Compute the interpolation weights of the pixels of a tile
+def tileGridWeights(mesh, z, x, y):
+    west, south, east, north = tiles.tileBounds(z, x, y)
+    lons, lats = tiles.tilePixelCenters(z, x, y)
+    return(meshregrid.gridWeights(mesh.x, mesh.y, mesh.tri[mesh.trianglesIn(west, south, east, north)], lons, lats))
+
+# Get the maximum of each node over the timesteps, which sets the color values and tile coverage of all timesteps, so
+# that colors do not change from one timestep to the next
+def maxValues(inputFile, names, timesteps, chunk):
+    result = None
+    for steps, values in meshregrid.readValueChunks(inputFile, names, timesteps, chunk):
+        chunkMax = np.fmax.reduce(values, axis=0)
+        result = chunkMax if result is None else np.fmax(result, chunkMax)
+    return(result)
+
+# This function renders a range of timesteps of an ADCIRC time series file, such as fort.63 or fort.64, into one raw tiff
+# or one mbtiles file per timestep. Timesteps are read a chunk at a time
+def timeseries(inputFile, inputDir, outputDir, finalDir, args):
+    os.makedirs(outputDir, exist_ok=True)
+    number = inputFile.split('.')[1]
+    names = args.variables or meshregrid.TIMESERIES_VARIABLES.get(number)
+    if not names:
+        logger.info('No time series variables of '+inputFile+', use --variables')
+        sys.exit(1)
+
+    with stagemetrics.stage('open'):
+        mesh = meshcache.loadMesh(inputDir+inputFile, args.meshCache) if args.meshCache else meshregrid.loadMesh(inputDir+inputFile)
+        count = meshregrid.readTimesteps(inputDir+inputFile, names[0])
+        timesteps = getTimesteps(count, args.first, args.last, args.step)
+    if len(timesteps) == 0:
+        logger.info('No timesteps of the '+str(count)+' timesteps of '+inputFile+' from --first '+str(args.first)+' to --last '+str(args.last))
+        sys.exit(1)
+    logger.info('Render '+str(len(timesteps))+' timesteps of '+', '.join(names)+' from '+inputFile)
+    weights = meshregrid.WeightCache(args.memory)
+
+    if args.output == 'tiff':
+        parameters = dict(rasterfile.defaultParameters(), DATA_TYPE=args.dataType, COMPRESS=args.compress, TILED=args.tiled, COG=args.cog,
+                          SCALE=args.scale)
+        xmin, xmax, ymin, ymax = mesh.extent()
+        width = int((xmax - xmin)/args.mapUnitsPerPixel)
+        height = int((ymax - ymin)/args.mapUnitsPerPixel)
+        geotransform = (xmin, (xmax - xmin)/width, 0, ymax, 0, -(ymax - ymin)/height)
+        xs, ys = meshregrid.pixelCenters(xmin, ymin, xmax, ymax, width, height)
+        align = rasterfile.BLOCK_SIZE if args.tiled or args.cog else 1
+        windows = meshregrid.getWindows(width, height, args.memory, 8, 1, align)
+    else:
+        # Color values and tile coverage are set by the maximum of each node over the timesteps
+        product = STYLE_PRODUCTS.get(number, 'maxele')
+        with stagemetrics.stage('stats'):
+            peak = maxValues(inputDir+inputFile, names, timesteps, args.chunk)
+            stats = colorramp.valueStats(peak[np.isfinite(peak)], args.percentiles)
+        if not colorramp.hasValues(stats):
+            logger.info(inputFile+' has no wet node values in timesteps '+str(timesteps[0])+' to '+str(timesteps[-1])+', no tiles to render')
+            return
+        lookup = colorramp.buildLookup(colorramp.getColorRamp(product, args.colorscaling, stats))
+        with stagemetrics.stage('coverage'):
+            cover = coverage.meshCoverage(mesh, peak, int(args.zlstart), int(args.zlstop))
+        encoder = tileencode.TileEncoder(args.tileFormat, args.optimize)
+
+    for steps, chunk in meshregrid.readValueChunks(inputDir+inputFile, names, timesteps, args.chunk):
+        if args.output == 'tiff':
+            writeTiffChunk(inputFile, mesh, steps, chunk, xs, ys, windows, geotransform, weights, parameters, outputDir, finalDir)
+        else:
+            writeMbtilesChunk(inputFile, mesh, steps, chunk, cover, lookup, encoder, weights, args.zlstart, args.zlstop, outputDir, finalDir)
+
+    if args.output == 'mbtiles':
+        encoder.logStats()
+    logger.info('Computed interpolation weights '+str(weights.computed)+' times, and kept '+str(len(weights.weights))+' of '
+                +'{:.1f}'.format(weights.nbytes / 2**20)+' MB')
+
+@logger.catch
+def main(args):
+    # get input variables from args
+    inputFile = args.inputFile
+    inputDir = os.path.join(args.inputDir, '')
+    outputDir = os.path.join(args.outputDir, '')
+    finalDir = os.path.join(args.finalDir, '')
+
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'adcirc2timeseries.log', level='DEBUG')
+
+    if not os.path.exists(inputDir+inputFile):
+        logger.info(inputDir+inputFile+' does not exist')
+        sys.exit(1)
+    if args.output == 'mbtiles' and (args.zlstart is None or args.zlstop is None):
+        logger.info('Rendering mbtiles files needs --zlstart and --zlstop')
+        sys.exit(1)
+
+    stagemetrics.setProfileDir(args.profileDir)
+    timeseries(inputFile, inputDir, outputDir, finalDir, args)
+    stagemetrics.writeMetrics(args.metricsFile, args.prometheusFile, {'script': 'adcirc2timeseries', 'product': ".".join(inputFile.split('.')[0:2])})
+
+# Get the command line argument parser
+def getParser():
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--inputFILE", "--inputFile", help="Input time series file name, such as fort.63.nc", action="store", dest="inputFile", required=True)
+    parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
+    parser.add_argument("--outputDIR", "--outputDir", help="Output directory path", action="store", dest="outputDir", required=True)
+    parser.add_argument("--finalDIR", "--finalDir", help="Final directory path", action="store", dest="finalDir", required=True)
+    parser.add_argument("--output", help="Write one raw tiff or one mbtiles file per timestep", action="store", dest="output", choices=['tiff', 'mbtiles'], default='tiff')
+    parser.add_argument("--variables", help="Node variables, whose magnitude is rendered when two are given, by default from the file number", action="store", dest="variables", nargs='+')
+    parser.add_argument("--first", help="First timestep", action="store", dest="first", type=int, default=0)
+    parser.add_argument("--last", help="Last timestep, by default the last timestep of the file", action="store", dest="last", type=int)
+    parser.add_argument("--step", help="Render every step-th timestep", action="store", dest="step", type=int, default=1)
+    parser.add_argument("--chunk", help="Number of timesteps read and rendered at once", action="store", dest="chunk", type=int, default=24)
+    parser.add_argument("--memory", help="Memory budget in MB for regrid windows and kept interpolation weights", action="store", dest="memory", type=int, default=None)
+    parser.add_argument("--meshCACHE", "--meshCache", help="Mesh geometry cache directory path", action="store", dest="meshCache", default=os.getenv('MESH_CACHE_DIR'))
+    parser.add_argument("--mapUnitsPerPixel", help="Pixel size of the tiffs in degrees", action="store", dest="mapUnitsPerPixel", type=float, default=0.001)
+    parser.add_argument("--dataType", help="Data type of the raw tiffs, Int16 values are scaled by --scale", action="store", dest="dataType", choices=['Float64', 'Float32', 'Int16'], default='Float64')
+    parser.add_argument("--scale", help="Scale of Int16 raw tiff values", action="store", dest="scale", type=float, default=0.001)
+    parser.add_argument("--compress", help="Compression of the raw tiffs", action="store", dest="compress", choices=['NONE', 'DEFLATE', 'ZSTD', 'LZW'], default='NONE')
+    parser.add_argument("--tiled", help="Write the raw tiffs with internal tiles", action="store_true", dest="tiled")
+    parser.add_argument("--cog", help="Write the raw tiffs as Cloud Optimized GeoTiffs with internal overviews", action="store_true", dest="cog")
+    parser.add_argument("--zlstart", help="Start zoom level of mbtiles files", action="store", dest="zlstart")
+    parser.add_argument("--zlstop", help="Stop zoom level of mbtiles files", action="store", dest="zlstop")
+    parser.add_argument("--colorscaling", help="Color scaling", action="store", dest="colorscaling", choices=['discrete', 'interpolated'], default='discrete')
+    parser.add_argument("--percentiles", help="Percentiles of the maximum node values used as the bottom and top color values", action="store", dest="percentiles", nargs=2, type=float, default=list(colorramp.PERCENTILES))
+    parser.add_argument("--format", help="Tile format", action="store", dest="tileFormat", choices=tileencode.TILE_FORMATS, default='png')
+    parser.add_argument("--optimize", help="Spend more time compressing tiles, for smaller tiles", action="store_true", dest="optimize")
+    stagemetrics.addArguments(parser)
+    return(parser)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    args = getParser().parse_args()
+    main(args)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, time, traceback, queue
+import multiprocessing
+from pathlib import Path
+from loguru import logger
+
+# Import local modules
+import adcirc2geotiff, batch2geotiff, geotiff2mbtiles, pyramid, tileencode, regions, stagemetrics
+
+# Tile styled tiffs into mbtiles files as they are queued, until None is queued. This runs in a tiling process, so that
+# tiling one product overlaps converting the next product in the main process
+def tileWorker(jobs, results, mbtilesDir, finalDir, args):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+
+        tiffFile, tiffDir = job
+        result = {'inputFile': tiffFile, 'status': 'done', 'seconds': 0.0}
+        start = time.time()
+        logger.info('Tile '+tiffFile)
+        stagemetrics.reset()
+        try:
+            geotiff2mbtiles.geotiff2mbtiles(tiffFile, args.zlstart, args.zlstop, str(args.tileCpu), tiffDir, mbtilesDir, finalDir, args.tiler,
+                                            args.pyramid, args.tileFormat, args.optimize, args.resultCache, args.resultCacheSize,
+                                            regions.getRegions(args))
+            result['mbtiles'] = finalDir+".".join(tiffFile.split('.')[0:2])+'.'+args.zlstart+'.'+args.zlstop+'.mbtiles'
+        except (Exception, SystemExit) as e:
+            logger.info('Failed to tile '+tiffFile+': '+traceback.format_exc())
+            result['status'] = 'failed'
+            result['error'] = repr(e)
+        result['seconds'] = time.time() - start
+        result['stages'] = stagemetrics.report()
+        logger.info('Tiled '+tiffFile+' with status '+result['status']+' in '+'{:.1f}'.format(result['seconds'])+' seconds')
+        results.put(result)
+
+# Seconds to wait on the queues of the tiling process before checking that it is still running
+POLL_SECONDS = 5
+
+# Queue a job for the tiling process, waiting for room in the queue while the process runs. Returns False if the tiling
+# process has exited, such as when it was killed, so that the job can not be tiled
+def putJob(jobs, job, tiler):
+    while True:
+        try:
+            jobs.put(job, timeout=POLL_SECONDS)
+            return(True)
+        except queue.Full:
+            if not tiler.is_alive():
+                return(False)
+
+# Get the result of a queued job from the tiling process, or None if the tiling process exited without it
+def getResult(results, tiler):
+    while True:
+        try:
+            return(results.get(timeout=POLL_SECONDS))
+        except queue.Empty:
+            if not tiler.is_alive():
+                # The process can put its last result just before it exits
+                try:
+                    return(results.get(timeout=POLL_SECONDS))
+                except queue.Empty:
+                    return(None)
+
+# Convert the netCDF files of an advisory to tiffs, and tile the styled tiffs to mbtiles files. Tiling of a product runs in
+# a tiling process while the next product is converted, with at most queueSize styled tiffs waiting between them, so the
+# advisory takes about as long as the slower of converting and tiling, instead of their sum
+def advisory2mbtiles(inputFiles, inputDir, tiffDir, tiffFinalDir, mbtilesDir, mbtilesFinalDir, args):
+    # The tiling process is started before QGIS is initialized, so that it does not inherit QGIS
+    jobs = multiprocessing.Queue(args.queueSize)
+    results = multiprocessing.Queue()
+    tiler = multiprocessing.Process(target=tileWorker, args=(jobs, results, mbtilesDir, mbtilesFinalDir, args))
+    tiler.start()
+
+    converted = []
+    queued = []
+    running = True
+    try:
+        batch2geotiff.initBatch(args, adcirc2geotiff.getTmpDir(inputDir, inputFiles[0]))
+        for inputFile in inputFiles:
+            result = batch2geotiff.runFile(inputFile, inputDir, tiffDir, tiffFinalDir, args)
+            converted.append(result)
+            # Products without wet nodes have no styled tiff to tile
+            if result['status'] == 'done' and 'styledTiff' in result['outputs']:
+                # Wait for room in the queue when tiling is slower than converting
+                start = time.time()
+                styledTiff = result['outputs']['styledTiff']
+                tiffFile = Path(styledTiff).parts[-1]
+                queued.append(tiffFile)
+                running = running and putJob(jobs, (tiffFile, os.path.join(os.path.dirname(styledTiff), '')), tiler)
+                result['queueWaitSeconds'] = time.time() - start
+        batch2geotiff.exitBatch()
+    finally:
+        if running:
+            putJob(jobs, None, tiler)
+
+    # Results are read before joining, since a process does not exit until its queued results are read. If the tiling
+    # process exits without tiling every queued tiff, such as when it is killed, the tiffs it did not tile are failed
+    tiled = []
+    for tiffFile in queued:
+        result = getResult(results, tiler) if running else None
+        if result is None:
+            running = False
+            logger.info('Tiling process exited with code '+str(tiler.exitcode)+' before tiling '+tiffFile)
+            result = {'inputFile': tiffFile, 'status': 'failed', 'seconds': 0.0, 'stages': {},
+                      'error': 'Tiling process exited with code '+str(tiler.exitcode)}
+        tiled.append(result)
+    tiler.join()
+    return(converted, tiled)
+
+@logger.catch
+def main(args):
+    # get input variables from args
+    inputFiles = list(args.inputFiles or [])
+    if args.manifest:
+        inputFiles += batch2geotiff.readManifest(args.manifest)
+    inputDir = os.path.join(args.inputDir, '')
+    tiffDir = os.path.join(args.tiffDir, '')
+    tiffFinalDir = os.path.join(args.tiffFinalDir, '')
+    mbtilesDir = os.path.join(args.mbtilesDir, '')
+    mbtilesFinalDir = os.path.join(args.mbtilesFinalDir, '')
+    summaryFile = args.summaryFile or mbtilesFinalDir+'advisory2mbtiles.summary.json'
+
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'advisory2mbtiles.log', level='DEBUG', enqueue=True)
+
+    if not inputFiles:
+        logger.info('No input files')
+        sys.exit(1)
+
+    logger.info('Convert and tile '+str(len(inputFiles))+' files of an advisory: '+', '.join(inputFiles))
+    start = time.time()
+    converted, tiled = advisory2mbtiles(inputFiles, inputDir, tiffDir, tiffFinalDir, mbtilesDir, mbtilesFinalDir, args)
+    seconds = time.time() - start
+    stageSeconds = sum(result['seconds'] for result in converted + tiled)
+    logger.info('Advisory took '+'{:.1f}'.format(seconds)+' seconds, and its conversions and tilings '+'{:.1f}'.format(stageSeconds)+' seconds')
+
+    batch2geotiff.writeSummary(summaryFile, {'seconds': seconds, 'stageSeconds': stageSeconds, 'converted': converted, 'tiled': tiled})
+    stagemetrics.writeReports(args.metricsFile, args.prometheusFile,
+                              [({'script': 'adcirc2geotiff', 'product': result['inputFile'].split('.')[0]}, result.get('stages', {})) for result in converted]
+                              + [({'script': 'geotiff2mbtiles', 'product': result['inputFile'].split('.')[0]}, result['stages']) for result in tiled])
+
+    # Missing swan files are expected, like adcirc2geotiff.py, but other missing files and failures are not
+    failed = [result['inputFile'] for result in converted + tiled
+              if result['status'] == 'failed' or (result['status'] == 'missing' and not result['inputFile'].startswith('swan'))]
+    if failed:
+        logger.info('Advisory did not convert or tile '+', '.join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--inputFILES", "--inputFiles", help="Input file names", action="store", dest="inputFiles", nargs='+')
+    parser.add_argument("--manifest", help="File listing input file names, one per line", action="store", dest="manifest")
+    parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
+    parser.add_argument("--tiffDIR", "--tiffDir", help="Tiff output directory path", action="store", dest="tiffDir", required=True)
+    parser.add_argument("--tiffFinalDIR", "--tiffFinalDir", help="Tiff final directory path", action="store", dest="tiffFinalDir", required=True)
+    parser.add_argument("--mbtilesDIR", "--mbtilesDir", help="Mbtiles output directory path", action="store", dest="mbtilesDir", required=True)
+    parser.add_argument("--mbtilesFinalDIR", "--mbtilesFinalDir", help="Mbtiles final directory path", action="store", dest="mbtilesFinalDir", required=True)
+    parser.add_argument("--zlstart", help="Start zoom level", action="store", dest="zlstart", required=True)
+    parser.add_argument("--zlstop", help="Stop zoom level", action="store", dest="zlstop", required=True)
+    parser.add_argument("--tileCpu", help="Number of CPUs used by gdal2mbtiles or the sharded tiler", action="store", dest="tileCpu", type=int, default=1)
+    parser.add_argument("--tiler", help="Tile with the gdal2mbtiles script, natively in the tiling process, or natively in shards rendered by --tileCpu processes", action="store", dest="tiler", choices=['gdal2mbtiles', 'native', 'sharded'], default='gdal2mbtiles')
+    parser.add_argument("--pyramid", help="With the native tiler, read every zoom level from the tiff (none), or build lower zoom levels from the top zoom level with a reduction", action="store", dest="pyramid", choices=('none',) + pyramid.RGBA_REDUCTIONS, default='none')
+    parser.add_argument("--format", help="Tile format of the native tiler", action="store", dest="tileFormat", choices=tileencode.TILE_FORMATS, default='png')
+    parser.add_argument("--optimize", help="Spend more time compressing tiles of the native tiler, for smaller tiles", action="store_true", dest="optimize")
+    parser.add_argument("--queueSize", help="Number of styled tiffs that wait for the tiling process before converting waits", action="store", dest="queueSize", type=int, default=1)
+    parser.add_argument("--summaryFILE", "--summaryFile", help="Advisory summary file path, by default advisory2mbtiles.summary.json in the mbtiles final directory", action="store", dest="summaryFile")
+    adcirc2geotiff.addArguments(parser)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, json, time, traceback
+import multiprocessing, multiprocessing.util
+from loguru import logger
+
+# Import local modules
+import adcirc2geotiff, meshcache, stagemetrics
+
+# State of a batch process, which is QGIS when it is needed and the meshes loaded so far
+batchState = {}
+
+# Read input file names from a manifest file, with one file name per line. Blank lines and lines starting with # are skipped
+def readManifest(manifestFile):
+    with open(manifestFile) as f:
+        return([line.strip() for line in f if line.strip() and not line.strip().startswith('#')])
+
+# Set the QGIS environment and initialize QGIS once in a batch process. QGIS is quit when the process exits, which is how
+# pool worker processes quit it, since they exit without running atexit functions
+def initBatch(args, tmpDir):
+    adcirc2geotiff.setEnvironment(tmpDir)
+    stagemetrics.setProfileDir(args.profileDir)
+    batchState['app'] = adcirc2geotiff.startQgis() if adcirc2geotiff.needsQgis(args) else None
+    batchState['meshes'] = meshcache.LoadedMeshes()
+    if batchState['app'] is not None:
+        multiprocessing.util.Finalize(None, exitBatch, exitpriority=10)
+
+# Quit QGIS in a batch process, if it has not been quit yet
+def exitBatch():
+    if batchState.get('app') is not None:
+        batchState['app'].exitQgis()
+        batchState['app'] = None
+        logger.info('Quit QGIS')
+
+# Convert one netCDF file of a batch, returning its result
+def runFile(inputFile, inputDir, outputDir, finalDir, args):
+    result = {'inputFile': inputFile, 'status': 'done', 'seconds': 0.0}
+    start = time.time()
+    if not os.path.exists(inputDir+inputFile):
+        logger.info(inputDir+inputFile+' does not exist')
+        result['status'] = 'missing'
+        return(result)
+
+    # Each file has its own tmp directory
+    tmpDir = adcirc2geotiff.getTmpDir(inputDir, inputFile)
+    os.makedirs(tmpDir, exist_ok=True)
+    os.environ['TMPDIR'] = tmpDir
+
+    logger.info('Convert '+inputFile+' in batch')
+    stagemetrics.reset()
+    try:
+        result['outputs'] = adcirc2geotiff.convertFile(inputFile, inputDir, outputDir, finalDir, tmpDir, args, batchState['meshes'])
+    except (Exception, SystemExit) as e:
+        logger.info('Failed to convert '+inputFile+': '+traceback.format_exc())
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['seconds'] = time.time() - start
+
+    # Keep the stages of each file with its result
+    result['stages'] = stagemetrics.report()
+    stagemetrics.logStages()
+    stagemetrics.dumpProfiles({'script': 'adcirc2geotiff', 'product': inputFile.split('.')[0]})
+    logger.info('Converted '+inputFile+' with status '+result['status']+' in '+'{:.1f}'.format(result['seconds'])+' seconds')
+    return(result)
+
+# Convert a netCDF file in a worker process of a concurrent batch
+def runWorkerFile(job):
+    return(runFile(*job))
+
+# Convert netCDF files one after another, or in worker processes that each initialize QGIS once
+def batch2geotiff(inputFiles, inputDir, outputDir, finalDir, args, jobs=1):
+    if jobs > 1:
+        if args.cpu > 1:
+            # Pool workers can not start regrid worker processes of their own
+            logger.info('Each of the '+str(jobs)+' batch jobs regrids with one CPU')
+            args.cpu = 1
+        pool = multiprocessing.Pool(jobs, initBatch, (args, adcirc2geotiff.getTmpDir(inputDir, inputFiles[0])))
+        try:
+            results = pool.map(runWorkerFile, [(inputFile, inputDir, outputDir, finalDir, args) for inputFile in inputFiles], 1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        initBatch(args, adcirc2geotiff.getTmpDir(inputDir, inputFiles[0]))
+        results = [runFile(inputFile, inputDir, outputDir, finalDir, args) for inputFile in inputFiles]
+        exitBatch()
+
+    return(results)
+
+# Write the results of a batch to a summary file
+def writeSummary(summaryFile, results):
+    os.makedirs(os.path.dirname(os.path.abspath(summaryFile)), exist_ok=True)
+    with open(summaryFile, 'w') as f:
+        json.dump(results, f, indent=2)
+    logger.info('Wrote batch summary '+summaryFile)
+
+@logger.catch
+def main(args):
+    # get input variables from args
+    inputFiles = list(args.inputFiles or [])
+    if args.manifest:
+        inputFiles += readManifest(args.manifest)
+    inputDir = os.path.join(args.inputDir, '')
+    outputDir = os.path.join(args.outputDir, '')
+    finalDir = os.path.join(args.finalDir, '')
+    summaryFile = args.summaryFile or finalDir+'batch2geotiff.summary.json'
+
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'batch2geotiff.log', level='DEBUG')
+
+    if not inputFiles:
+        logger.info('No input files')
+        sys.exit(1)
+
+    logger.info('Convert '+str(len(inputFiles))+' files in batch: '+', '.join(inputFiles))
+    results = batch2geotiff(inputFiles, inputDir, outputDir, finalDir, args, args.jobs)
+    writeSummary(summaryFile, results)
+    stagemetrics.writeReports(args.metricsFile, args.prometheusFile,
+                              [({'script': 'adcirc2geotiff', 'product': result['inputFile'].split('.')[0]}, result.get('stages', {}))
+                               for result in results])
+
+    # Missing swan files are expected, like adcirc2geotiff.py, but other missing files and failures are not
+    failed = [result['inputFile'] for result in results
+              if result['status'] == 'failed' or (result['status'] == 'missing' and not result['inputFile'].startswith('swan'))]
+    if failed:
+        logger.info('Batch did not convert '+', '.join(failed))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("--inputFILES", "--inputFiles", help="Input file names", action="store", dest="inputFiles", nargs='+')
+    parser.add_argument("--manifest", help="File listing input file names, one per line", action="store", dest="manifest")
+    parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
+    parser.add_argument("--outputDIR", "--outputDir", help="Output directory path", action="store", dest="outputDir", required=True)
+    parser.add_argument("--finalDIR", "--finalDir", help="Final directory path", action="store", dest="finalDir", required=True)
+    parser.add_argument("--jobs", help="Number of files converted at once, each in a process that initializes QGIS once", action="store", dest="jobs", type=int, default=1)
+    parser.add_argument("--summaryFILE", "--summaryFile", help="Batch summary file path, by default batch2geotiff.summary.json in the final directory", action="store", dest="summaryFile")
+    adcirc2geotiff.addArguments(parser)
+
+    args = parser.parse_args()
+    main(args)
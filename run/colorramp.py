@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, json, tempfile
+import numpy as np
+from pathlib import Path
+from loguru import logger
+from colour import Color
+
+# Import local modules
+import meshregrid, meshcache
+
+# Opacity of styled rasters and tiles
+OPACITY = 0.75
+
+# Tolerance used by QGIS when comparing values with color ramp values
+DOUBLE_DIFF_THRESHOLD = 0.0000001
+
+# Units of the values of each product, as labelled on its colorbar
+UNITS = {'maxele': 'meters', 'maxwvel': 'meters per second', 'swan_HS_max': 'meters'}
+
+# Percentiles of the node values used as the bottom and top color values of products other than maxele
+PERCENTILES = (0.5, 99.5)
+
+# Compute color ramp statistics of node values, which are the range of the values and the values at two percentiles
+def valueStats(values, percentiles=PERCENTILES):
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        logger.info('No node values to compute color ramp statistics from')
+        return({'count': 0, 'min': None, 'max': None, 'percentiles': [float(p) for p in percentiles], 'bottom': None, 'top': None})
+    bottom, top = np.percentile(values, percentiles)
+    return({'count': int(len(values)), 'min': float(values.min()), 'max': float(values.max()),
+            'percentiles': [float(p) for p in percentiles], 'bottom': float(bottom), 'top': float(top)})
+
+# Check if statistics were computed from any values, since products without wet nodes have nothing to style
+def hasValues(stats):
+    return(stats['count'] > 0)
+
+# Get the path of the statistics sidecar file of a netCDF file, such as maxwvel.63.stats.json. The sidecar file is kept in
+# statsDir, or next to the netCDF file, so that every script run on the netCDF file reuses it
+def statsFile(inputFile, statsDir=None):
+    return(os.path.join(statsDir or os.path.dirname(inputFile), ".".join(Path(inputFile).parts[-1].split('.')[0:2])+'.stats.json'))
+
+# Read a statistics sidecar file, returning None if it does not exist, or was computed from another file or percentiles
+def readStats(filename, source, percentiles=PERCENTILES):
+    try:
+        with open(filename) as f:
+            stats = json.load(f)
+    except (OSError, ValueError):
+        return(None)
+    if stats.get('source') != source or stats.get('percentiles') != [float(p) for p in percentiles]:
+        return(None)
+    return(stats)
+
+# Write a statistics sidecar file, which can be read by other users
+def writeStats(filename, stats):
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpFile = tempfile.mkstemp(dir=directory, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(stats, f, indent=2)
+    os.chmod(tmpFile, 0o644)
+    os.replace(tmpFile, filename)
+
+# Get the color ramp statistics of a netCDF file from its sidecar file, or compute them from the node values and write
+# the sidecar file
+def loadStats(inputFile, statsPath, percentiles=PERCENTILES, values=None):
+    source = meshcache.fileKey(inputFile)
+    stats = readStats(statsPath, source, percentiles)
+    if stats is not None:
+        logger.info('Read color ramp statistics from '+statsPath)
+        return(stats)
+
+    if values is None:
+        values = meshregrid.readValues(inputFile, Path(inputFile).parts[-1].split('.')[0])
+    stats = dict(valueStats(values, percentiles), source=source)
+    try:
+        writeStats(statsPath, stats)
+        logger.info('Wrote color ramp statistics to '+statsPath)
+    except OSError as e:
+        logger.info('Can not write color ramp statistics to '+statsPath+': '+str(e))
+    return(stats)
+
+# Get the color ramp of a product
+def getColorRamp(rasterlayer, colorscaling, stats=None):
+    '''
+    rasterlayer: product name, such as maxele, maxwvel or swan_HS_max
+    colorscaling: interpolated or discrete
+    stats: statistics of the product values from valueStats, not used for maxele
+    Returns: dictionary with the ramp type, the ramp item values and hex colors, and the valueList used for the colorbar
+    '''
+    if colorscaling == 'interpolated':
+        # Get bottom and top color values from value percentiles, calculate values for bottom middle,
+        # and top middle color values, and create color dictionary
+        logger.info('Get interpolated color values, used for styling')
+        if rasterlayer == 'maxele':
+            bottomvalue = 0.0
+            topvalue =  2.0
+
+            # Calculate range value between the bottom and top color values
+            if bottomvalue < 0:
+                vrange = topvalue + bottomvalue
+            else:
+                vrange = topvalue - bottomvalue
+
+            bottommiddle = vrange * 0.3333
+            topmiddle = vrange * 0.6667
+            colDic = {'bottomcolor':'#0000ff', 'bottommiddle':'#00ffff', 'topmiddle':'#ffff00', 'topcolor':'#ff0000'}
+        else:
+            bottomvalue, topvalue = stats['bottom'], stats['top']
+
+            # Calculate range value between the bottom and top color values
+            if bottomvalue < 0:
+                vrange = topvalue + bottomvalue
+            else:
+                vrange = topvalue - bottomvalue
+
+            bottommiddle = vrange * 0.375
+            topmiddle = vrange * 0.75
+            colDic = {'bottomcolor':'#000000', 'bottommiddle':'#ff0000', 'topmiddle':'#ffff00', 'topcolor':'#ffffff'}
+
+        # Create list of color values
+        valueList = [bottomvalue, bottommiddle, topmiddle, topvalue]
+        values = valueList
+        colors = [colDic['bottomcolor'], colDic['bottommiddle'], colDic['topmiddle'], colDic['topcolor']]
+
+    elif colorscaling == 'discrete':
+        # Calculate values for bottom middle, and top middle color values, and create color dictionary
+        logger.info('Get descrete color values, used for styling')
+        if rasterlayer == 'maxele':
+            # Defind color values
+            minv = 0.0
+            maxv = 2.0
+            bottomvalue = 0.0
+            topvalue =  2.0
+            bottomcolor = Color('#0000ff')
+            topcolor = Color('#ff0000')
+            colorramp=list(bottomcolor.range_to(topcolor, 32))
+
+            # Create list of color values and colorramp
+            valueList = np.append(np.arange(bottomvalue, topvalue, topvalue/31), topvalue)
+
+        else:
+            minv, maxv = stats['min'], stats['max']
+            topvalue = stats['top']
+
+            # Define color values
+            bottomvalue = 0.0
+            bottomcolor = Color('#000000')
+            bottommiddle = Color('#ff0000')
+            topmiddle = Color('#ffff00')
+            topcolor = Color('#ffffff')
+            colorrampbottom=list(bottomcolor.range_to(bottommiddle, 11))
+            colorrampmmiddle=list(bottommiddle.range_to(topmiddle, 12))
+            colorramptop=list(topmiddle.range_to(topcolor, 11))
+            colorramp = colorrampbottom + colorrampmmiddle[1:-1] + colorramptop
+
+            # Create list of color values and colorramp
+            valueList = np.arange(bottomvalue, topvalue, topvalue/32)
+
+        # The ramp starts at the minimum value and ends at the maximum value
+        logger.info('Check valueList '+str(len(valueList))+' and colorramp '+str(len(colorramp))+' length ')
+        values = [minv] + list(valueList) + [maxv]
+        colors = [colorramp[0].hex_l] + [colorramp[i].hex_l for i in range(len(valueList))] + [colorramp[-1].hex_l]
+
+    else:
+        logger.info('Incorrect colorscaling value')
+        raise Exception('Incorrect colorscaling value')
+
+    return({'type': colorscaling, 'values': [float(value) for value in values], 'colors': colors, 'valueList': valueList})
+
+# Get the value ranges of a product that its colorbars are made from, which are the statistics of its values, and the
+# values and colors of its ramp for each color scaling. Clients of value encoded tiles use them to style the tiles, and
+# to draw the colorbar that create_colorbar draws
+def valueRanges(rasterlayer, stats):
+    ramps = {}
+    for colorscaling in ('discrete', 'interpolated'):
+        ramp = getColorRamp(rasterlayer, colorscaling, stats)
+        ramps[colorscaling] = {'values': ramp['values'], 'colors': ramp['colors'], 'valueList': [float(value) for value in ramp['valueList']]}
+    return({'unit': UNITS.get(rasterlayer), 'opacity': OPACITY, 'stats': {key: stats[key] for key in ('min', 'max', 'percentiles', 'bottom', 'top')},
+            'ramps': ramps})
+
+# Convert a hex color to a red, green, blue array
+def hexToRgb(value):
+    value = value.strip('#')
+    return(np.array([int(value[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.uint8))
+
+# Build a lookup table of a color ramp, which maps pixel values to indices of a uint8 RGBA palette. The last palette
+# entry is transparent, and is used for pixels that are NaN, or above the last value of a discrete ramp, which is how
+# QgsColorRampShader renders them
+def buildLookup(ramp, opacity=OPACITY, levels=255):
+    values = np.asarray(ramp['values'], dtype=np.float64)
+    colors = np.array([hexToRgb(color) for color in ramp['colors']])
+
+    if ramp['type'] == 'discrete':
+        # Each ramp value has its own color
+        rgb = colors
+    else:
+        # Sample the interpolated colors at evenly spaced levels between the first and last ramp values
+        values = np.linspace(values[0], values[-1], levels)
+        rgb = np.stack([np.round(np.interp(values, ramp['values'], colors[:, band].astype(np.float64))) for band in range(3)], axis=1)
+
+    palette = np.zeros((len(values) + 1, 4), dtype=np.uint8)
+    palette[:-1, :3] = rgb
+    palette[:-1, 3] = int(255 * opacity)
+    return({'type': ramp['type'], 'values': values, 'palette': palette, 'nodata': len(values)})
+
+# Map a block of values to palette indices of a lookup table
+def classify(block, lookup):
+    values = lookup['values']
+    valid = np.isfinite(block)
+    safe = np.where(valid, block, values[0])
+    if lookup['type'] == 'discrete':
+        # Use the first ramp value that is greater than or equal to the pixel value
+        index = np.searchsorted(values, safe - DOUBLE_DIFF_THRESHOLD, 'left')
+    else:
+        # Use the nearest level, and the end levels outside the ramp
+        step = (values[-1] - values[0]) / max(len(values) - 1, 1)
+        index = np.clip(np.round((safe - values[0]) / (step or 1.0)), 0, len(values) - 1)
+    index = np.where(valid, index, lookup['nodata'])
+    return(index.astype(np.uint8 if len(lookup['palette']) <= 256 else np.uint16))
+
+# Colorize a block of values with a lookup table, returning RGBA pixels
+def applyLookup(block, lookup):
+    return(lookup['palette'][classify(block, lookup)])
+
+# Colorize a block of values with a color ramp, returning RGBA pixels
+def colorize(block, ramp, opacity=OPACITY):
+    return(applyLookup(block, buildLookup(ramp, opacity)))
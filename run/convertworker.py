@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, json, time, signal, socket, tempfile, traceback, importlib, threading
+from datetime import datetime
+from loguru import logger
+
+# Import local modules
+import meshcache, regions, stagemetrics
+
+# Scripts that worker jobs run, with the same arguments as on the command line
+COMMANDS = ('adcirc2geotiff', 'geotiff2mbtiles', 'adcirc2mbtiles')
+
+# Directories of a spool directory, holding jobs that are waiting, running, done and failed
+QUEUES = ('incoming', 'running', 'done', 'failed')
+
+# Number of recent jobs listed in the status file of a worker
+RECENT_JOBS = 20
+
+# Seconds between updates of the status file of a running worker, and seconds after which a worker whose status file was
+# not updated is taken to be gone
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 300
+
+# Number of times a job whose worker is gone is queued again, before it is failed
+MAX_RECLAIMS = 1
+
+# State kept by a worker between jobs, which is QGIS once a job needs it, the loaded meshes, and the imported scripts
+workerState = {'app': None, 'meshes': None, 'modules': {}, 'stop': False, 'metricsFile': None, 'prometheusFile': None, 'started': None}
+
+# Create the queue directories of a spool directory
+def makeSpool(spoolDir):
+    for queue in QUEUES:
+        os.makedirs(os.path.join(spoolDir, queue), exist_ok=True)
+
+# Write a JSON file so that readers never see it partly written
+def writeJson(filename, data):
+    fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.chmod(tmpFile, 0o644)
+    os.replace(tmpFile, filename)
+
+# Add a job to the incoming queue of a spool directory, returning the job id
+def submitJob(spoolDir, command, jobArgs):
+    if command not in COMMANDS:
+        raise Exception('Incorrect worker command '+command)
+    makeSpool(spoolDir)
+    jobId = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')+'-'+str(os.getpid())
+    writeJson(os.path.join(spoolDir, 'incoming', jobId+'.json'), {'id': jobId, 'command': command, 'args': list(jobArgs), 'submitted': time.time()})
+    return(jobId)
+
+# Claim the oldest incoming job by moving it to the running queue. Several workers can share a spool directory, since only
+# one of them can move a job file
+def claimJob(spoolDir):
+    for name in sorted(os.listdir(os.path.join(spoolDir, 'incoming'))):
+        if not name.endswith('.json'):
+            continue
+        try:
+            os.rename(os.path.join(spoolDir, 'incoming', name), os.path.join(spoolDir, 'running', name))
+        except FileNotFoundError:
+            continue
+        os.utime(os.path.join(spoolDir, 'running', name))
+        with open(os.path.join(spoolDir, 'running', name)) as f:
+            job = json.load(f)
+
+        # Record the worker running the job, so that the job can be reclaimed if the worker is gone
+        job['owner'] = {'worker': workerName(), 'host': socket.gethostname(), 'pid': os.getpid(), 'started': workerState['started']}
+        writeJson(os.path.join(spoolDir, 'running', name), job)
+        return(name, job)
+    return(None)
+
+# Check if the worker running a job is gone, such as when it was killed or its node failed. A worker on this host is gone
+# if its process is, and any worker is gone if its status file was not updated for STALE_SECONDS, or was written by a
+# later worker with the same name. Jobs without a worker are gone if they were not claimed within STALE_SECONDS
+def ownerGone(spoolDir, name, owner):
+    if owner is None:
+        return(time.time() - os.path.getmtime(os.path.join(spoolDir, 'running', name)) > STALE_SECONDS)
+    if owner['host'] == socket.gethostname():
+        if owner['pid'] == os.getpid():
+            return(owner['started'] != workerState['started'])
+        try:
+            os.kill(owner['pid'], 0)
+        except ProcessLookupError:
+            return(True)
+        except PermissionError:
+            pass
+
+    statusFile = os.path.join(spoolDir, 'status.'+owner['worker']+'.json')
+    try:
+        with open(statusFile) as f:
+            status = json.load(f)
+        age = time.time() - os.path.getmtime(statusFile)
+    except (OSError, ValueError):
+        return(True)
+    return(status.get('started') != owner['started'] or status.get('state') == 'stopped' or age > STALE_SECONDS)
+
+# Queue running jobs whose worker is gone again, or fail them if they were already queued again MAX_RECLAIMS times, since
+# the job itself can be what killed its workers. Returns the names of the reclaimed jobs
+def reclaimJobs(spoolDir):
+    reclaimed = []
+    for name in sorted(os.listdir(os.path.join(spoolDir, 'running'))):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(spoolDir, 'running', name)) as f:
+                job = json.load(f)
+            if not ownerGone(spoolDir, name, job.get('owner')):
+                continue
+
+            # Only one worker can move the job file aside, so a job is reclaimed once
+            os.rename(os.path.join(spoolDir, 'running', name), os.path.join(spoolDir, 'running', name+'.reclaim'))
+        except (FileNotFoundError, ValueError):
+            continue
+
+        owner = job.pop('owner', None)
+        worker = owner['worker'] if owner else 'unknown'
+        if job.get('reclaims', 0) < MAX_RECLAIMS:
+            job['reclaims'] = job.get('reclaims', 0) + 1
+            writeJson(os.path.join(spoolDir, 'incoming', name), job)
+            logger.info('Queued job '+name+' of gone worker '+worker+' again')
+        else:
+            writeJson(os.path.join(spoolDir, 'failed', name),
+                      dict(job, worker=worker, status='failed', finished=time.time(), error='Worker '+worker+' is gone'))
+            logger.info('Failed job '+name+' of gone worker '+worker)
+        os.remove(os.path.join(spoolDir, 'running', name+'.reclaim'))
+        reclaimed.append(name)
+    return(reclaimed)
+
+# Import a script once per worker
+def getModule(command):
+    if command not in workerState['modules']:
+        logger.info('Import '+command)
+        workerState['modules'][command] = importlib.import_module(command)
+    return(workerState['modules'][command])
+
+# Run a job with the warm state of the worker, returning its outputs
+def runJob(job):
+    if job['command'] not in COMMANDS:
+        raise Exception('Incorrect worker command '+str(job['command']))
+    module = getModule(job['command'])
+    args = module.getParser().parse_args(job['args'])
+    inputFile = args.inputFile
+    inputDir = os.path.join(args.inputDir, '')
+    outputDir = os.path.join(args.outputDir, '')
+    finalDir = os.path.join(args.finalDir, '')
+    if not os.path.exists(inputDir+inputFile):
+        raise Exception(inputDir+inputFile+' does not exist')
+
+    if job['command'] == 'adcirc2geotiff':
+        # QGIS is initialized by the first job that needs it, and kept for later jobs
+        tmpDir = module.getTmpDir(inputDir, inputFile)
+        module.setEnvironment(tmpDir)
+        if module.needsQgis(args) and workerState['app'] is None:
+            workerState['app'] = module.startQgis()
+        return(module.convertFile(inputFile, inputDir, outputDir, finalDir, tmpDir, args, workerState['meshes']))
+
+    if job['command'] == 'geotiff2mbtiles':
+        outputFile = ".".join(inputFile.split('.')[0:2])+'.'+args.zlstart+'.'+args.zlstop+'.mbtiles'
+        module.geotiff2mbtiles(inputFile, args.zlstart, args.zlstop, args.cpu, inputDir, outputDir, finalDir, args.tiler, args.pyramid,
+                               args.tileFormat, args.optimize, args.resultCache, args.resultCacheSize, regions.getRegions(args))
+    else:
+        outputFile = module.mbtilesFile(inputFile, args.zlstart, args.zlstop, args.encoding)
+        module.mesh2mbtiles(inputFile, args.zlstart, args.zlstop, inputDir, outputDir, finalDir, args.colorscaling, args.meshCache,
+                            args.pyramid, args.tileFormat, args.optimize, args.percentiles, workerState['meshes'], args.resultCache,
+                            args.resultCacheSize, args.incremental, args.encoding, args.valueScale, args.valueOffset,
+                            regions.getRegions(args), args.statsDir)
+    return({'mbtiles': finalDir+outputFile})
+
+# Run a claimed job, and move it to the done or failed queue with its result
+def processJob(spoolDir, name, job):
+    result = dict(job, worker=workerName(), started=time.time(), status='done')
+    result['waitSeconds'] = result['started'] - job.get('submitted', result['started'])
+    logger.info('Run job '+name+': '+job.get('command', '')+' '+' '.join(job.get('args', [])))
+    stagemetrics.reset()
+    try:
+        result['outputs'] = runJob(job)
+    except (Exception, SystemExit) as e:
+        # Argument errors of a job exit argparse, which must not stop the worker
+        logger.info('Job '+name+' failed: '+traceback.format_exc())
+        result['status'] = 'failed'
+        result['error'] = repr(e)
+    result['finished'] = time.time()
+    result['seconds'] = result['finished'] - result['started']
+
+    # Keep the stages of the job with its result, and write them to the metrics files of the worker
+    result['stages'] = stagemetrics.report()
+    labels = {'script': str(job.get('command')), 'product': jobProduct(job)}
+    stagemetrics.logStages()
+    stagemetrics.writeReports(workerState['metricsFile'], workerState['prometheusFile'], [(labels, result['stages'])])
+    stagemetrics.dumpProfiles(dict(labels, job=job.get('id', name)))
+
+    writeJson(os.path.join(spoolDir, result['status'], name), result)
+    os.remove(os.path.join(spoolDir, 'running', name))
+    logger.info('Job '+name+' '+result['status']+' in '+'{:.1f}'.format(result['seconds'])+' seconds')
+    return(result)
+
+# Get the product of a job from its input file argument
+def jobProduct(job):
+    args = job.get('args', [])
+    for i, arg in enumerate(args[:-1]):
+        if arg in ('--inputFile', '--inputFILE'):
+            return(args[i + 1].split('.')[0])
+    return('')
+
+# Get the name of this worker
+def workerName():
+    return(socket.gethostname()+'.'+str(os.getpid()))
+
+# Write the status file of this worker to the spool directory
+def writeStatus(spoolDir, status):
+    meshes = workerState['meshes']
+    status = dict(status, updated=time.time(), qgis=workerState['app'] is not None, meshes=len(meshes.meshes) if meshes else 0,
+                  modules=sorted(workerState['modules']))
+    writeJson(os.path.join(spoolDir, 'status.'+workerName()+'.json'), status)
+
+# Update the modification time of the status file of this worker every HEARTBEAT_SECONDS, while jobs run, so that other
+# workers can tell that it is not gone
+def heartbeat(spoolDir, stopped):
+    while not stopped.wait(HEARTBEAT_SECONDS):
+        try:
+            os.utime(os.path.join(spoolDir, 'status.'+workerName()+'.json'))
+        except OSError:
+            pass
+
+# Stop the worker after the running job
+def stopWorker(signum, frame):
+    logger.info('Worker received signal '+str(signum)+', stopping after the running job')
+    workerState['stop'] = True
+
+# Run jobs from a spool directory until stopped, or until the incoming queue is empty if once is set
+def serve(spoolDir, poll=1.0, maxMeshes=4, once=False):
+    makeSpool(spoolDir)
+    workerState['meshes'] = meshcache.LoadedMeshes(maxMeshes)
+    signal.signal(signal.SIGTERM, stopWorker)
+    signal.signal(signal.SIGINT, stopWorker)
+
+    status = {'worker': workerName(), 'started': time.time(), 'state': 'idle', 'job': None, 'done': 0, 'failed': 0, 'recent': []}
+    workerState['started'] = status['started']
+    logger.info('Worker '+status['worker']+' serving spool directory '+spoolDir)
+    writeStatus(spoolDir, status)
+    stopped = threading.Event()
+    threading.Thread(target=heartbeat, args=(spoolDir, stopped), daemon=True).start()
+
+    # Jobs left running by workers that are gone are queued again or failed
+    reclaimJobs(spoolDir)
+    while not workerState['stop']:
+        claimed = claimJob(spoolDir)
+        if claimed is None:
+            if once:
+                break
+            time.sleep(poll)
+            continue
+
+        name, job = claimed
+        status.update(state='running', job=name)
+        writeStatus(spoolDir, status)
+        result = processJob(spoolDir, name, job)
+        status[result['status']] += 1
+        status['recent'] = ([{key: result.get(key) for key in ('id', 'command', 'status', 'waitSeconds', 'seconds', 'error')}]
+                            + status['recent'])[:RECENT_JOBS]
+        status.update(state='idle', job=None)
+        writeStatus(spoolDir, status)
+
+    stopped.set()
+    status.update(state='stopped')
+    writeStatus(spoolDir, status)
+    if workerState['app'] is not None:
+        workerState['app'].exitQgis()
+        logger.info('Quit QGIS')
+    logger.info('Worker '+status['worker']+' stopped after '+str(status['done'])+' done and '+str(status['failed'])+' failed jobs')
+
+# Get the number of jobs in each queue of a spool directory, and the status of its workers, after reclaiming the running
+# jobs of workers that are gone
+def spoolStatus(spoolDir):
+    makeSpool(spoolDir)
+    reclaimed = reclaimJobs(spoolDir)
+    status = {queue: len([name for name in os.listdir(os.path.join(spoolDir, queue)) if name.endswith('.json')]) for queue in QUEUES}
+    status['workers'] = []
+    for name in sorted(os.listdir(spoolDir)):
+        if name.startswith('status.') and name.endswith('.json'):
+            with open(os.path.join(spoolDir, name)) as f:
+                status['workers'].append(json.load(f))
+    status['reclaimed'] = reclaimed
+    return(status)
+
+@logger.catch
+def main(args):
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'convertworker.log', level='DEBUG')
+
+    if args.action == 'serve':
+        # Stage metrics files are written after each job, with the stages of that job
+        workerState['metricsFile'] = args.metricsFile
+        workerState['prometheusFile'] = args.prometheusFile
+        stagemetrics.setProfileDir(args.profileDir)
+        serve(args.spoolDir, args.poll, args.maxMeshes, args.once)
+    elif args.action == 'submit':
+        if args.command is None:
+            sys.exit('Submitting a job needs --command')
+        print(submitJob(args.spoolDir, args.command, args.jobArgs))
+    else:
+        print(json.dumps(spoolStatus(args.spoolDir), indent=2))
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("action", help="Run jobs (serve), add a job (submit), or show the queues and workers (status)", choices=['serve', 'submit', 'status'])
+    parser.add_argument("--spoolDIR", "--spoolDir", help="Spool directory path", action="store", dest="spoolDir", default=os.getenv('SPOOL_DIR'), required=os.getenv('SPOOL_DIR') is None)
+    parser.add_argument("--poll", help="Seconds to wait before checking an empty queue again", action="store", dest="poll", type=float, default=1.0)
+    parser.add_argument("--maxMeshes", help="Number of recently used mesh geometries kept in memory", action="store", dest="maxMeshes", type=int, default=4)
+    parser.add_argument("--once", help="Stop when the incoming queue is empty", action="store_true", dest="once")
+    stagemetrics.addArguments(parser)
+    parser.add_argument("--command", help="Script run by a submitted job, whose arguments follow --", action="store", dest="command", choices=COMMANDS)
+
+    # Arguments of a submitted job follow --
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    args.jobArgs = argv[split + 1:]
+    main(args)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import numpy as np
+from osgeo import gdal
+from loguru import logger
+
+# Import local modules
+import tiles
+
+# Tiles of each zoom level that hold data. Tiles of a zoom level are stored as sorted keys y * 2**z + x
+class TileCoverage:
+    def __init__(self, keys, zmin, zmax, leaves=None):
+        '''
+        keys: sorted keys of the covered tiles at zoom level zmax
+        zmin, zmax: range of zoom levels
+        leaves: dictionary of sorted keys of covered tiles of lower zoom levels that have no covered children of their own,
+                such as the tiles of regions that stop at a lower zoom level
+        '''
+        self.zmin = zmin
+        self.zmax = zmax
+        self.keys = {zmax: keys}
+        self.leaves = {z: leaves[z] for z in leaves if zmin <= z < zmax} if leaves else {}
+
+        # A tile is covered when one of its children is covered, or it is a leaf
+        for z in range(zmax - 1, zmin - 1, -1):
+            cx, cy = keyToTile(self.keys[z + 1], z + 1)
+            self.keys[z] = np.unique(np.concatenate((tileToKey(cx // 2, cy // 2, z), self.leaves.get(z, np.zeros(0, dtype=np.int64)))))
+
+        logger.info('Coverage has '+', '.join('z'+str(z)+': '+str(len(self.keys[z])) for z in range(zmin, zmax + 1))+' tiles')
+
+    # Check if a tile is covered
+    def covers(self, z, x, y):
+        return(hasKey(self.keys[z], tileToKey(x, y, z)))
+
+    # Check if a tile of a pyramid is rendered, instead of being reduced from its children, which is the case for the tiles
+    # of the top zoom level and the leaves. A leaf with covered children is rendered, so that it is not left with only the
+    # part of it its children cover
+    def renders(self, z, x, y):
+        return(z == self.zmax or (z in self.leaves and hasKey(self.leaves[z], tileToKey(x, y, z))))
+
+    # Get the number of covered tiles of a zoom level
+    def count(self, z):
+        return(len(self.keys[z]))
+
+    # Get the covered tiles of a zoom level
+    def tiles(self, z):
+        tx, ty = keyToTile(self.keys[z], z)
+        return(list(zip(tx.tolist(), ty.tolist())))
+
+    # Yield covered tiles from the top zoom level down, visiting only the children of covered tiles
+    def iterTiles(self):
+        level = self.tiles(self.zmin)
+        for z in range(self.zmin, self.zmax + 1):
+            for x, y in level:
+                yield(z, x, y)
+            if z < self.zmax:
+                level = [(cx, cy) for x, y in level for cx, cy in children(x, y) if self.covers(z + 1, cx, cy)]
+
+# Check if sorted keys hold a key
+def hasKey(keys, key):
+    i = np.searchsorted(keys, key)
+    return(bool(i < len(keys) and keys[i] == key))
+
+# Get the part of a coverage from zoom level zmin to zmax, keeping only the tiles under roots, which are keys of tiles of
+# zoom level zroot, if they are given
+def partCoverage(cover, zmin, zmax, zroot=None, roots=None):
+    def select(keys, z):
+        if roots is None:
+            return(keys)
+        tx, ty = keyToTile(keys, z)
+        return(keys[np.isin(tileToKey(tx >> (z - zroot), ty >> (z - zroot), zroot), roots)])
+    return(TileCoverage(select(cover.keys[zmax], zmax), zmin, zmax, {z: select(keys, z) for z, keys in cover.leaves.items()}))
+
+# Join the coverages of regions that stop at different zoom levels into one coverage. tops holds the top zoom level of each
+# region with the keys of its covered tiles at that zoom level, and the covered tiles of regions that stop below the top
+# zoom level of the coverage are its leaves
+def joinCoverages(tops, zmin):
+    zmax = max([z for z, _ in tops], default=zmin)
+    levels = {}
+    for z, keys in tops:
+        levels.setdefault(z, []).append(keys)
+    levels = {z: np.unique(np.concatenate(keys)) for z, keys in levels.items()}
+    return(TileCoverage(levels.pop(zmax, np.zeros(0, dtype=np.int64)), zmin, zmax, levels))
+
+# Get the key of a tile
+def tileToKey(x, y, z):
+    return(np.asarray(y, dtype=np.int64) * (2 ** z) + np.asarray(x, dtype=np.int64))
+
+# Get the tile of a key
+def keyToTile(key, z):
+    return(key % (2 ** z), key // (2 ** z))
+
+# Get the four children of a tile
+def children(x, y):
+    return([(2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)])
+
+# Get the keys of the tiles overlapped by longitude and latitude boxes at a zoom level
+def boxKeys(west, south, east, north, z):
+    n = 2 ** z
+    tx0, ty0 = tiles.lonlatToTile(west, north, z)
+    tx1, ty1 = tiles.lonlatToTile(east, south, z)
+    x0 = np.clip(np.floor(tx0), 0, n - 1).astype(np.int64)
+    x1 = np.clip(np.floor(tx1), 0, n - 1).astype(np.int64)
+    y0 = np.clip(np.floor(ty0), 0, n - 1).astype(np.int64)
+    y1 = np.clip(np.floor(ty1), 0, n - 1).astype(np.int64)
+
+    # Expand each box into its tiles
+    ncols = x1 - x0 + 1
+    counts = ncols * (y1 - y0 + 1)
+    b = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return(np.unique(tileToKey(x0[b] + local % ncols[b], y0[b] + local // ncols[b], z)))
+
+# Compute the tiles covered by the wet triangles of a mesh, which are the triangles with values at all three nodes. With
+# bounds, as west, south, east, north, only triangles that overlap the bounds are used
+def meshCoverage(mesh, values, zmin, zmax, chunk=1000000, bounds=None):
+    logger.info('Compute mesh coverage of zoom levels '+str(zmin)+' to '+str(zmax))
+    wet = np.nonzero(np.isfinite(values[mesh.tri]).all(axis=1))[0]
+    return(triangleCoverage(mesh, boundedTriangles(mesh, wet, bounds), zmin, zmax, chunk))
+
+# Compute the tiles overlapped by triangles of a mesh that have a changed node, which are the tiles whose pixels can change
+def changedCoverage(mesh, changed, zmin, zmax, chunk=1000000, bounds=None):
+    logger.info('Compute coverage of changed nodes of zoom levels '+str(zmin)+' to '+str(zmax))
+    return(triangleCoverage(mesh, boundedTriangles(mesh, np.nonzero(changed[mesh.tri].any(axis=1))[0], bounds), zmin, zmax, chunk))
+
+# Get the triangles of an index that overlap bounds, or all of them if there are no bounds
+def boundedTriangles(mesh, index, bounds=None):
+    if bounds is None:
+        return(index)
+    return(np.intersect1d(index, mesh.trianglesIn(*bounds)))
+
+# Compute the tiles overlapped by the bounding boxes of triangles of a mesh
+def triangleCoverage(mesh, index, zmin, zmax, chunk=1000000):
+    keys = [np.zeros(0, dtype=np.int64)]
+    for start in range(0, len(index), chunk):
+        box = mesh.bbox[index[start:start + chunk]]
+        keys.append(boxKeys(box[:, 0], box[:, 1], box[:, 2], box[:, 3], zmax))
+    return(TileCoverage(np.unique(np.concatenate(keys)), zmin, zmax))
+
+# Compute the tiles covered by visible pixels of a styled RGBA tiff, reading its alpha band averaged to pixels of at
+# most half a tile at zoom level zmax. Blocks of at most 13 by 13 pixels are averaged, so that a single visible pixel
+# still gives a non zero average. With bounds, as west, south, east, north, only the pixels within the bounds are read
+def rasterCoverage(ds, zmin, zmax, rows=4096, bounds=None):
+    logger.info('Compute raster coverage of zoom levels '+str(zmin)+' to '+str(zmax))
+    x0, xres, _, y0, _, yres = ds.GetGeoTransform()
+    factor = min(13, max(1, int(360.0 / 2 ** zmax / 2 / xres)))
+    band = ds.GetRasterBand(ds.RasterCount)
+    xoff, xsize, ystart, ystop = 0, ds.RasterXSize, 0, ds.RasterYSize
+    if bounds is not None:
+        west, south, east, north = bounds
+        xoff = int(np.clip(np.floor((west - x0) / xres), 0, ds.RasterXSize))
+        xsize = int(np.clip(np.ceil((east - x0) / xres), 0, ds.RasterXSize)) - xoff
+        ystart = int(np.clip(np.floor((north - y0) / yres), 0, ds.RasterYSize))
+        ystop = int(np.clip(np.ceil((south - y0) / yres), 0, ds.RasterYSize))
+        if xsize <= 0:
+            ystop = ystart
+    keys = [np.zeros(0, dtype=np.int64)]
+    for yoff in range(ystart, ystop, rows * factor):
+        ysize = min(rows * factor, ystop - yoff)
+        bxsize = max(1, xsize // factor)
+        bysize = max(1, ysize // factor)
+        alpha = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_xsize=bxsize, buf_ysize=bysize,
+                                 resample_alg=gdal.GRIORA_Average)
+        brows, bcols = np.nonzero(alpha)
+        if len(brows) == 0:
+            continue
+
+        # Use the bounds of the visible buffer pixels
+        bxres = xres * xsize / bxsize
+        byres = yres * ysize / bysize
+        west = x0 + xoff * xres + bcols * bxres
+        north = y0 + yoff * yres + brows * byres
+        keys.append(boxKeys(west, north + byres, west + bxres, north, zmax))
+    return(TileCoverage(np.unique(np.concatenate(keys)), zmin, zmax))
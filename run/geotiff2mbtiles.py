@@ -7,13 +7,199 @@
 # SPDX-License-Identifier: MIT
 
 # Import Python modules
-import sys, os, argparse, shutil
+import sys, os, re, argparse, shutil, codecs
+import numpy as np
 from pathlib import Path
 from loguru import logger
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, STDOUT
+from osgeo import gdal
 
-# This function takes a tiff file and converts it to an mbtiles file, based on inputs
-def geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalDir):
+# Import local modules
+import mbtiles, tiles, coverage, pyramid, tileencode, tileshards, meshdiff, regions, resultcache, stagemetrics
+
+# Progress output of GDAL commands, such as 0...10...20...100 - done., and percentages
+PROGRESS = re.compile(r'(\d+)(?:\.\.\.|\s*%|\s*-\s*done)')
+PROGRESS_ONLY = re.compile(r'([\d.\s%-]|done)*')
+
+# Largest buffer, in pixels per side, read from the tiff to render one tile
+MAX_BUFFER = 2 * tiles.TILE_SIZE
+
+# Read the RGBA pixels of a tile from a styled EPSG 4326 tiff, using nearest neighbour resampling. Returns None if the
+# tile has no visible pixels
+def renderRasterTile(ds, z, x, y):
+    x0, xres, _, y0, _, yres = ds.GetGeoTransform()
+    lons, lats = tiles.tilePixelCenters(z, x, y)
+    cols = np.floor((lons - x0) / xres).astype(np.int64)
+    rows = np.floor((lats - y0) / yres).astype(np.int64)
+    colvalid = (cols >= 0) & (cols < ds.RasterXSize)
+    rowvalid = (rows >= 0) & (rows < ds.RasterYSize)
+    if not colvalid.any() or not rowvalid.any():
+        return(None)
+
+    # Read the window of the tiff under the tile, decimated to at most MAX_BUFFER pixels per side
+    c0, c1 = cols[colvalid].min(), cols[colvalid].max()
+    r0, r1 = rows[rowvalid].min(), rows[rowvalid].max()
+    xsize = int(c1 - c0 + 1)
+    ysize = int(r1 - r0 + 1)
+    bxsize = min(xsize, MAX_BUFFER)
+    bysize = min(ysize, MAX_BUFFER)
+    buf = ds.ReadAsArray(int(c0), int(r0), xsize, ysize, buf_xsize=bxsize, buf_ysize=bysize)
+
+    # Pick the buffer pixel under each tile pixel
+    bcols = np.clip((cols - c0) * bxsize // xsize, 0, bxsize - 1)
+    brows = np.clip((rows - r0) * bysize // ysize, 0, bysize - 1)
+    rgba = np.moveaxis(buf[:, brows[:, None], bcols[None, :]], 0, -1).copy()
+    rgba[~(rowvalid[:, None] & colvalid[None, :])] = 0
+    if not rgba[..., 3].any():
+        return(None)
+
+    return(rgba)
+
+# Render the tiles of a styled tiff for a range of zoom levels, and write them to an mbtiles file. With more than one CPU,
+# the tile pyramid is rendered in shards
+def writeRasterTiles(inputFile, outputFile, zlstart, zlstop, reduction='none', tileFormat='png', optimize=False, cpu=1, regionList=None):
+    ds = gdal.Open(inputFile)
+    x0, xres, _, y0, _, yres = ds.GetGeoTransform()
+    west, north = x0, y0
+    east, south = x0 + xres * ds.RasterXSize, y0 + yres * ds.RasterYSize
+
+    # Render only tiles covered by visible pixels of the tiff
+    with stagemetrics.stage('coverage'):
+        cover = rasterCoverage(ds, int(zlstart), int(zlstop), regionList)
+    encoder = tileencode.TileEncoder(tileFormat, optimize)
+    writer = mbtiles.MbtilesWriter(outputFile, threaded=True)
+    if cpu > 1:
+        writeShardedTiles(inputFile, outputFile, cover, cpu, reduction, tileFormat, optimize, writer)
+    elif reduction == 'none':
+        for z, x, y in cover.iterTiles():
+            rgba = renderRasterTile(ds, z, x, y)
+            if rgba is not None:
+                writer.addTile(z, x, y, encoder.encode(rgba))
+    else:
+        # Read only the top zoom level from the tiff, and build lower zoom levels by reducing their child tiles
+        pyramid.buildPyramid(cover, lambda z, x, y: renderRasterTile(ds, z, x, y),
+                             lambda childTiles: pyramid.reduceRgbaTiles(childTiles, reduction),
+                             lambda z, x, y, rgba: writer.addTile(z, x, y, encoder.encode(rgba)))
+
+    writer.setMetadata(mbtiles.tileMetadata(Path(outputFile).parts[-1].split('.mbtiles')[0], encoder.mbtilesFormat(), west, south, east,
+                                            north, int(zlstart), int(zlstop), 'Rendered from '+Path(inputFile).parts[-1]))
+    writer.close()
+    encoder.logStats()
+    return(writer.count)
+
+# Compute the tiles covered by visible pixels of a styled tiff. With regions, only the pixels within each region are read,
+# and tiles overlapping a region are covered up to the top zoom level of the region
+def rasterCoverage(ds, zlstart, zlstop, regionList=None):
+    if not regionList:
+        return(coverage.rasterCoverage(ds, zlstart, zlstop))
+    return(regions.regionCoverage(regionList, zlstart, zlstop, lambda bounds, z: coverage.rasterCoverage(ds, zlstart, z, bounds=bounds)))
+
+# Render the tiles of the coverages of a shard of a styled tiff into the shard's own mbtiles file, in a shard process.
+# With a pyramid reduction, the tiles of the lowest zoom level of the shard are also returned, to reduce the zoom levels
+# below the shards
+def writeRasterShard(job):
+    inputFile, shardFile, covers, reduction, tileFormat, optimize = job
+    ds = gdal.Open(inputFile)
+    encoder = tileencode.TileEncoder(tileFormat, optimize)
+    writer = mbtiles.MbtilesWriter(shardFile, threaded=True)
+    roots = {}
+    for cover in covers:
+        if reduction == 'none':
+            for z, x, y in cover.iterTiles():
+                rgba = renderRasterTile(ds, z, x, y)
+                if rgba is not None:
+                    writer.addTile(z, x, y, encoder.encode(rgba))
+        else:
+            def emitTile(z, x, y, rgba):
+                if z == cover.zmin:
+                    roots[(x, y)] = rgba
+                writer.addTile(z, x, y, encoder.encode(rgba))
+            pyramid.buildPyramid(cover, lambda z, x, y: renderRasterTile(ds, z, x, y),
+                                 lambda childTiles: pyramid.reduceRgbaTiles(childTiles, reduction), emitTile)
+    writer.close()
+    return(shardFile, writer.count, roots)
+
+# Reduce the zoom levels below the split zoom level of a sharded tile pyramid from the tiles of the split zoom level,
+# which are already in the shards. Leaves below the split zoom level, of regions that stop below it, are read from the tiff
+def writeBaseTiles(writer, cover, zsplit, roots, reduction, tileFormat, optimize, inputFile):
+    ds = gdal.Open(inputFile)
+    encoder = tileencode.TileEncoder(tileFormat, optimize)
+    def emitTile(z, x, y, rgba):
+        if z < zsplit:
+            writer.addTile(z, x, y, encoder.encode(rgba))
+    pyramid.buildPyramid(coverage.partCoverage(cover, cover.zmin, zsplit),
+                         lambda z, x, y: roots.get((x, y)) if z == zsplit else renderRasterTile(ds, z, x, y),
+                         lambda childTiles: pyramid.reduceRgbaTiles(childTiles, reduction), emitTile)
+
+# Render the tiles of a styled tiff in shards of the tile pyramid, in cpu processes that each write their own mbtiles
+# file, and merge the shard files into the mbtiles file as they finish. Zoom levels below the shards are rendered from
+# the tiff in another shard, or with a pyramid reduction are reduced from the lowest zoom level of the shards
+def writeShardedTiles(inputFile, outputFile, cover, cpu, reduction, tileFormat, optimize, writer):
+    tileshards.removeShards(outputFile)
+    zsplit, parts = tileshards.planShards(cover, cpu * tileshards.SHARDS_PER_CPU)
+    covers = [[tileshards.shardCoverage(cover, zsplit, roots)] for roots in parts]
+    base = tileshards.baseCoverage(cover, zsplit)
+    if base is not None and reduction == 'none':
+        covers.append([base])
+
+    jobs = [(inputFile, tileshards.shardFile(outputFile, i), shardCovers, reduction, tileFormat, optimize) for i, shardCovers in enumerate(covers)]
+    roots = {}
+    try:
+        for shardFile, count, shardRoots in tileshards.runShards(writeRasterShard, jobs, cpu):
+            writer.mergeFile(shardFile, count)
+            roots.update(shardRoots)
+    except Exception:
+        # Merged shard files are removed by the writer thread, and the others when a shard fails
+        tileshards.removeShards(outputFile)
+        raise
+
+    if base is not None and reduction != 'none':
+        writeBaseTiles(writer, cover, zsplit, roots, reduction, tileFormat, optimize, inputFile)
+
+# Get the progress of a command from GDAL style progress output, such as 0...10...20, or percentages, logging it every
+# 10 percent
+def logProgress(name, text, progress):
+    for percent in PROGRESS.findall(text):
+        if int(percent) >= progress + 10:
+            progress = int(percent) // 10 * 10
+            logger.info(name+' progress '+str(progress)+'%')
+    return(progress)
+
+# Run a command, logging its output and progress as it runs, and raise an exception if it fails. The output is read as
+# it is written, so the command never blocks on a full pipe
+def runCommand(cmd):
+    name = Path(cmd[1]).parts[-1] if len(cmd) > 1 else cmd[0]
+    logger.info('Run '+' '.join(cmd))
+    proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+    progress = -10
+    line = ''
+    # Characters can be split between chunks, so the output is decoded incrementally
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    for chunk in iter(lambda: proc.stdout.read1(4096), b''):
+        line += decoder.decode(chunk)
+        *lines, line = line.split('\n')
+        for text in lines:
+            progress = logProgress(name, text, progress)
+            if text.strip() and not PROGRESS_ONLY.fullmatch(text.strip()):
+                logger.info(name+': '+text.rstrip())
+
+        # GDAL progress has no line ends, so progress at the end of the line being written is logged as it comes
+        if PROGRESS_ONLY.fullmatch(line.strip()):
+            progress = logProgress(name, line, progress)
+            line = ''
+
+    line += decoder.decode(b'', final=True)
+    if line.strip():
+        logger.info(name+': '+line.rstrip())
+    returncode = proc.wait()
+    if returncode != 0:
+        raise Exception(name+' failed with exit code '+str(returncode))
+    logger.info(name+' finished')
+
+# This function takes a tiff file and converts it to an mbtiles file, based on inputs. With regions, the native and sharded
+# tilers render only tiles overlapping a region, up to the top zoom level of the region
+def geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalDir, tiler='gdal2mbtiles', reduction='none',
+                    tileFormat='png', optimize=False, resultCache=None, resultCacheSize=resultcache.DEFAULT_SIZE, regionList=None):
     # Create mbtiles directory path
     if not os.path.exists(outputDir):
         #mode = 0o755
@@ -38,6 +224,23 @@ def geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalD
 
     # Define output file name
     outputFile = ".".join(inputFile.split('.')[0:2])+'.'+zlstart+'.'+zlstop+'.mbtiles'
+    if regionList and tiler == 'gdal2mbtiles':
+        raise Exception('Regions can only be tiled with --tiler native or --tiler sharded')
+
+    # The mbtiles file has the name of the mbtiles file of adcirc2mbtiles.py, so the node values kept next to that file by an
+    # incremental run are removed
+    meshdiff.removeNodes(finalDir+outputFile)
+
+    # Reuse the mbtiles file of an earlier run on the same tiff contents with the same parameters, if it is cached
+    key = None
+    if resultCache:
+        with stagemetrics.stage('cache'):
+            parameters = {'zlstart': zlstart, 'zlstop': zlstop, 'tiler': tiler, 'pyramid': reduction, 'format': tileFormat, 'optimize': optimize}
+            if regionList:
+                parameters['regions'] = regions.describeRegions(regionList)
+            key = resultcache.resultKey(resultCache, inputDir+inputFile, 'geotiff2mbtiles', parameters)
+            if resultcache.fetch(resultCache, key, {outputFile: finalDir+outputFile}):
+                return
 
     # Check if output file exist, and remove it if it does exist
     if os.path.exists(outputDir+outputFile):
@@ -47,14 +250,18 @@ def geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalD
     else:
         logger.info('Mbtiles path '+outputDir+outputFile+'.')
 
-    # Define command and run it
-    cmds_list = [
-      ['python', gdal2mbtiles_cmd, inputDir+inputFile, '-z', zl, '--processes='+cpu, outputDir+outputFile]
-    ]
-    procs_list = [Popen(cmd, stdout=PIPE, stderr=PIPE) for cmd in cmds_list]
-
-    for proc in procs_list:
-        proc.wait()
+    with stagemetrics.stage('tiling') as counts:
+        if tiler == 'native':
+            # Render tiles in this process, and write them with the native mbtiles writer
+            counts['tiles'] = writeRasterTiles(inputDir+inputFile, outputDir+outputFile, zlstart, zlstop, reduction, tileFormat, optimize,
+                                               1, regionList)
+        elif tiler == 'sharded':
+            # Render shards of the tiles in cpu processes, and merge them with the native mbtiles writer
+            counts['tiles'] = writeRasterTiles(inputDir+inputFile, outputDir+outputFile, zlstart, zlstop, reduction, tileFormat, optimize,
+                                               int(cpu), regionList)
+        else:
+            # Define command and run it, logging its output as it runs
+            runCommand(['python', gdal2mbtiles_cmd, inputDir+inputFile, '-z', zl, '--processes='+cpu, outputDir+outputFile])
 
     logger.info('Created mbtiles file '+outputFile+' from tiff file '+inputFile+'.')
 
@@ -68,9 +275,16 @@ def geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalD
         logger.info('Directory '+Path(finalDir).parts[-1]+' already made.')
 
     # Move mbtiles file to findal mbtiles directory
-    shutil.move(outputDir+outputFile, finalDir+outputFile)
+    with stagemetrics.stage('move'):
+        shutil.move(outputDir+outputFile, finalDir+outputFile)
     logger.info('Moved mbtiles file to '+Path(finalDir).parts[-1]+' directory.')
 
+    # Add the mbtiles file to the result cache
+    if key:
+        with stagemetrics.stage('cache'):
+            resultcache.store(resultCache, key, {outputFile: finalDir+outputFile}, {'command': 'geotiff2mbtiles', 'inputFile': inputDir+inputFile},
+                              resultCacheSize)
+
 @logger.catch
 def main(args):
     # get input variables from args
@@ -94,7 +308,10 @@ def main(args):
 
         logger.info('Create mbtiles file, with zoom levels '+zlstart+' to '+zlstop+', from '+inputFile.strip()+' tiff file '+inputFile+' using '+cpu+' CPUs.')
 
-        geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalDir)
+        stagemetrics.setProfileDir(args.profileDir)
+        geotiff2mbtiles(inputFile, zlstart, zlstop, cpu, inputDir, outputDir, finalDir, args.tiler, args.pyramid, args.tileFormat, args.optimize,
+                        args.resultCache, args.resultCacheSize, regions.getRegions(args))
+        stagemetrics.writeMetrics(args.metricsFile, args.prometheusFile, {'script': 'geotiff2mbtiles', 'product': inputFile.split('.')[0]})
 
     else:
         logger.info(inputDir+inputFile+' does not exist')
@@ -103,8 +320,8 @@ def main(args):
         else:
             sys.exit(1)
 
-if __name__ == "__main__":
-    """ This is executed when run from the command line """
+# Get the command line argument parser, which is also used to parse the arguments of worker jobs
+def getParser():
     parser = argparse.ArgumentParser()
 
     # Argument which requires a parameter (eg. -d test)
@@ -115,7 +332,16 @@ if __name__ == "__main__":
     parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir", required=True)
     parser.add_argument("--outputDIR", "--outputDir", help="Output directory path", action="store", dest="outputDir", required=True)
     parser.add_argument("--finalDIR", "--finalDir", help="Final directory path", action="store", dest="finalDir", required=True)
+    parser.add_argument("--pyramid", help="With the native tiler, read every zoom level from the tiff (none), or build lower zoom levels from the top zoom level with a reduction", action="store", dest="pyramid", choices=('none',) + pyramid.RGBA_REDUCTIONS, default='none')
+    parser.add_argument("--tiler", help="Tile with the gdal2mbtiles script, natively in this process, or natively in shards rendered by --cpu processes", action="store", dest="tiler", choices=['gdal2mbtiles', 'native', 'sharded'], default='gdal2mbtiles')
+    parser.add_argument("--format", help="Tile format of the native tiler", action="store", dest="tileFormat", choices=tileencode.TILE_FORMATS, default='png')
+    parser.add_argument("--optimize", help="Spend more time compressing tiles of the native tiler, for smaller tiles", action="store_true", dest="optimize")
+    regions.addArguments(parser)
+    resultcache.addArguments(parser)
+    stagemetrics.addArguments(parser)
+    return(parser)
 
-    args = parser.parse_args()
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    args = getParser().parse_args()
     main(args)
-
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sys, argparse, json, glob, time, shutil, socket, sqlite3, tempfile
+import numpy as np
+from pathlib import Path
+from loguru import logger
+from osgeo import gdal
+
+# Import local modules
+import geotiff2mbtiles, mbtiles, tiles, coverage, pyramid, tileencode, tileshards, meshdiff, regions, stagemetrics
+
+# Read a JSON file
+def readJson(filename):
+    with open(filename) as f:
+        return(json.load(f))
+
+# Write a JSON file to a temporary file that is then renamed, so that other nodes never read a partly written file
+def writeJson(filename, data):
+    fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.chmod(tmpFile, 0o644)
+    os.replace(tmpFile, filename)
+
+# Get the files of a shard, which are kept in the shard directory next to its descriptor
+def shardFiles(shardDir, outputFile, index):
+    shardFile = tileshards.shardFile(os.path.join(shardDir, outputFile), index)
+    base = shardFile.split('.mbtiles')[0]
+    return({'descriptor': base+'.json', 'mbtiles': shardFile, 'roots': base+'.roots.npz', 'result': base+'.result.json'})
+
+# Get the plan file and coverage file of a product in the shard directory
+def planFiles(shardDir, outputFile):
+    base = os.path.join(shardDir, outputFile.split('.mbtiles')[0])
+    return({'plan': base+'.plan.json', 'coverage': base+'.coverage.npz'})
+
+# Get the size and modification time of the input tiff, to check that shards are rendered from the tiff that was planned
+def inputStat(inputFile):
+    stat = os.stat(inputFile)
+    return([stat.st_size, stat.st_mtime_ns])
+
+# Get the number of tiles of each zoom level of an mbtiles file
+def zoomCounts(filename):
+    conn = sqlite3.connect(filename)
+    counts = {str(z): count for z, count in conn.execute('SELECT zoom_level, COUNT(*) FROM map GROUP BY zoom_level')}
+    conn.close()
+    return(counts)
+
+# Plan the shards of the tile pyramid of a styled tiff. The pyramid is split into shards with about the same number of
+# tiles covered by visible pixels, and a descriptor of each shard is written to the shard directory, with the coverage of
+# the tiff and a plan listing the shards
+def planShards(inputFile, inputDir, shardDir, zlstart, zlstop, shards, reduction='none', tileFormat='png', optimize=False, regionList=None):
+    os.makedirs(shardDir, exist_ok=True)
+    outputFile = ".".join(inputFile.split('.')[0:2])+'.'+zlstart+'.'+zlstop+'.mbtiles'
+    files = planFiles(shardDir, outputFile)
+
+    # Remove the files of an earlier plan of the product
+    for filename in glob.glob(os.path.join(shardDir, outputFile.split('.mbtiles')[0]+'.shard*')):
+        os.remove(filename)
+
+    ds = gdal.Open(inputDir+inputFile)
+    x0, xres, _, y0, _, yres = ds.GetGeoTransform()
+    with stagemetrics.stage('coverage'):
+        cover = geotiff2mbtiles.rasterCoverage(ds, int(zlstart), int(zlstop), regionList)
+    zsplit, parts = tileshards.planShards(cover, shards)
+    weights = tileshards.rootWeights(cover, zsplit)
+    np.savez(files['coverage'], keys=cover.keys[cover.zmax], zmax=cover.zmax, **{'leaves'+str(z): keys for z, keys in cover.leaves.items()})
+
+    # Each descriptor holds what a node needs to render its shard. Zoom levels below the split zoom level are rendered
+    # with the first shard, or with a pyramid reduction are reduced from the shards when they are merged
+    common = {'inputFile': os.path.abspath(inputDir+inputFile), 'inputStat': inputStat(inputDir+inputFile), 'outputFile': outputFile,
+              'coverageFile': os.path.basename(files['coverage']), 'zlstart': zlstart, 'zlstop': zlstop, 'zsplit': zsplit,
+              'pyramid': reduction, 'format': tileFormat, 'optimize': optimize}
+    descriptors = []
+    for i, roots in enumerate(parts):
+        descriptor = dict(common, index=i, roots=roots.tolist(), tiles=int(weights[np.isin(cover.keys[zsplit], roots)].sum()),
+                          base=(i == 0 and reduction == 'none' and zsplit > cover.zmin))
+        writeJson(shardFiles(shardDir, outputFile, i)['descriptor'], descriptor)
+        descriptors.append(os.path.basename(shardFiles(shardDir, outputFile, i)['descriptor']))
+        logger.info('Planned shard '+str(i)+' of '+outputFile+' with '+str(descriptor['tiles'])+' covered tiles')
+
+    encoder = tileencode.TileEncoder(tileFormat, optimize)
+    metadata = mbtiles.tileMetadata(outputFile.split('.mbtiles')[0], encoder.mbtilesFormat(), x0, y0 + yres * ds.RasterYSize,
+                                    x0 + xres * ds.RasterXSize, y0, int(zlstart), int(zlstop), 'Rendered from '+Path(inputFile).parts[-1])
+    writeJson(files['plan'], dict(common, shards=descriptors, metadata=metadata,
+                                  tiles=int(sum(cover.count(z) for z in range(cover.zmin, cover.zmax + 1)))))
+    logger.info('Wrote plan '+files['plan']+' of '+str(len(descriptors))+' shards')
+    return(files['plan'])
+
+# Read the coverage of a plan or descriptor, with the leaves of regions that stop below its top zoom level, which is below
+# zlstop when every region does
+def readCoverage(shardDir, descriptor):
+    with np.load(os.path.join(shardDir, descriptor['coverageFile'])) as data:
+        leaves = {int(name[len('leaves'):]): data[name] for name in data.files if name.startswith('leaves')}
+        zmax = int(data['zmax']) if 'zmax' in data.files else int(descriptor['zlstop'])
+        return(coverage.TileCoverage(data['keys'], int(descriptor['zlstart']), zmax, leaves))
+
+# Render the tiles of a shard into a partial mbtiles file next to its descriptor. With a pyramid reduction, the tiles of
+# the split zoom level are written to a roots file, to reduce the zoom levels below it when merging. The result file,
+# which marks the shard as done, is written last
+def runShard(descriptorFile):
+    shardDir = os.path.dirname(os.path.abspath(descriptorFile))
+    descriptor = readJson(descriptorFile)
+    files = shardFiles(shardDir, descriptor['outputFile'], descriptor['index'])
+    if inputStat(descriptor['inputFile']) != descriptor['inputStat']:
+        raise Exception(descriptor['inputFile']+' changed since the shards were planned')
+
+    start = time.time()
+    cover = readCoverage(shardDir, descriptor)
+    zsplit = descriptor['zsplit']
+    covers = [tileshards.shardCoverage(cover, zsplit, np.array(descriptor['roots'], dtype=np.int64))]
+    if descriptor['base']:
+        covers.append(tileshards.baseCoverage(cover, zsplit))
+
+    # The partial mbtiles file is written under a temporary name, so that a shard that fails leaves no partial file
+    tmpFile = os.path.join(shardDir, '.'+os.path.basename(files['mbtiles'])+'.'+str(os.getpid())+'.tmp')
+    with stagemetrics.stage('tiling') as counts:
+        _, counts['tiles'], roots = geotiff2mbtiles.writeRasterShard((descriptor['inputFile'], tmpFile, covers, descriptor['pyramid'],
+                                                                     descriptor['format'], descriptor['optimize']))
+    if descriptor['pyramid'] != 'none':
+        keys = sorted(roots)
+        np.savez(files['roots'], keys=np.array(keys, dtype=np.int64).reshape(-1, 2),
+                 tiles=np.array([roots[key] for key in keys], dtype=np.uint8).reshape(-1, tiles.TILE_SIZE, tiles.TILE_SIZE, 4))
+    result = {'index': descriptor['index'], 'tiles': counts['tiles'], 'zoomCounts': zoomCounts(tmpFile), 'worker': socket.gethostname(),
+              'seconds': time.time() - start}
+    os.replace(tmpFile, files['mbtiles'])
+    writeJson(files['result'], result)
+    logger.info('Rendered shard '+str(descriptor['index'])+' of '+descriptor['outputFile']+' with '+str(counts['tiles'])+' tiles in '
+                +'{:.1f}'.format(result['seconds'])+' seconds')
+    return(result)
+
+# Read the results of the shards of a plan, returning them with the shards that are not done
+def readResults(planFile, plan):
+    shardDir = os.path.dirname(os.path.abspath(planFile))
+    results = []
+    missing = []
+    for descriptor in plan['shards']:
+        files = shardFiles(shardDir, plan['outputFile'], readJson(os.path.join(shardDir, descriptor))['index'])
+        if os.path.exists(files['result']):
+            results.append(dict(readJson(files['result']), files=files))
+        else:
+            missing.append(descriptor)
+    return(results, missing)
+
+# Check that an mbtiles file holds every tile of the shards of a plan, and nothing else, returning a list of problems
+def verifyMbtiles(mbtilesFile, plan, results, cover):
+    problems = []
+    if len(results) != len(plan['shards']):
+        problems.append(str(len(plan['shards']) - len(results))+' shards are not done')
+
+    conn = sqlite3.connect(mbtilesFile)
+    metadata = dict(conn.execute('SELECT name, value FROM metadata'))
+    for name, value in plan['metadata'].items():
+        if metadata.get(name) != str(value):
+            problems.append('Metadata '+name+' is '+str(metadata.get(name))+' instead of '+str(value))
+    dangling = conn.execute('SELECT COUNT(*) FROM map WHERE tile_id NOT IN (SELECT tile_id FROM images)').fetchone()[0]
+    if dangling:
+        problems.append(str(dangling)+' tiles have no image')
+    rows = np.array(conn.execute('SELECT zoom_level, tile_column, tile_row FROM map').fetchall(), dtype=np.int64).reshape(-1, 3)
+    conn.close()
+
+    # Zoom levels rendered by the shards have the tiles the shards rendered, and reduced zoom levels have the parent of
+    # every tile of the zoom level above, and the leaves of regions that stop at the zoom level
+    zsplit = plan['zsplit'] if plan['pyramid'] != 'none' else cover.zmin
+    for z in range(cover.zmin, cover.zmax + 1):
+        level = rows[rows[:, 0] == z]
+        keys = np.unique(coverage.tileToKey(level[:, 1], tiles.tmsRow(z, level[:, 2]), z))
+        if z >= zsplit:
+            expected = sum(result['zoomCounts'].get(str(z), 0) for result in results)
+        else:
+            above = rows[rows[:, 0] == z + 1]
+            parents = coverage.tileToKey(above[:, 1] // 2, tiles.tmsRow(z + 1, above[:, 2]) // 2, z)
+            expected = len(np.union1d(parents, keys[np.isin(keys, cover.leaves.get(z, []))]))
+        if len(keys) != expected:
+            problems.append('Zoom level '+str(z)+' has '+str(len(keys))+' tiles instead of '+str(expected))
+        uncovered = len(keys) - int(np.isin(keys, cover.keys[z]).sum())
+        if uncovered:
+            problems.append('Zoom level '+str(z)+' has '+str(uncovered)+' tiles outside the coverage')
+    return(problems)
+
+# Merge the partial mbtiles files of the shards of a plan into the mbtiles file, check it, and move it to the final
+# directory. Shard files are removed once the mbtiles file is complete, and the result files are kept to verify it again
+def mergeShards(planFile, outputDir, finalDir):
+    shardDir = os.path.dirname(os.path.abspath(planFile))
+    plan = readJson(planFile)
+    outputFile = plan['outputFile']
+    results, missing = readResults(planFile, plan)
+    if missing:
+        raise Exception(str(len(missing))+' shards of '+outputFile+' are not done: '+', '.join(missing))
+
+    os.makedirs(outputDir, exist_ok=True)
+    if os.path.exists(outputDir+outputFile):
+        os.remove(outputDir+outputFile)
+    cover = readCoverage(shardDir, plan)
+    writer = mbtiles.MbtilesWriter(outputDir+outputFile, threaded=True)
+    roots = {}
+    with stagemetrics.stage('merge'):
+        for result in results:
+            writer.mergeFile(result['files']['mbtiles'], result['tiles'], remove=False)
+            if plan['pyramid'] != 'none':
+                with np.load(result['files']['roots']) as data:
+                    roots.update(((int(x), int(y)), tile) for (x, y), tile in zip(data['keys'], data['tiles']))
+        if plan['pyramid'] != 'none' and plan['zsplit'] > cover.zmin:
+            geotiff2mbtiles.writeBaseTiles(writer, cover, plan['zsplit'], roots, plan['pyramid'], plan['format'], plan['optimize'],
+                                           plan['inputFile'])
+        writer.setMetadata(plan['metadata'])
+        writer.close()
+
+    with stagemetrics.stage('verify'):
+        problems = verifyMbtiles(outputDir+outputFile, plan, results, cover)
+    if problems:
+        raise Exception('Merged mbtiles file '+outputFile+' is not complete: '+'; '.join(problems))
+    logger.info('Merged and verified '+str(len(results))+' shards into mbtiles file '+outputFile+' with '+str(writer.count)+' tiles')
+
+    os.makedirs(finalDir, exist_ok=True)
+    meshdiff.removeNodes(finalDir+outputFile)
+    with stagemetrics.stage('move'):
+        shutil.move(outputDir+outputFile, finalDir+outputFile)
+    logger.info('Moved mbtiles file to '+Path(finalDir).parts[-1]+' directory.')
+    for result in results:
+        for name in ('mbtiles', 'roots'):
+            if os.path.exists(result['files'][name]):
+                os.remove(result['files'][name])
+
+# Errors exit with a failure, so that the job of a node that fails is retried
+@logger.catch(onerror=lambda _: sys.exit(1))
+def main(args):
+    # Remove old logger and start new one
+    logger.remove()
+    log_path = os.path.join(os.getenv('LOG_PATH', os.path.join(os.path.dirname(__file__), 'logs')), '')
+    logger.add(log_path+'geotiff2shards.log', level='DEBUG')
+    stagemetrics.setProfileDir(args.profileDir)
+
+    if args.action == 'plan':
+        if not (args.inputFile and args.inputDir and args.zlstart and args.zlstop):
+            sys.exit('Planning needs --inputFile, --inputDir, --zlstart and --zlstop')
+        inputDir = os.path.join(args.inputDir, '')
+        if not os.path.exists(inputDir+args.inputFile):
+            logger.info(inputDir+args.inputFile+' does not exist')
+            sys.exit(0 if args.inputFile.startswith('swan') else 1)
+        logger.info('Plan '+str(args.shards)+' shards of zoom levels '+args.zlstart+' to '+args.zlstop+' of tiff file '+args.inputFile)
+        planShards(args.inputFile, inputDir, args.shardDir, args.zlstart, args.zlstop, args.shards, args.pyramid, args.tileFormat, args.optimize,
+                   regions.getRegions(args))
+        product = args.inputFile.split('.')[0]
+    elif args.action == 'run':
+        if not args.shardFile:
+            sys.exit('Running a shard needs --shardFile')
+        runShard(args.shardFile)
+        product = os.path.basename(args.shardFile).split('.')[0]
+    else:
+        if not args.planFile:
+            sys.exit('Merging and verifying need --planFile')
+        product = os.path.basename(args.planFile).split('.')[0]
+        if args.action == 'merge':
+            if not (args.outputDir and args.finalDir):
+                sys.exit('Merging needs --outputDir and --finalDir')
+            mergeShards(args.planFile, os.path.join(args.outputDir, ''), os.path.join(args.finalDir, ''))
+        else:
+            if not args.mbtilesFile:
+                sys.exit('Verifying needs --mbtilesFile')
+            plan = readJson(args.planFile)
+            results, missing = readResults(args.planFile, plan)
+            problems = verifyMbtiles(args.mbtilesFile, plan, results, readCoverage(os.path.dirname(os.path.abspath(args.planFile)), plan))
+            for problem in problems:
+                logger.info(problem)
+            if problems:
+                sys.exit(1)
+            logger.info('Verified mbtiles file '+args.mbtilesFile+' against the '+str(len(results))+' shards of '+args.planFile)
+
+    stagemetrics.writeMetrics(args.metricsFile, args.prometheusFile, {'script': 'geotiff2shards', 'product': product})
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Argument which requires a parameter (eg. -d test)
+    parser.add_argument("action", help="Plan the shards of a tiff (plan), render one shard (run), merge the shards into the mbtiles file (merge), or check a merged mbtiles file (verify)", choices=['plan', 'run', 'merge', 'verify'])
+    parser.add_argument("--inputFILE", "--inputFile", help="Input tiff file name", action="store", dest="inputFile")
+    parser.add_argument("--inputDIR", "--inputDir", help="Input directory path", action="store", dest="inputDir")
+    parser.add_argument("--zlstart", help="Start zoom level", action="store", dest="zlstart")
+    parser.add_argument("--zlstop", help="Stop zoom level", action="store", dest="zlstop")
+    parser.add_argument("--shards", help="Number of shards to plan", action="store", dest="shards", type=int, default=4)
+    parser.add_argument("--shardDIR", "--shardDir", help="Directory path shared by the nodes, holding the plan, descriptors and partial mbtiles files", action="store", dest="shardDir", default='.')
+    parser.add_argument("--shardFILE", "--shardFile", help="Descriptor file path of the shard to run", action="store", dest="shardFile")
+    parser.add_argument("--planFILE", "--planFile", help="Plan file path of the shards to merge or verify", action="store", dest="planFile")
+    parser.add_argument("--outputDIR", "--outputDir", help="Output directory path of the merged mbtiles file", action="store", dest="outputDir")
+    parser.add_argument("--finalDIR", "--finalDir", help="Final directory path of the merged mbtiles file", action="store", dest="finalDir")
+    parser.add_argument("--mbtilesFILE", "--mbtilesFile", help="Merged mbtiles file path to verify", action="store", dest="mbtilesFile")
+    parser.add_argument("--pyramid", help="Read every zoom level from the tiff (none), or build lower zoom levels from the top zoom level with a reduction", action="store", dest="pyramid", choices=('none',) + pyramid.RGBA_REDUCTIONS, default='none')
+    parser.add_argument("--format", help="Tile format", action="store", dest="tileFormat", choices=tileencode.TILE_FORMATS, default='png')
+    parser.add_argument("--optimize", help="Spend more time compressing tiles, for smaller tiles", action="store_true", dest="optimize")
+    regions.addArguments(parser)
+    stagemetrics.addArguments(parser)
+
+    args = parser.parse_args()
+    main(args)
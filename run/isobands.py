@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import numpy as np
+import shapely
+
+# Import local modules
+import tiles, colorramp, vectortile
+
+# Name of the vector tile layer of isobands
+LAYER = 'isobands'
+
+# Pixels of a 256 pixel tile that bands extend beyond the tile, so that band edges are not drawn at tile borders
+BUFFER_PIXELS = 4
+
+# Pixels of a 256 pixel tile within which band outlines are simplified at each zoom level
+SIMPLIFY_PIXELS = 0.5
+
+# Smallest area in pixels of a 256 pixel tile of polygons and holes written to a tile, since smaller ones are not seen
+MIN_AREA_PIXELS = 0.5
+
+# Fields of the isoband features, as listed in the vector_layers metadata
+FIELDS = {'band': 'Number', 'lower': 'Number', 'upper': 'Number', 'color': 'String'}
+
+# Get the upper limits of the bands of a discrete color ramp. A band holds the values above the previous limit, up to and
+# including its limit, like the classes of a discrete QgsColorRampShader, and values above the last limit are not drawn
+def bandLimits(ramp):
+    return(np.unique(np.asarray(ramp['values'], dtype=np.float64)))
+
+# Get the properties of the features of each band, with the color of the band in the lookup table of the ramp
+def bandProperties(limits, lookup):
+    index = colorramp.classify(limits, lookup)
+    properties = []
+    for i, upper in enumerate(limits):
+        red, green, blue = lookup['palette'][index[i]][:3]
+        band = {'band': i, 'upper': float(upper), 'color': '#{:02x}{:02x}{:02x}'.format(red, green, blue)}
+        if i > 0:
+            band['lower'] = float(limits[i - 1])
+        properties.append(band)
+    return(properties)
+
+# Convert longitudes and latitudes to web mercator world coordinates, which go from 0 to 1 over the tile of zoom level 0
+def worldCoords(lon, lat):
+    return(tiles.lonlatToTile(lon, lat, 0))
+
+# Get the world coordinates of a tile, extended by the tile buffer, as xmin, ymin, xmax, ymax
+def tileBox(z, x, y):
+    n = 2 ** z
+    buffer = BUFFER_PIXELS / tiles.TILE_SIZE
+    return(((x - buffer) / n, (y - buffer) / n, (x + 1 + buffer) / n, (y + 1 + buffer) / n))
+
+# Get the parts of triangles with values from lower to upper, as polygons. Values are linear over each triangle, so the
+# part of a triangle is the polygon of its corners in the band, and the points where the band limits cross its edges,
+# in the order they are met going around the triangle
+def bandPieces(px, py, f, lower, upper):
+    '''
+    px, py: world coordinates of the three corners of each triangle, as arrays of shape (n, 3)
+    f: values of the three corners of each triangle, as an array of shape (n, 3)
+    '''
+    slots = []
+    for k in range(3):
+        a, b = k, (k + 1) % 3
+        fa, fb = f[:, a], f[:, b]
+        slots.append((px[:, a], py[:, a], (fa >= lower) & (fa <= upper)))
+
+        # Going from a to b, the lower limit is crossed first when the values rise
+        with np.errstate(divide='ignore', invalid='ignore'):
+            levels = [np.where(fa < fb, lower, upper), np.where(fa < fb, upper, lower)]
+            for level in levels:
+                t = (level - fa) / (fb - fa)
+                slots.append((px[:, a] + t * (px[:, b] - px[:, a]), py[:, a] + t * (py[:, b] - py[:, a]), (t > 0) & (t < 1)))
+
+    sx = np.stack([slot[0] for slot in slots], axis=1)
+    sy = np.stack([slot[1] for slot in slots], axis=1)
+    valid = np.stack([slot[2] for slot in slots], axis=1)
+
+    # Keep triangles whose parts have at least three points, as rings of their points in order
+    valid &= (valid.sum(axis=1) >= 3)[:, None]
+    rows = np.nonzero(valid)[0]
+    if len(rows) == 0:
+        return(np.zeros(0, dtype=object))
+    rings = shapely.linearrings(np.stack((sx[valid], sy[valid]), axis=1), indices=rows)
+    return(shapely.polygons(rings))
+
+# Simplify band geometry for a zoom level
+def simplifyBand(geometry, z):
+    return(shapely.simplify(geometry, SIMPLIFY_PIXELS / tiles.TILE_SIZE / 2 ** z, preserve_topology=True))
+
+# Compute the bands of the wet triangles of a mesh over a tile, clipped to the tile buffer and simplified for the zoom level
+# of the tile. Returns the zoom level and the geometry of each band that is not empty, or None if no band is
+def renderBands(mesh, values, wx, wy, limits, z, x, y):
+    xmin, ymin, xmax, ymax = tileBox(z, x, y)
+    west, north = tiles.tileToLonlat(x - BUFFER_PIXELS / tiles.TILE_SIZE, y - BUFFER_PIXELS / tiles.TILE_SIZE, z)
+    east, south = tiles.tileToLonlat(x + 1 + BUFFER_PIXELS / tiles.TILE_SIZE, y + 1 + BUFFER_PIXELS / tiles.TILE_SIZE, z)
+    tri = mesh.tri[mesh.trianglesIn(west, south, east, north)]
+    tri = tri[np.isfinite(values[tri]).all(axis=1)]
+    if len(tri) == 0:
+        return(None)
+
+    f = values[tri]
+    px, py = wx[tri], wy[tri]
+    fmin, fmax = f.min(axis=1), f.max(axis=1)
+    box = shapely.box(xmin, ymin, xmax, ymax)
+    bands = {}
+    for i, upper in enumerate(limits):
+        lower = limits[i - 1] if i > 0 else -np.inf
+        inBand = (fmax > lower) & (fmin <= upper)
+        if not inBand.any():
+            continue
+        pieces = bandPieces(px[inBand], py[inBand], f[inBand], lower, upper)
+        geometry = simplifyBand(shapely.intersection(shapely.union_all(pieces), box), z)
+        if not geometry.is_empty:
+            bands[i] = geometry
+    return({'zoom': z, 'bands': bands} if bands else None)
+
+# Reduce the bands of four child tiles to their parent tile, by joining the bands of the children and simplifying them for
+# the zoom level of the parent
+def reduceBands(childTiles):
+    children = [tile for tile in childTiles if tile is not None]
+    if not children:
+        return(None)
+
+    z = children[0]['zoom'] - 1
+    bands = {}
+    for i in sorted(set().union(*[tile['bands'] for tile in children])):
+        geometry = simplifyBand(shapely.union_all([tile['bands'][i] for tile in children if i in tile['bands']]), z)
+        if not geometry.is_empty:
+            bands[i] = geometry
+    return({'zoom': z, 'bands': bands} if bands else None)
+
+# Get the polygons of a geometry, leaving out the points and lines that clipping can leave
+def polygonParts(geometry):
+    polygons = []
+    for part in shapely.get_parts(geometry):
+        if part.geom_type == 'Polygon':
+            polygons.append(part)
+        elif part.geom_type in ('MultiPolygon', 'GeometryCollection'):
+            polygons += polygonParts(part)
+    return(polygons)
+
+# Get the rings of polygons in tile coordinates, as the coords, counts and outer arguments of vectortile.encodeRings,
+# leaving out polygons and holes smaller than minArea
+def tileRings(polygons, minArea):
+    polygons = polygons[shapely.area(polygons) >= minArea]
+    interiors = shapely.get_num_interior_rings(polygons)
+    rings = shapely.get_rings(polygons)
+    outer = np.zeros(len(rings), dtype=bool)
+    outer[np.cumsum(interiors + 1) - interiors - 1] = True
+    keep = outer | (shapely.area(shapely.polygons(rings)) >= minArea)
+    rings, outer = rings[keep], outer[keep]
+
+    # Leave out the closing point of each ring
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    counts = np.bincount(index, minlength=len(rings)) - 1
+    coords = np.delete(coords, np.cumsum(counts + 1) - 1, axis=0)
+    return(np.round(coords), counts, outer)
+
+# Encode the bands of a tile as a gzip compressed vector tile, with one feature per band, clipped to the tile buffer.
+# Returns None if no band has polygons left in tile coordinates
+def encodeBands(tile, properties, z, x, y):
+    n = 2 ** z
+    box = shapely.box(*tileBox(z, x, y))
+    minArea = MIN_AREA_PIXELS * (vectortile.EXTENT / tiles.TILE_SIZE) ** 2
+    features = []
+    for i, geometry in sorted(tile['bands'].items()):
+        # Snap to integer tile coordinates, keeping polygons valid
+        geometry = shapely.transform(shapely.intersection(geometry, box), lambda coords: (coords * n - [x, y]) * vectortile.EXTENT)
+        polygons = np.array(polygonParts(shapely.set_precision(geometry, 1.0)), dtype=object)
+        if len(polygons):
+            features.append((tileRings(polygons, minArea), properties[i]))
+    return(vectortile.encodeTile([vectortile.encodeLayer(LAYER, features)]))
+
+# Get the vector_layers metadata of an mbtiles file of isobands
+def vectorLayers(minzoom, maxzoom):
+    return({'vector_layers': [{'id': LAYER, 'description': 'Filled contour bands of the discrete color ramp', 'fields': FIELDS,
+                               'minzoom': minzoom, 'maxzoom': maxzoom}]})
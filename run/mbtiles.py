@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, sqlite3, hashlib, queue, threading
+from loguru import logger
+
+# Import local modules
+import tiles
+
+# Number of tiles inserted in one transaction
+BATCH_SIZE = 5000
+
+# Number of batches of tiles that wait for the writer thread of a threaded writer
+QUEUE_BATCHES = 4
+
+# SQLite settings for writing a new file in one pass. The file is not usable if the writer crashes, in which case it is
+# written again from the start
+PRAGMAS = ['PRAGMA page_size = 65536', 'PRAGMA journal_mode = OFF', 'PRAGMA synchronous = OFF',
+           'PRAGMA locking_mode = EXCLUSIVE', 'PRAGMA temp_store = MEMORY', 'PRAGMA cache_size = -262144']
+
+# Normalized MBTiles schema, where map rows point to images stored once per distinct tile content
+SCHEMA = ['CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)',
+          'CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)',
+          'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT)',
+          'CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)',
+          'CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT)',
+          'CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)',
+          'CREATE VIEW IF NOT EXISTS tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column, '
+          'map.tile_row AS tile_row, images.tile_data AS tile_data FROM map JOIN images ON images.tile_id = map.tile_id']
+
+# Get the id of a tile from a hash of its content
+def tileId(data):
+    return(hashlib.md5(data).hexdigest())
+
+# Writes tiles and metadata to an MBTiles file, storing identical tiles once. A threaded writer inserts batches of tiles in
+# a writer thread, so that the next tiles are rendered and encoded while earlier batches are written
+class MbtilesWriter:
+    def __init__(self, filename, batchSize=BATCH_SIZE, threaded=False):
+        self.filename = filename
+        self.batchSize = batchSize
+        self.count = 0
+        self.removed = 0
+        self.merged = 0
+        self.bytes = 0
+        self.images = set()
+        self.mapRows = []
+        self.imageRows = []
+        self.removeRows = []
+        self.error = None
+        self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+
+        # Batches wait in a bounded queue, so that a slow disk holds back rendering instead of filling memory
+        self.queue = None
+        if threaded:
+            self.queue = queue.Queue(QUEUE_BATCHES)
+            self.thread = threading.Thread(target=self.writeBatches, daemon=True)
+            self.thread.start()
+
+    # Add an XYZ tile
+    def addTile(self, z, x, y, data):
+        tid = tileId(data)
+        if tid not in self.images:
+            self.images.add(tid)
+            self.imageRows.append((sqlite3.Binary(data), tid))
+            self.bytes += len(data)
+        self.mapRows.append((z, x, tiles.tmsRow(z, y), tid))
+        self.count += 1
+        if len(self.mapRows) >= self.batchSize:
+            self.flush()
+
+    # Remove an XYZ tile, such as a tile of an existing file that no longer has data
+    def removeTile(self, z, x, y):
+        self.removeRows.append((z, x, tiles.tmsRow(z, y)))
+        self.removed += 1
+        if len(self.removeRows) >= self.batchSize:
+            self.flush()
+
+    # Run a function on the file, in the writer thread if there is one. Errors of the writer thread are raised here
+    def submit(self, function, *args):
+        if self.error is not None:
+            raise self.error
+        if self.queue is None:
+            function(*args)
+        else:
+            self.queue.put((function, args))
+
+    # Run functions from the queue in the writer thread, until close
+    def writeBatches(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    item[0](*item[1])
+                except Exception as e:
+                    self.error = e
+
+    # Insert buffered tiles, and delete removed tiles, in one transaction
+    def flush(self):
+        if not self.mapRows and not self.removeRows:
+            return
+        self.submit(self.writeRows, self.mapRows, self.imageRows, self.removeRows)
+        self.mapRows = []
+        self.imageRows = []
+        self.removeRows = []
+
+    # Write a batch of tiles
+    def writeRows(self, mapRows, imageRows, removeRows):
+        self.conn.execute('BEGIN')
+        self.conn.executemany('DELETE FROM map WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', removeRows)
+        self.conn.executemany('INSERT OR IGNORE INTO images VALUES (?, ?)', imageRows)
+        self.conn.executemany('INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)', mapRows)
+        self.conn.execute('COMMIT')
+
+    # Merge the tiles of another mbtiles file written with this schema, such as a shard, and remove the file unless remove is
+    # False. Tiles of the file are counted with count, since they are merged in the writer thread
+    def mergeFile(self, filename, count=0, remove=True):
+        self.flush()
+        self.submit(self.mergeRows, filename, remove)
+        self.count += count
+        self.merged += 1
+
+    # Copy the images and tiles of another mbtiles file in one transaction
+    def mergeRows(self, filename, remove):
+        self.conn.execute('ATTACH DATABASE ? AS merged', (filename,))
+        self.conn.execute('BEGIN')
+        self.conn.execute('INSERT OR IGNORE INTO images (tile_data, tile_id) SELECT tile_data, tile_id FROM merged.images')
+        self.conn.execute('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) '
+                          'SELECT zoom_level, tile_column, tile_row, tile_id FROM merged.map')
+        self.conn.execute('COMMIT')
+        self.conn.execute('DETACH DATABASE merged')
+        if remove:
+            os.remove(filename)
+
+    # Delete images that no tile uses any more, after tiles of an existing file have been replaced or removed
+    def pruneImages(self):
+        self.flush()
+        self.submit(self.deleteUnusedImages)
+
+    # Delete images that no tile uses
+    def deleteUnusedImages(self):
+        self.conn.execute('BEGIN')
+        pruned = self.conn.execute('DELETE FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)').rowcount
+        self.conn.execute('COMMIT')
+        logger.info('Deleted '+str(pruned)+' unused images from '+self.filename)
+
+    # Set metadata values
+    def setMetadata(self, metadata):
+        self.flush()
+        self.submit(self.writeMetadata, [(name, str(value)) for name, value in metadata.items()])
+
+    # Write metadata rows
+    def writeMetadata(self, rows):
+        self.conn.execute('BEGIN')
+        self.conn.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', rows)
+        self.conn.execute('COMMIT')
+
+    # Write remaining tiles, wait for the writer thread, and close the file
+    def close(self):
+        self.flush()
+        if self.queue is not None:
+            self.queue.put(None)
+            self.thread.join()
+        self.conn.close()
+        if self.error is not None:
+            raise self.error
+        logger.info('Wrote '+str(self.count)+' tiles, with '+str(len(self.images))+' distinct images of '+str(self.bytes)+' bytes, to '+self.filename)
+        if self.merged:
+            logger.info('Merged tiles of '+str(self.merged)+' files into '+self.filename)
+        if self.removed:
+            logger.info('Removed '+str(self.removed)+' tiles from '+self.filename)
+
+# Get MBTiles metadata of a tile set
+def tileMetadata(name, tileFormat, west, south, east, north, minzoom, maxzoom, description=''):
+    return({'name': name, 'type': 'overlay', 'version': '1.1', 'format': tileFormat, 'description': description,
+            'bounds': ','.join(str(v) for v in (west, max(south, -tiles.MAX_LATITUDE), east, min(north, tiles.MAX_LATITUDE))),
+            'center': ','.join(str(v) for v in ((west + east) / 2, (south + north) / 2, minzoom)),
+            'minzoom': minzoom, 'maxzoom': maxzoom})
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, json, fcntl, hashlib, shutil, tempfile, contextlib, collections
+import numpy as np
+from loguru import logger
+
+# Import local modules
+import meshregrid
+
+# Name of the file mapping netCDF files to the fingerprint of their grid
+FILES_INDEX = 'files.json'
+
+# Compute the fingerprint of a grid from its node and element arrays
+def gridFingerprint(x, y, tri):
+    sha = hashlib.sha1()
+    for array in (x, y, tri):
+        sha.update(str(array.shape).encode())
+        sha.update(np.ascontiguousarray(array).tobytes())
+    return(sha.hexdigest())
+
+# Get key identifying the contents of a netCDF file from its path, size and modification time
+def fileKey(inputFile):
+    stat = os.stat(inputFile)
+    return(os.path.abspath(inputFile)+'|'+str(stat.st_size)+'|'+str(stat.st_mtime_ns))
+
+# Read the index of netCDF files that have been cached
+def readFilesIndex(cacheDir):
+    try:
+        with open(os.path.join(cacheDir, FILES_INDEX)) as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+# Hold an exclusive lock on an index of a cache directory while it is read and replaced, so that processes sharing the
+# cache do not drop the entries that other processes add. Readers do not lock, since the index is replaced by a rename
+@contextlib.contextmanager
+def lockIndex(cacheDir, indexName):
+    fd = os.open(os.path.join(cacheDir, indexName+'.lock'), os.O_RDONLY | os.O_CREAT, 0o644)
+    try:
+        # The lock file is opened by other users sharing the cache, which only its owner can allow
+        try:
+            os.fchmod(fd, 0o644)
+        except OSError:
+            pass
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+# Add a netCDF file to the index of cached files
+def writeFilesIndex(cacheDir, inputFile, fingerprint):
+    with lockIndex(cacheDir, FILES_INDEX):
+        files = readFilesIndex(cacheDir)
+        files[fileKey(inputFile)] = fingerprint
+        fd, tmpFile = tempfile.mkstemp(dir=cacheDir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(files, f)
+        os.chmod(tmpFile, 0o644)
+        os.replace(tmpFile, os.path.join(cacheDir, FILES_INDEX))
+
+# Map cached mesh geometry into memory
+def readGeometry(cacheDir, fingerprint):
+    gridDir = os.path.join(cacheDir, fingerprint)
+    if not os.path.exists(os.path.join(gridDir, 'binTris.npy')):
+        return(None)
+
+    arrays = [np.load(os.path.join(gridDir, name+'.npy'), mmap_mode='r') for name in meshregrid.MeshGeometry.names]
+    return(meshregrid.MeshGeometry(*arrays))
+
+# Write mesh geometry to the cache. The arrays are written to a temporary directory that is then renamed,
+# so other processes never map a partly written geometry
+def writeGeometry(cacheDir, fingerprint, mesh):
+    gridDir = os.path.join(cacheDir, fingerprint)
+    tmpDir = tempfile.mkdtemp(dir=cacheDir)
+    for name, array in mesh.arrays().items():
+        np.save(os.path.join(tmpDir, name+'.npy'), array)
+    os.chmod(tmpDir, 0o755)
+
+    try:
+        os.rename(tmpDir, gridDir)
+        logger.info('Cached mesh geometry in '+gridDir)
+    except OSError:
+        # Another process cached the same grid first
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+# Load mesh geometry of a netCDF file, using the cache when it already holds the grid. Returns the mesh geometry and the
+# fingerprint of its grid
+def loadMeshFingerprint(inputFile, cacheDir):
+    os.makedirs(cacheDir, exist_ok=True)
+
+    # Files that have been cached before are mapped without reading the netCDF file
+    fingerprint = readFilesIndex(cacheDir).get(fileKey(inputFile))
+    mesh = readGeometry(cacheDir, fingerprint) if fingerprint else None
+    if mesh is not None:
+        logger.info('Mapped cached mesh geometry '+fingerprint+' for '+inputFile)
+        return(mesh, fingerprint)
+
+    # Other files on the same grid only need the grid arrays read to find the fingerprint
+    x, y, tri = meshregrid.readMesh(inputFile)
+    fingerprint = gridFingerprint(x, y, tri)
+    mesh = readGeometry(cacheDir, fingerprint)
+    if mesh is not None:
+        logger.info('Mapped cached mesh geometry '+fingerprint+' for '+inputFile)
+    else:
+        logger.info('Index mesh triangles')
+        writeGeometry(cacheDir, fingerprint, meshregrid.MeshGeometry(x, y, tri))
+        mesh = readGeometry(cacheDir, fingerprint)
+
+    writeFilesIndex(cacheDir, inputFile, fingerprint)
+    return(mesh, fingerprint)
+
+# Load mesh geometry of a netCDF file, using the cache when it already holds the grid
+def loadMesh(inputFile, cacheDir):
+    mesh, _ = loadMeshFingerprint(inputFile, cacheDir)
+    return(mesh)
+
+# Meshes loaded by one process, so that files on the same grid share one mesh geometry. When maxMeshes is set, only that
+# many of the most recently used meshes are kept
+class LoadedMeshes:
+    def __init__(self, maxMeshes=None):
+        self.maxMeshes = maxMeshes
+        self.meshes = collections.OrderedDict()
+        self.files = {}
+
+    # Get the mesh geometry of a netCDF file, loading it only if no earlier file had the same grid
+    def get(self, inputFile, cacheDir=None):
+        key = fileKey(inputFile)
+        if self.files.get(key) in self.meshes:
+            self.meshes.move_to_end(self.files[key])
+            return(self.meshes[self.files[key]])
+
+        if cacheDir:
+            # Files cached before give the fingerprint of their grid without loading it, and other files on a loaded grid
+            # give it once they are cached
+            fingerprint = readFilesIndex(cacheDir).get(key)
+            mesh = self.meshes.get(fingerprint)
+            if mesh is None:
+                # The fingerprint comes from loading, since other processes can replace the index in the meantime
+                loaded, fingerprint = loadMeshFingerprint(inputFile, cacheDir)
+                mesh = self.meshes.get(fingerprint, loaded)
+            if fingerprint in self.meshes:
+                logger.info('Reused loaded mesh geometry '+fingerprint+' for '+inputFile)
+        else:
+            x, y, tri = meshregrid.readMesh(inputFile)
+            fingerprint = gridFingerprint(x, y, tri)
+            mesh = self.meshes.get(fingerprint)
+            if mesh is None:
+                logger.info('Index mesh triangles')
+                mesh = meshregrid.MeshGeometry(x, y, tri)
+            else:
+                logger.info('Reused loaded mesh geometry '+fingerprint+' for '+inputFile)
+
+        self.meshes[fingerprint] = mesh
+        self.meshes.move_to_end(fingerprint)
+        self.files[key] = fingerprint
+
+        # Drop the least recently used meshes, and the files on their grids
+        while self.maxMeshes and len(self.meshes) > self.maxMeshes:
+            dropped, _ = self.meshes.popitem(last=False)
+            self.files = {k: f for k, f in self.files.items() if f != dropped}
+            logger.info('Dropped loaded mesh geometry '+dropped)
+
+        return(mesh)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, json, tempfile
+import numpy as np
+from loguru import logger
+
+# Get the file holding the node values an mbtiles file was rendered from, which is kept next to the mbtiles file
+def nodesFile(mbtilesFile):
+    return(mbtilesFile+'.nodes.npz')
+
+# Get the size and modification time of an mbtiles file, which tell if it was written again after its node values were
+def fileStamp(mbtilesFile):
+    info = os.stat(mbtilesFile)
+    return(np.array([info.st_size, info.st_mtime_ns], dtype=np.int64))
+
+# Write the node values an mbtiles file was rendered from, with the fingerprint of their grid, the lookup table of their
+# colors, the parameters of the tiles, and the size and modification time of the mbtiles file. The file is written to a
+# temporary file that is then renamed
+def writeNodes(mbtilesFile, fingerprint, values, lookup, parameters):
+    filename = nodesFile(mbtilesFile)
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpFile = tempfile.mkstemp(dir=directory, suffix='.npz')
+    lookupValues, palette = lookupArrays(lookup)
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, values=values, fingerprint=fingerprint, lookupValues=lookupValues, palette=palette,
+                 parameters=json.dumps(parameters, sort_keys=True), stamp=fileStamp(mbtilesFile))
+    os.chmod(tmpFile, 0o644)
+    os.replace(tmpFile, filename)
+    logger.info('Wrote node values of the tiles to '+filename)
+
+# Remove the node values kept next to an mbtiles file, when the mbtiles file is written without them, so that they are not
+# taken for the node values of its tiles
+def removeNodes(mbtilesFile):
+    filename = nodesFile(mbtilesFile)
+    if os.path.exists(filename):
+        os.remove(filename)
+        logger.info('Removed node values '+filename+' of the previous mbtiles file')
+
+# Get the values and palette of a lookup table, which are empty for value encoded tiles, whose pixels do not depend on colors
+def lookupArrays(lookup):
+    if lookup is None:
+        return(np.zeros(0), np.zeros((0, 4), dtype=np.uint8))
+    return(lookup['values'], lookup['palette'])
+
+# Read the node values an mbtiles file was rendered from, returning None if the file does not exist or can not be read
+def readNodes(filename):
+    try:
+        with np.load(filename) as data:
+            return({name: data[name] for name in data.files})
+    except (OSError, ValueError, KeyError):
+        return(None)
+
+# Get the node values of the previous mbtiles file, if its tiles can be updated with new node values. They can be when the
+# new values are on the same grid, and are colored and tiled the same way, so that tiles over unchanged nodes are the same
+def previousValues(mbtilesFile, fingerprint, values, lookup, parameters):
+    if not os.path.exists(mbtilesFile):
+        logger.info('No previous mbtiles file '+mbtilesFile+' to update')
+        return(None)
+    previous = readNodes(nodesFile(mbtilesFile))
+    if previous is None:
+        logger.info('No node values of the previous mbtiles file '+mbtilesFile+' to update')
+        return(None)
+
+    # Check in order of cost
+    lookupValues, palette = lookupArrays(lookup)
+    if 'stamp' not in previous or not np.array_equal(previous['stamp'], fileStamp(mbtilesFile)):
+        reason = 'it was written again without its node values'
+    elif str(previous['fingerprint']) != fingerprint or previous['values'].shape != values.shape:
+        reason = 'the grid changed'
+    elif str(previous['parameters']) != json.dumps(parameters, sort_keys=True):
+        reason = 'the tile parameters changed'
+    elif not (np.array_equal(previous['lookupValues'], lookupValues) and np.array_equal(previous['palette'], palette)):
+        reason = 'the colors changed'
+    else:
+        return(previous['values'])
+
+    logger.info('Can not update the previous mbtiles file '+mbtilesFile+', since '+reason)
+    return(None)
+
+# Get the nodes whose values changed, where a node that stays dry is unchanged
+def changedNodes(previous, values):
+    changed = ~((previous == values) | (np.isnan(previous) & np.isnan(values)))
+    logger.info(str(int(changed.sum()))+' of '+str(len(values))+' node values changed')
+    return(changed)
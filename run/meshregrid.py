@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import multiprocessing as mp
+import numpy as np
+import netCDF4 as nc
+from loguru import logger
+
+# ADCIRC netCDF variable holding the node values of each product
+MESH_VARIABLES = {'maxele': 'zeta_max', 'maxwvel': 'wind_max', 'swan_HS_max': 'swan_HS_max'}
+
+# ADCIRC netCDF variables holding the node values of each time series file, by file number. Files with two variables hold
+# vector components, whose magnitude is regridded
+TIMESERIES_VARIABLES = {'63': ('zeta',), '64': ('u-vel', 'v-vel'), '73': ('pressure',), '74': ('windx', 'windy')}
+
+# Mesh variables that are never regridded
+MESH_COORDINATES = ('x', 'y', 'depth', 'element', 'neta', 'nvel', 'nbdv', 'nvell', 'ibtype', 'nbvv')
+
+# Maximum number of candidate pixels tested at once, which bounds the memory used by the rasterizer
+CHUNK_PIXELS = 1000000
+
+# Approximate bytes used by the rasterizer per candidate pixel
+CHUNK_BYTES_PER_PIXEL = 120
+
+# Mesh and grid arrays of a regrid worker process, backed by shared memory
+sharedArrays = {}
+
+# Read node coordinates and element table of an ADCIRC mesh from a netCDF file
+def readMesh(inputFile):
+    logger.info('Read mesh geometry from '+inputFile)
+    ds = nc.Dataset(inputFile)
+    x = np.ma.getdata(ds.variables['x'][:]).astype(np.float64)
+    y = np.ma.getdata(ds.variables['y'][:]).astype(np.float64)
+
+    # ADCIRC element numbers are 1 based
+    tri = np.ma.getdata(ds.variables['element'][:]).astype(np.int64) - 1
+    ds.close()
+
+    return(x, y, tri)
+
+# Mesh geometry, with triangle bounding boxes and a spatial bin index of the triangles
+class MeshGeometry:
+    '''
+    x, y: node coordinates
+    tri: (n, 3) array of 0 based node indices
+    bbox: (n, 4) array of triangle xmin, ymin, xmax, ymax
+    binGrid: xmin, ymin, bin size, number of bin columns and rows of the bin index
+    binStart, binTris: triangles of bin i are binTris[binStart[i]:binStart[i+1]]
+    '''
+    names = ('x', 'y', 'tri', 'bbox', 'binGrid', 'binStart', 'binTris')
+
+    def __init__(self, x, y, tri, bbox=None, binGrid=None, binStart=None, binTris=None):
+        self.x = x
+        self.y = y
+        self.tri = tri
+        self.bbox = triangleBoxes(x, y, tri) if bbox is None else bbox
+        if binGrid is None:
+            binGrid, binStart, binTris = buildBinIndex(x, y, self.bbox)
+        self.binGrid = binGrid
+        self.binStart = binStart
+        self.binTris = binTris
+
+    # Get the arrays of the geometry by name
+    def arrays(self):
+        return(dict((name, getattr(self, name)) for name in self.names))
+
+    # Get the extent of the mesh as xmin, xmax, ymin, ymax
+    def extent(self):
+        return(self.x.min(), self.x.max(), self.y.min(), self.y.max())
+
+    # Get indices of triangles whose bounding box overlaps a rectangle
+    def trianglesIn(self, xmin, ymin, xmax, ymax):
+        c0, r0 = binIndex(self.binGrid, xmin, ymin)
+        c1, r1 = binIndex(self.binGrid, xmax, ymax)
+        ncols = int(self.binGrid[3])
+        index = np.unique(np.concatenate([self.binTris[self.binStart[r * ncols + c0]:self.binStart[r * ncols + c1 + 1]]
+                for r in range(r0, r1 + 1)] + [np.zeros(0, dtype=np.int64)]))
+        box = self.bbox[index]
+        return(index[(box[:, 0] <= xmax) & (box[:, 2] >= xmin) & (box[:, 1] <= ymax) & (box[:, 3] >= ymin)])
+
+# Read an ADCIRC mesh from a netCDF file, and index its triangles
+def loadMesh(inputFile):
+    x, y, tri = readMesh(inputFile)
+    logger.info('Index mesh triangles')
+    return(MeshGeometry(x, y, tri))
+
+# Get bounding boxes of triangles
+def triangleBoxes(x, y, tri):
+    tx = x[tri]
+    ty = y[tri]
+    return(np.stack((tx.min(axis=1), ty.min(axis=1), tx.max(axis=1), ty.max(axis=1)), axis=1))
+
+# Get the column and row of the bin holding a point, clipped to the bin grid
+def binIndex(binGrid, px, py):
+    col = np.clip(np.floor((np.asarray(px) - binGrid[0]) / binGrid[2]).astype(np.int64), 0, int(binGrid[3]) - 1)
+    row = np.clip(np.floor((np.asarray(py) - binGrid[1]) / binGrid[2]).astype(np.int64), 0, int(binGrid[4]) - 1)
+    return(col, row)
+
+# Build a uniform grid of bins, listing the triangles whose bounding box overlaps each bin
+def buildBinIndex(x, y, bbox, trianglesPerBin=8):
+    xmin, ymin = x.min(), y.min()
+    width = max(x.max() - xmin, 1e-9)
+    height = max(y.max() - ymin, 1e-9)
+    binsize = np.sqrt(width * height * trianglesPerBin / max(len(bbox), 1))
+    binGrid = np.array([xmin, ymin, binsize, int(width // binsize) + 1, int(height // binsize) + 1])
+
+    # Expand each triangle into the bins overlapped by its bounding box
+    c0, r0 = binIndex(binGrid, bbox[:, 0], bbox[:, 1])
+    c1, r1 = binIndex(binGrid, bbox[:, 2], bbox[:, 3])
+    ncols = c1 - c0 + 1
+    counts = ncols * (r1 - r0 + 1)
+    t = np.repeat(np.arange(len(bbox)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    bins = (r0[t] + local // ncols[t]) * int(binGrid[3]) + c0[t] + local % ncols[t]
+
+    # Sort triangles by bin
+    order = np.argsort(bins, kind='stable')
+    binTris = t[order]
+    binStart = np.zeros(int(binGrid[3] * binGrid[4]) + 1, dtype=np.int64)
+    binStart[1:] = np.cumsum(np.bincount(bins, minlength=len(binStart) - 1))
+
+    return(binGrid, binStart, binTris)
+
+# Get the name of the variable to regrid from a netCDF file
+def getVariableName(ds, product):
+    if product in MESH_VARIABLES and MESH_VARIABLES[product] in ds.variables:
+        return(MESH_VARIABLES[product])
+
+    # Fall back to the first node variable that is not part of the mesh geometry
+    for name, var in ds.variables.items():
+        if name in MESH_COORDINATES or name.startswith('time_of'):
+            continue
+        if len(var.dimensions) > 0 and var.dimensions[-1] == 'node':
+            return(name)
+
+    raise Exception('No node variable found for '+product)
+
+# Read node values of a product, with masked (dry) nodes set to NaN
+def readValues(inputFile, product, timestep=0):
+    ds = nc.Dataset(inputFile)
+    name = getVariableName(ds, product)
+    logger.info('Read node values of '+name+' from '+inputFile)
+    var = ds.variables[name]
+    if len(var.dimensions) > 1:
+        data = var[timestep, :]
+    else:
+        data = var[:]
+    ds.close()
+
+    return(np.ma.filled(np.ma.asarray(data).astype(np.float64), np.nan))
+
+# Get the number of timesteps of a time series variable
+def readTimesteps(inputFile, name):
+    ds = nc.Dataset(inputFile)
+    count = ds.variables[name].shape[0]
+    ds.close()
+    return(count)
+
+# Yield node values of a range of timesteps, a chunk of timesteps at a time, with masked (dry) nodes set to NaN, so that
+# the whole variable is never in memory. Vector components are combined into their magnitude
+def readValueChunks(inputFile, names, timesteps, chunk=24):
+    ds = nc.Dataset(inputFile)
+    try:
+        for start in range(0, len(timesteps), chunk):
+            steps = timesteps[start:start + chunk]
+            components = [np.ma.filled(np.ma.asarray(ds.variables[name][steps.start:steps.stop:steps.step, :]).astype(np.float64), np.nan)
+                          for name in names]
+            values = components[0] if len(components) == 1 else np.sqrt(sum(component ** 2 for component in components))
+            yield(list(steps), values)
+    finally:
+        ds.close()
+
+# Get pixel center coordinates of a raster, with rows ordered from north to south
+def pixelCenters(xmin, ymin, xmax, ymax, width, height):
+    xres = (xmax - xmin)/width
+    yres = (ymax - ymin)/height
+    xs = xmin + (np.arange(width) + 0.5) * xres
+    ys = ymax - (np.arange(height) + 0.5) * yres
+    return(xs, ys)
+
+# Yield chunks of pixel indices, triangle node indices and barycentric weights for all pixel centers inside a triangle
+def iterTriangleWeights(x, y, tri, xs, ys, chunkPixels=CHUNK_PIXELS):
+    '''
+    Rasterizes the triangles of a mesh onto a separable grid.
+    x, y: node coordinates
+    tri: (n, 3) array of 0 based node indices
+    xs: increasing pixel center x coordinates of the grid columns
+    ys: decreasing pixel center y coordinates of the grid rows
+    Yields: flat pixel indices (row * len(xs) + col), (k, 3) node indices, and (k, 3) weights
+    '''
+    width = len(xs)
+    height = len(ys)
+    ysasc = ys[::-1]
+
+    x1 = x[tri[:, 0]]
+    y1 = y[tri[:, 0]]
+    x2 = x[tri[:, 1]]
+    y2 = y[tri[:, 1]]
+    x3 = x[tri[:, 2]]
+    y3 = y[tri[:, 2]]
+
+    # Find the range of pixel columns and rows covered by the bounding box of each triangle
+    c0 = np.searchsorted(xs, np.minimum(np.minimum(x1, x2), x3), 'left')
+    c1 = np.searchsorted(xs, np.maximum(np.maximum(x1, x2), x3), 'right')
+    a0 = np.searchsorted(ysasc, np.minimum(np.minimum(y1, y2), y3), 'left')
+    a1 = np.searchsorted(ysasc, np.maximum(np.maximum(y1, y2), y3), 'right')
+    ncols = c1 - c0
+    nrows = a1 - a0
+
+    # Skip triangles without pixel centers and degenerate triangles
+    det = (y2 - y3) * (x1 - x3) + (x3 - x2) * (y1 - y3)
+    index = np.nonzero((ncols > 0) & (nrows > 0) & (det != 0))[0]
+    if len(index) == 0:
+        return
+
+    counts = ncols[index] * nrows[index]
+    cum = np.cumsum(counts)
+
+    # Test candidate pixels of as many triangles as fit in a chunk
+    start = 0
+    while start < len(index):
+        limit = (cum[start-1] if start > 0 else 0) + chunkPixels
+        stop = max(int(np.searchsorted(cum, limit, 'right')), start + 1)
+        tidx = index[start:stop]
+        tcounts = counts[start:stop]
+        start = stop
+
+        # Expand each triangle into its candidate pixels
+        total = int(tcounts.sum())
+        rep = np.repeat(np.arange(len(tidx)), tcounts)
+        local = np.arange(total) - np.repeat(np.cumsum(tcounts) - tcounts, tcounts)
+        t = tidx[rep]
+        col = c0[t] + local % ncols[t]
+        arow = a0[t] + local // ncols[t]
+        px = xs[col]
+        py = ysasc[arow]
+
+        # Compute barycentric coordinates and keep pixels inside the triangle
+        l1 = ((y2[t] - y3[t]) * (px - x3[t]) + (x3[t] - x2[t]) * (py - y3[t])) / det[t]
+        l2 = ((y3[t] - y1[t]) * (px - x3[t]) + (x1[t] - x3[t]) * (py - y3[t])) / det[t]
+        l3 = 1.0 - l1 - l2
+        inside = (l1 >= -1e-12) & (l2 >= -1e-12) & (l3 >= -1e-12)
+
+        pix = (height - 1 - arow[inside]) * width + col[inside]
+        nodes = tri[t[inside]]
+        weights = np.stack((l1[inside], l2[inside], l3[inside]), axis=1)
+
+        yield(pix, nodes, weights)
+
+# Regrid node values onto a grid, returning a (len(ys), len(xs)) array with NaN outside the mesh
+def regridGrid(x, y, tri, values, xs, ys, dtype=np.float64):
+    block = np.full(len(ys) * len(xs), np.nan, dtype=dtype)
+    for pix, nodes, weights in iterTriangleWeights(x, y, tri, xs, ys):
+        vals = (values[nodes] * weights).sum(axis=1)
+        valid = np.isfinite(vals)
+        block[pix[valid]] = vals[valid]
+
+    return(block.reshape(len(ys), len(xs)))
+
+# Interpolation weights of the pixels of a grid that are inside a triangle, with the three nodes and barycentric weights
+# of each pixel, like the rows of a sparse matrix in ELLPACK form. Regridding the values of a timestep is then a gather of
+# node values and a weighted sum, without finding the triangles of the pixels again
+class RegridWeights:
+    def __init__(self, pix, nodes, weights, shape):
+        '''
+        pix: flat pixel indices, in the order of iterTriangleWeights, so that later triangles win like in regridGrid
+        nodes, weights: (k, 3) node indices and weights of each pixel
+        shape: rows and columns of the grid
+        '''
+        self.pix = pix
+        self.nodes = nodes
+        self.weights = weights
+        self.shape = shape
+
+    # Get the bytes used by the weights
+    def nbytes(self):
+        return(self.pix.nbytes + self.nodes.nbytes + self.weights.nbytes)
+
+    # Regrid node values onto the grid, returning an array with NaN outside the mesh, like regridGrid
+    def apply(self, values, dtype=np.float64):
+        block = np.full(self.shape[0] * self.shape[1], np.nan, dtype=dtype)
+        vals = (values[self.nodes] * self.weights).sum(axis=1)
+        valid = np.isfinite(vals)
+        block[self.pix[valid]] = vals[valid]
+        return(block.reshape(self.shape))
+
+# Compute the interpolation weights of a grid
+def gridWeights(x, y, tri, xs, ys):
+    chunks = list(iterTriangleWeights(x, y, tri, xs, ys))
+    if not chunks:
+        return(RegridWeights(np.zeros(0, dtype=np.int64), np.zeros((0, 3), dtype=np.int32), np.zeros((0, 3)), (len(ys), len(xs))))
+    pix, nodes, weights = zip(*chunks)
+    return(RegridWeights(np.concatenate(pix), np.concatenate(nodes).astype(np.int32), np.concatenate(weights), (len(ys), len(xs))))
+
+# Compute the interpolation weights of one window of a grid
+def windowWeights(mesh, xs, ys, window):
+    xoff, yoff, xsize, ysize = window
+    wxs = xs[xoff:xoff + xsize]
+    wys = ys[yoff:yoff + ysize]
+    return(gridWeights(mesh.x, mesh.y, mesh.tri[mesh.trianglesIn(wxs[0], wys[-1], wxs[-1], wys[0])], wxs, wys))
+
+# Interpolation weights computed once and reused for later timesteps, keeping as many as fit in a memory budget
+class WeightCache:
+    def __init__(self, memory=None):
+        self.budget = memory * 2**20 if memory else None
+        self.weights = {}
+        self.nbytes = 0
+        self.computed = 0
+
+    # Get the weights of a key, such as a window or a tile, computing them if they are not kept
+    def get(self, key, compute):
+        if key in self.weights:
+            return(self.weights[key])
+        weights = compute()
+        self.computed += 1
+        if self.budget is None or self.nbytes + weights.nbytes() <= self.budget:
+            self.weights[key] = weights
+            self.nbytes += weights.nbytes()
+        return(weights)
+
+# Split a raster into strips of rows that each fit in a memory budget
+def getWindows(width, height, memory=None, bytesPerPixel=8, count=1, align=1):
+    '''
+    width, height: raster size in pixels
+    memory: memory budget in MB, or None to use a single window
+    bytesPerPixel: bytes needed per pixel of a window
+    count: minimum number of windows
+    align: number of rows that window heights are a multiple of, such as the block height of a tiled raster
+    Returns: list of (xoff, yoff, xsize, ysize) windows
+    '''
+    rows = -(-height // count)
+    if memory is not None:
+        # Reserve memory used by the rasterizer chunks
+        budget = memory * 1024 * 1024 - CHUNK_PIXELS * CHUNK_BYTES_PER_PIXEL
+        rows = int(max(1, min(rows, budget // (width * bytesPerPixel))))
+    rows = max(align, rows // align * align)
+    return([(0, yoff, width, min(rows, height - yoff)) for yoff in range(0, height, rows)])
+
+# Share the arrays of a mesh with regrid worker processes. Arrays mapped from files of the mesh cache are
+# shared by mapping the same files, other arrays are copied into shared memory
+def shareArray(array):
+    if isinstance(array, np.memmap) and array.filename is not None:
+        return(array.filename)
+    array = np.ascontiguousarray(array)
+    raw = mp.RawArray(np.ctypeslib.as_ctypes_type(array.dtype), array.size)
+    np.frombuffer(raw, dtype=array.dtype)[:] = array.ravel()
+    return((raw, array.dtype.str, array.shape))
+
+# Map shared arrays in a regrid worker process
+def initWorker(arrays):
+    for name, shared in arrays.items():
+        if isinstance(shared, str):
+            sharedArrays[name] = np.load(shared, mmap_mode='r')
+        else:
+            raw, dtype, shape = shared
+            sharedArrays[name] = np.frombuffer(raw, dtype=np.dtype(dtype)).reshape(shape)
+
+# Regrid one window of a grid
+def regridWindow(mesh, values, xs, ys, window):
+    xoff, yoff, xsize, ysize = window
+    wxs = xs[xoff:xoff + xsize]
+    wys = ys[yoff:yoff + ysize]
+    tri = mesh.tri[mesh.trianglesIn(wxs[0], wys[-1], wxs[-1], wys[0])]
+    return(regridGrid(mesh.x, mesh.y, tri, values, wxs, wys))
+
+# Regrid one window in a regrid worker process
+def regridSharedWindow(window):
+    mesh = MeshGeometry(*[sharedArrays[name] for name in MeshGeometry.names])
+    return(window, regridWindow(mesh, sharedArrays['values'], sharedArrays['xs'], sharedArrays['ys'], window))
+
+# Regrid windows of a grid, yielding each window with its block as it is done
+def regridWindows(mesh, values, xs, ys, windows, cpu=1):
+    '''
+    Windows are regridded in a pool of cpu processes, which read the mesh from shared memory.
+    Blocks are yielded in the order they are finished, which is not the order of windows when cpu > 1.
+    '''
+    if cpu <= 1 or len(windows) == 1:
+        for window in windows:
+            yield(window, regridWindow(mesh, values, xs, ys, window))
+        return
+
+    logger.info('Regrid '+str(len(windows))+' windows with '+str(cpu)+' processes')
+    arrays = dict(mesh.arrays(), values=values, xs=xs, ys=ys)
+    shared = dict((name, shareArray(array)) for name, array in arrays.items())
+    with mp.Pool(cpu, initializer=initWorker, initargs=(shared,)) as pool:
+        for window, block in pool.imap_unordered(regridSharedWindow, windows):
+            yield(window, block)
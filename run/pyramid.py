@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import numpy as np
+from loguru import logger
+
+# Import local modules
+import tiles, coverage
+
+# Reductions of value tiles, where pixels are NaN when they have no value
+VALUE_REDUCTIONS = ('max', 'mean', 'nearest')
+
+# Reductions of RGBA tiles, where pixels are transparent when they have no value
+RGBA_REDUCTIONS = ('mean', 'nearest')
+
+# Assemble four child tiles, in the order of coverage.children, into a mosaic of twice the tile size
+def mosaicTiles(childTiles, fill):
+    size = tiles.TILE_SIZE
+    sample = next(tile for tile in childTiles if tile is not None)
+    mosaic = np.full((2 * size, 2 * size) + sample.shape[2:], fill, dtype=sample.dtype)
+    for (dx, dy), tile in zip(((0, 0), (1, 0), (0, 1), (1, 1)), childTiles):
+        if tile is not None:
+            mosaic[dy * size:(dy + 1) * size, dx * size:(dx + 1) * size] = tile
+    return(mosaic)
+
+# Get the four pixels of each 2 by 2 block of a mosaic, in the order top left, top right, bottom left, bottom right
+def mosaicQuads(mosaic):
+    return([mosaic[0::2, 0::2], mosaic[0::2, 1::2], mosaic[1::2, 0::2], mosaic[1::2, 1::2]])
+
+# Reduce four child value tiles to their parent tile, ignoring NaN pixels
+def reduceValueTiles(childTiles, reduction):
+    if all(tile is None for tile in childTiles):
+        return(None)
+
+    quads = mosaicQuads(mosaicTiles(childTiles, np.nan))
+    if reduction == 'max':
+        tile = np.fmax(np.fmax(quads[0], quads[1]), np.fmax(quads[2], quads[3]))
+    elif reduction == 'mean':
+        stack = np.stack(quads)
+        valid = np.isfinite(stack)
+        count = valid.sum(axis=0)
+        total = np.where(valid, stack, 0).sum(axis=0)
+        tile = np.where(count > 0, total / np.maximum(count, 1), np.nan).astype(stack.dtype)
+    elif reduction == 'nearest':
+        # Use the top left pixel, or the first of the other pixels that has a value
+        tile = quads[0].copy()
+        for quad in quads[1:]:
+            missing = np.isnan(tile)
+            tile[missing] = quad[missing]
+    else:
+        raise Exception('Incorrect pyramid reduction '+reduction)
+
+    return(tile if np.isfinite(tile).any() else None)
+
+# Reduce four child RGBA tiles to their parent tile, ignoring transparent pixels
+def reduceRgbaTiles(childTiles, reduction):
+    if all(tile is None for tile in childTiles):
+        return(None)
+
+    quads = mosaicQuads(mosaicTiles(childTiles, 0))
+    if reduction == 'mean':
+        # Average colors weighted by opacity, and average the opacity
+        stack = np.stack(quads).astype(np.float64)
+        alpha = stack[..., 3:4]
+        weight = alpha.sum(axis=0)
+        color = (stack[..., :3] * alpha).sum(axis=0) / np.maximum(weight, 1)
+        tile = np.concatenate((color, weight / 4), axis=-1)
+        tile = np.round(tile).astype(np.uint8)
+    elif reduction == 'nearest':
+        tile = quads[0].copy()
+        for quad in quads[1:]:
+            missing = tile[..., 3] == 0
+            tile[missing] = quad[missing]
+    else:
+        raise Exception('Incorrect pyramid reduction '+reduction)
+
+    return(tile if tile[..., 3].any() else None)
+
+# Build tiles of all covered zoom levels by rendering the top zoom level, and reducing each set of four child tiles to
+# their parent. Leaves of the coverage, which are the tiles of regions that stop below the top zoom level, are rendered
+# as well. Tiles are built depth first, so only the tiles on the path from the top tile to the current tile are held in
+# memory
+def buildPyramid(cover, renderTile, reduceTiles, emitTile):
+    '''
+    cover: TileCoverage of the zoom levels to build
+    renderTile: function (z, x, y) rendering a tile of the top zoom level or a leaf, returning None for an empty tile
+    reduceTiles: function taking a list of four child tiles, which are None if empty, and returning the parent tile
+    emitTile: function (z, x, y, tile) called for every tile that is not empty
+    '''
+    def build(z, x, y):
+        childTiles = []
+        if z < cover.zmax:
+            childTiles = [build(z + 1, cx, cy) if cover.covers(z + 1, cx, cy) else None for cx, cy in coverage.children(x, y)]
+        if cover.renders(z, x, y):
+            tile = renderTile(z, x, y)
+        else:
+            tile = reduceTiles(childTiles)
+        if tile is not None:
+            emitTile(z, x, y, tile)
+        return(tile)
+
+    logger.info('Build tile pyramid from zoom level '+str(cover.zmax)+' to '+str(cover.zmin))
+    for x, y in cover.tiles(cover.zmin):
+        build(cover.zmin, x, y)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os
+import numpy as np
+from osgeo import gdal, osr
+from loguru import logger
+
+# GDAL data types of raw GeoTiff files
+DATA_TYPES = {'Float64': gdal.GDT_Float64, 'Float32': gdal.GDT_Float32, 'Int16': gdal.GDT_Int16, 'Byte': gdal.GDT_Byte}
+
+# Nodata value of scaled Int16 rasters
+INT16_NODATA = -32768
+
+# Size of the internal tiles of tiled GeoTiff files
+BLOCK_SIZE = 512
+
+# Get default raster output parameters, which write uncompressed Float64 GeoTiff files
+def defaultParameters():
+    return({'DATA_TYPE': 'Float64', 'COMPRESS': 'NONE', 'TILED': False, 'COG': False, 'SCALE': 0.001})
+
+# Get GDAL creation options for a raw GeoTiff file
+def getCreateOptions(parameters):
+    options = ['BIGTIFF=IF_SAFER']
+    if parameters['TILED'] or parameters['COG']:
+        options += ['TILED=YES', 'BLOCKXSIZE='+str(BLOCK_SIZE), 'BLOCKYSIZE='+str(BLOCK_SIZE)]
+    if parameters['COMPRESS'] != 'NONE':
+        # Use the floating point predictor for float data, and the horizontal differencing predictor for integer data
+        predictor = '3' if parameters['DATA_TYPE'].startswith('Float') else '2'
+        options += ['COMPRESS='+parameters['COMPRESS'], 'PREDICTOR='+predictor, 'NUM_THREADS=ALL_CPUS']
+    return(options)
+
+# Predictor values of the COG driver, which names the predictors of the GTiff driver
+COG_PREDICTORS = {'2': 'STANDARD', '3': 'FLOATING_POINT'}
+
+# Get COG driver creation options from GTiff creation options, which have no TILED, BLOCKXSIZE or BLOCKYSIZE option, and
+# name the predictor instead of numbering it
+def getCogOptions(options):
+    cogOptions = []
+    for option in options:
+        name, _, value = option.partition('=')
+        if name == 'PREDICTOR':
+            cogOptions.append('PREDICTOR='+COG_PREDICTORS.get(value, value))
+        elif name not in ('TILED', 'BLOCKXSIZE', 'BLOCKYSIZE'):
+            cogOptions.append(option)
+    return(cogOptions + ['BLOCKSIZE='+str(BLOCK_SIZE), 'OVERVIEW_RESAMPLING=NEAREST'])
+
+# Check if raster output parameters need anything besides a plain Float64 or Float32 GeoTiff file
+def needsConversion(parameters):
+    return(parameters['DATA_TYPE'] == 'Int16' or parameters['COG'])
+
+# Create a one band EPSG 4326 raster. A COG is written to a temporary GeoTiff file, which closeRaster converts
+def createRaster(filename, width, height, geotransform, parameters):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    if parameters['COG']:
+        filename = filename+'.tmp.tif'
+
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, width, height, 1, DATA_TYPES[parameters['DATA_TYPE']], getCreateOptions(parameters))
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    if parameters['DATA_TYPE'] == 'Int16':
+        band.SetNoDataValue(INT16_NODATA)
+        band.SetScale(parameters['SCALE'])
+        band.SetOffset(0.0)
+    else:
+        band.SetNoDataValue(np.nan)
+
+    return(ds)
+
+# Write a float block with NaN nodata to a raster, scaling it if the raster is Int16
+def writeBlock(ds, block, xoff, yoff):
+    band = ds.GetRasterBand(1)
+    if band.DataType == gdal.GDT_Int16:
+        scaled = np.clip(np.round(block / band.GetScale()), INT16_NODATA + 1, 32767)
+        block = np.where(np.isnan(block), INT16_NODATA, scaled).astype(np.int16)
+    band.WriteArray(block, xoff, yoff)
+
+# Read a block of a raster as float values, with scale applied and NaN for nodata
+def readBlock(ds, xoff, yoff, xsize, ysize):
+    band = ds.GetRasterBand(1)
+    block = band.ReadAsArray(xoff, yoff, xsize, ysize).astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None and not np.isnan(nodata):
+        block[block == nodata] = np.nan
+    scale = band.GetScale()
+    offset = band.GetOffset()
+    if scale not in (None, 1.0) or offset not in (None, 0.0):
+        block = block * (scale or 1.0) + (offset or 0.0)
+    return(block)
+
+# Close a raster, and convert it to a Cloud Optimized GeoTiff with internal overviews if requested
+def closeRaster(ds, filename, parameters):
+    source = ds.GetDescription()
+    ds.FlushCache()
+    ds = None
+
+    if parameters['COG']:
+        logger.info('Convert '+source+' to Cloud Optimized GeoTiff '+filename)
+        if gdal.GetDriverByName('COG') is not None:
+            gdal.Translate(filename, source, format='COG', creationOptions=getCogOptions(getCreateOptions(parameters)))
+        else:
+            # GDAL versions before 3.1 have no COG driver, so build the overviews and copy them in front of the data
+            options = [option for option in getCreateOptions(parameters) if not option.startswith(('TILED', 'BLOCKXSIZE', 'BLOCKYSIZE'))]
+            src = gdal.Open(source, gdal.GA_Update)
+            src.BuildOverviews('NEAREST', [2, 4, 8, 16, 32, 64])
+            src = None
+            options += ['TILED=YES', 'BLOCKXSIZE='+str(BLOCK_SIZE), 'BLOCKYSIZE='+str(BLOCK_SIZE), 'COPY_SRC_OVERVIEWS=YES']
+            gdal.Translate(filename, source, format='GTiff', creationOptions=options)
+        os.remove(source)
+
+    return(filename)
+
+# Copy a raster into a new raster written with the output parameters, one strip of rows at a time
+def convertRaster(source, filename, parameters, rows=BLOCK_SIZE * 4):
+    logger.info('Convert '+source+' to '+parameters['DATA_TYPE']+' raster '+filename)
+    src = gdal.Open(source)
+    ds = createRaster(filename, src.RasterXSize, src.RasterYSize, src.GetGeoTransform(), parameters)
+    for yoff in range(0, src.RasterYSize, rows):
+        ysize = min(rows, src.RasterYSize - yoff)
+        writeBlock(ds, readBlock(src, 0, yoff, src.RasterXSize, ysize), 0, yoff)
+    src = None
+    return(closeRaster(ds, filename, parameters))
+
+# Create an EPSG 4326 RGBA raster, for styled tiffs
+def createRgbaRaster(filename, width, height, geotransform, parameters):
+    parameters = dict(parameters, DATA_TYPE='Byte', COG=False)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(filename, width, height, 4, gdal.GDT_Byte, getCreateOptions(parameters) + ['PHOTOMETRIC=RGB', 'ALPHA=YES'])
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(srs.ExportToWkt())
+    return(ds)
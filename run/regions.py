@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import json
+import shapely
+from shapely.geometry import shape
+from loguru import logger
+
+# Import local modules
+import tiles, coverage
+
+# Parse a region given on the command line, as west,south,east,north[:maxzoom]
+def parseRegion(text):
+    bounds, _, maxzoom = text.partition(':')
+    try:
+        west, south, east, north = [float(value) for value in bounds.split(',')]
+    except ValueError:
+        raise Exception('Incorrect region '+text+', which should be west,south,east,north[:maxzoom]')
+    return({'name': bounds, 'geometry': shapely.box(west, south, east, north), 'maxzoom': int(maxzoom) if maxzoom else None})
+
+# Read the regions of a GeoJSON file of polygon features, whose name and maxzoom properties set the name and top zoom
+# level of each region
+def readRegions(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    features = data['features'] if data.get('type') == 'FeatureCollection' else [data]
+    regions = []
+    for i, feature in enumerate(features):
+        properties = feature.get('properties') or {}
+        geometry = shape(feature['geometry'])
+        if geometry.geom_type not in ('Polygon', 'MultiPolygon'):
+            raise Exception('Region '+str(i)+' of '+filename+' is a '+geometry.geom_type+', not a polygon')
+        maxzoom = properties.get('maxzoom')
+        regions.append({'name': str(properties.get('name', i)), 'geometry': geometry, 'maxzoom': int(maxzoom) if maxzoom is not None else None})
+    return(regions)
+
+# Get the regions given with --region and --regionFile, or None if no region is given
+def getRegions(args):
+    regions = [parseRegion(text) for text in (args.regions or [])]
+    if args.regionFile:
+        regions += readRegions(args.regionFile)
+    if not regions:
+        return(None)
+    names = [region['name']+(' to zoom level '+str(region['maxzoom']) if region['maxzoom'] is not None else '') for region in regions]
+    logger.info('Regions '+', '.join(names))
+    return(regions)
+
+# Describe regions, for the parameters that key cached results and incremental updates
+def describeRegions(regions):
+    return([{'name': region['name'], 'geometry': shapely.to_wkt(region['geometry']), 'maxzoom': region['maxzoom']} for region in regions])
+
+# Get the bounds of regions, as west, south, east, north
+def regionBounds(regions):
+    return(tuple(float(value) for value in shapely.total_bounds([region['geometry'] for region in regions])))
+
+# Get the regrid extent of regions, as the xmin,xmax,ymin,ymax string of INPUT_EXTENT
+def regionExtent(regions):
+    west, south, east, north = regionBounds(regions)
+    return(','.join(str(value) for value in (west, east, south, north)))
+
+# Check which tiles of a zoom level, given as keys, overlap a region
+def overlaps(region, keys, z):
+    tx, ty = coverage.keyToTile(keys, z)
+    west, north = tiles.tileToLonlat(tx, ty, z)
+    east, south = tiles.tileToLonlat(tx + 1, ty + 1, z)
+    return(shapely.intersects(region['geometry'], shapely.box(west, south, east, north)))
+
+# Compute the coverage of regions, where the tiles of each region are covered up to its own top zoom level, which is zmax
+# for regions without one. coverFunction(bounds, z) computes the coverage of the tiles overlapping bounds, as west,
+# south, east, north, up to zoom level z, and only its tiles that overlap the region are kept
+def regionCoverage(regions, zmin, zmax, coverFunction):
+    tops = []
+    for region in regions:
+        top = zmax if region['maxzoom'] is None else min(region['maxzoom'], zmax)
+        if top < zmin:
+            logger.info('Region '+region['name']+' stops at zoom level '+str(top)+', below zoom level '+str(zmin))
+            continue
+        keys = coverFunction(tuple(float(value) for value in region['geometry'].bounds), top).keys[top]
+        keys = keys[overlaps(region, keys, top)]
+        logger.info('Region '+region['name']+' covers '+str(len(keys))+' tiles at zoom level '+str(top))
+        tops.append((top, keys))
+    return(coverage.joinCoverages(tops, zmin))
+
+# Add the arguments that set the regions to regrid and tile, which are shared by the scripts
+def addArguments(parser):
+    parser.add_argument("--region", help="Region to regrid and tile, as west,south,east,north[:maxzoom], given with = as in --region=-78.9,33.7,-75.4,36.6:14, which can be repeated", action="append", dest="regions", default=None)
+    parser.add_argument("--regionFILE", "--regionFile", help="GeoJSON file of region polygons, with their top zoom level in a maxzoom property", action="store", dest="regionFile", default=None)
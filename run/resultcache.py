@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, json, glob, time, hashlib, shutil, tempfile
+from loguru import logger
+
+# Import local modules
+import meshcache
+
+# Name of the file mapping input files to the digest of their contents
+DIGESTS_INDEX = 'digests.json'
+
+# Name of the file describing a cached result, whose modification time is when the result was last used
+MANIFEST = 'manifest.json'
+
+# Bytes read at a time when computing the digest of an input file
+CHUNK_SIZE = 2**20
+
+# Default size of a result cache in MB
+DEFAULT_SIZE = 20480
+
+# Get the version of the scripts, which is a digest of their source, so that results of older scripts are not reused
+def toolVersion():
+    sha = hashlib.sha1()
+    for filename in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(filename, 'rb') as f:
+            sha.update(f.read())
+    return(sha.hexdigest())
+
+# Read the index of digests of input files
+def readDigestsIndex(cacheDir):
+    try:
+        with open(os.path.join(cacheDir, DIGESTS_INDEX)) as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return({})
+
+# Add the digest of an input file to the index
+def writeDigestsIndex(cacheDir, inputFile, digest):
+    with meshcache.lockIndex(cacheDir, DIGESTS_INDEX):
+        digests = readDigestsIndex(cacheDir)
+        digests[meshcache.fileKey(inputFile)] = digest
+        fd, tmpFile = tempfile.mkstemp(dir=cacheDir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(digests, f)
+        os.chmod(tmpFile, 0o644)
+        os.replace(tmpFile, os.path.join(cacheDir, DIGESTS_INDEX))
+
+# Get the digest of the contents of an input file. Digests are kept in an index, so an unchanged file is read only once
+def fileDigest(inputFile, cacheDir):
+    digest = readDigestsIndex(cacheDir).get(meshcache.fileKey(inputFile))
+    if digest:
+        return(digest)
+
+    sha = hashlib.sha1()
+    with open(inputFile, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    writeDigestsIndex(cacheDir, inputFile, digest)
+    return(digest)
+
+# Get the key of a result from the contents of its input file, the command and parameters that made it, and the version
+# of the scripts
+def resultKey(cacheDir, inputFile, command, parameters):
+    os.makedirs(cacheDir, exist_ok=True)
+    key = {'input': fileDigest(inputFile, cacheDir), 'command': command, 'parameters': parameters, 'version': toolVersion()}
+    return(hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest())
+
+# Get the directory of a cached result
+def resultDir(cacheDir, key):
+    return(os.path.join(cacheDir, key[:2], key))
+
+# Hard link a file to a path, or copy it when the path is on another file system. The link is made under a temporary name
+# and renamed, so that the path never holds a partly written file
+def linkFile(source, destination):
+    # Renaming a link over another link to the same file does nothing, and would leave the temporary link behind
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+    directory = os.path.dirname(os.path.abspath(destination))
+    os.makedirs(directory, exist_ok=True)
+    tmpFile = os.path.join(directory, '.'+os.path.basename(destination)+'.'+str(os.getpid())+'.tmp')
+    try:
+        os.link(source, tmpFile)
+    except OSError:
+        shutil.copy2(source, tmpFile)
+    os.replace(tmpFile, destination)
+
+# Remove the outputs of a result before it is made again, since they can be hard linked to cached files that writing
+# them in place would change
+def unlinkOutputs(outputs):
+    for path in outputs.values():
+        if os.path.lexists(path):
+            os.remove(path)
+
+# Link the files of a cached result to their output paths, returning False if the result is not cached. Outputs are a
+# dictionary of file names in the cache and their output paths
+def fetch(cacheDir, key, outputs):
+    directory = resultDir(cacheDir, key)
+    if not os.path.exists(os.path.join(directory, MANIFEST)):
+        return(False)
+
+    try:
+        for name, path in outputs.items():
+            linkFile(os.path.join(directory, name), path)
+        os.utime(os.path.join(directory, MANIFEST))
+    except OSError:
+        # The result was evicted while it was linked
+        logger.info('Cached result '+key+' is incomplete')
+        return(False)
+
+    logger.info('Reused cached result '+key+' for '+', '.join(outputs.values()))
+    return(True)
+
+# Add the output files of a result to the cache, and evict the least recently used results above maxSize MB
+def store(cacheDir, key, outputs, info=None, maxSize=DEFAULT_SIZE):
+    directory = resultDir(cacheDir, key)
+    os.makedirs(os.path.dirname(directory), exist_ok=True)
+    tmpDir = tempfile.mkdtemp(dir=os.path.dirname(directory))
+    os.chmod(tmpDir, 0o755)
+    size = 0
+    for name, path in outputs.items():
+        linkFile(path, os.path.join(tmpDir, name))
+        size += os.path.getsize(path)
+    with open(os.path.join(tmpDir, MANIFEST), 'w') as f:
+        json.dump(dict(info or {}, key=key, files=sorted(outputs), bytes=size, created=time.time()), f, indent=2)
+
+    try:
+        os.rename(tmpDir, directory)
+        logger.info('Cached result '+key+' of '+'{:.1f}'.format(size / 2**20)+' MB')
+    except OSError:
+        # Another process cached the same result first
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+    evict(cacheDir, maxSize)
+
+# Remove the least recently used results until the cache holds at most maxSize MB
+def evict(cacheDir, maxSize=DEFAULT_SIZE):
+    results = []
+    for manifest in glob.glob(os.path.join(cacheDir, '??', '*', MANIFEST)):
+        try:
+            with open(manifest) as f:
+                size = json.load(f)['bytes']
+            results.append((os.path.getmtime(manifest), size, os.path.dirname(manifest)))
+        except (OSError, ValueError, KeyError):
+            continue
+
+    total = sum(size for _, size, _ in results)
+    for used, size, directory in sorted(results):
+        if total <= maxSize * 2**20:
+            break
+        shutil.rmtree(directory, ignore_errors=True)
+        total -= size
+        logger.info('Evicted cached result '+os.path.basename(directory))
+
+# Add the arguments that set the result cache
+def addArguments(parser):
+    parser.add_argument("--resultCACHE", "--resultCache", help="Result cache directory path, where outputs of unchanged inputs and parameters are reused", action="store", dest="resultCache", default=os.getenv('RESULT_CACHE_DIR'))
+    parser.add_argument("--resultCacheSize", help="Size of the result cache in MB", action="store", dest="resultCacheSize", type=int, default=int(os.getenv('RESULT_CACHE_SIZE', DEFAULT_SIZE)))
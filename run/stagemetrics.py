@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, time, json, resource, cProfile, tempfile, contextlib, collections
+from loguru import logger
+
+# Prefix of Prometheus metric names
+PROMETHEUS_PREFIX = 'adcirc2mbtiles_stage_'
+
+# Prometheus metrics written for each stage, with their report field and help text
+PROMETHEUS_METRICS = [('calls', 'calls', 'Number of times the stage ran'),
+                      ('wall_seconds', 'wallSeconds', 'Wall time of the stage'),
+                      ('cpu_seconds', 'cpuSeconds', 'CPU time of the stage, including child processes'),
+                      ('process_peak_rss_bytes', 'processPeakRssBytes', 'Peak resident memory of the process up to the end of the stage, including earlier stages'),
+                      ('peak_rss_growth_bytes', 'peakRssGrowthBytes', 'Growth of the peak resident memory of the process during the stage'),
+                      ('read_bytes', 'readBytes', 'Bytes read by the process during the stage'),
+                      ('written_bytes', 'writtenBytes', 'Bytes written by the process during the stage')]
+
+# Stages recorded by this process, by name in the order they first ran, with their cProfile profilers
+stageRecords = collections.OrderedDict()
+stageProfilers = {}
+
+# Recording settings, where profileDir turns on profiling of each stage
+settings = {'profileDir': None, 'profiling': False}
+
+# Read the bytes read and written by this process, which Linux counts in /proc/self/io. Returns zeros elsewhere
+def readIo():
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return(int(fields['rchar']), int(fields['wchar']))
+    except (OSError, KeyError, ValueError):
+        return(0, 0)
+
+# Get the peak resident memory of this process and its waited for child processes in bytes
+def peakRss():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return(max(usage.ru_maxrss, children.ru_maxrss) * 1024)
+
+# Sample the wall time, CPU time, peak resident memory and I/O counters of this process. CPU time and peak resident
+# memory include child processes that have been waited for, such as gdal2mbtiles and regrid pool workers
+def sample():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read, written = readIo()
+    return({'wall': time.perf_counter(), 'cpu': usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime,
+            'rss': max(usage.ru_maxrss, children.ru_maxrss) * 1024, 'read': read, 'written': written})
+
+# Turn on profiling of each stage, with one cProfile file per stage written to profileDir
+def setProfileDir(profileDir):
+    settings['profileDir'] = profileDir
+
+# Forget the stages recorded so far, such as between the files of a batch
+def reset():
+    stageRecords.clear()
+    stageProfilers.clear()
+
+# Record a stage around a block of code. The block can add counts, such as pixels or tiles, to the yielded dictionary, and
+# they are reported per second. Stages with the same name add up, so a stage can be recorded once per window or tile.
+# Stages can be nested, in which case the outer stage includes the inner one, and only the outer stage is profiled
+@contextlib.contextmanager
+def stage(name, **counts):
+    counts = dict(counts)
+    profiler = None
+    if settings['profileDir'] and not settings['profiling']:
+        profiler = stageProfilers.setdefault(name, cProfile.Profile())
+        settings['profiling'] = True
+        profiler.enable()
+    start = sample()
+    try:
+        yield(counts)
+    finally:
+        end = sample()
+        if profiler is not None:
+            profiler.disable()
+            settings['profiling'] = False
+        addRecord(name, end['wall'] - start['wall'], end['cpu'] - start['cpu'], end['read'] - start['read'],
+                  end['written'] - start['written'], end['rss'] - start['rss'], end['rss'], counts)
+
+# Record a stage around getting each item of an iterable, such as the blocks of a generator whose consumer records its own
+# stages, so that the stages of the consumer are not nested in this stage. count(item) gives the counts of an item
+def iterStage(name, items, count=None):
+    items = iter(items)
+    while True:
+        with stage(name) as counts:
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            if count is not None:
+                counts.update(count(item))
+        yield(item)
+
+# Add a measurement to the record of a stage. The peak resident memory of a process only grows, so a stage reports the
+# growth of the peak during the stage, and the peak of the process up to the end of the stage
+def addRecord(name, wall, cpu, read, written, rssGrowth, rss, counts):
+    record = stageRecords.setdefault(name, {'calls': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0, 'readBytes': 0, 'writtenBytes': 0,
+                                            'peakRssGrowthBytes': 0, 'processPeakRssBytes': 0, 'counts': {}})
+    record['calls'] += 1
+    record['wallSeconds'] += wall
+    record['cpuSeconds'] += cpu
+    record['readBytes'] += read
+    record['writtenBytes'] += written
+    record['peakRssGrowthBytes'] += rssGrowth
+    record['processPeakRssBytes'] = max(record['processPeakRssBytes'], rss)
+    for key, value in counts.items():
+        record['counts'][key] = record['counts'].get(key, 0) + value
+
+# Get the recorded stages, with their counts per second
+def report():
+    stages = collections.OrderedDict()
+    for name, record in stageRecords.items():
+        stages[name] = dict(record, counts=dict(record['counts']))
+        for key, value in record['counts'].items():
+            stages[name][key+'PerSecond'] = value / record['wallSeconds'] if record['wallSeconds'] > 0 else 0.0
+    return(stages)
+
+# Log one line per recorded stage
+def logStages():
+    for name, record in report().items():
+        throughput = ''.join(', {:.0f} {} per second'.format(record[key+'PerSecond'], key) for key in record['counts'])
+        logger.info('Stage '+name+': {:.2f} s wall, {:.2f} s CPU, {:.0f} MB peak RSS growth, {:.0f} MB process peak RSS, {:.1f} MB read, '
+                    '{:.1f} MB written'.format(record['wallSeconds'], record['cpuSeconds'], record['peakRssGrowthBytes'] / 2**20,
+                                               record['processPeakRssBytes'] / 2**20, record['readBytes'] / 2**20,
+                                               record['writtenBytes'] / 2**20)+throughput)
+
+# Write a file so that readers, such as the Prometheus node exporter, never see it partly written
+def writeFile(filename, text):
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmpFile = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmpFile, 0o644)
+    os.replace(tmpFile, filename)
+
+# Format a Prometheus sample line
+def prometheusLine(metric, labels, value):
+    return(PROMETHEUS_PREFIX+metric+'{'+','.join(key+'="'+str(label).replace('"', '\\"')+'"' for key, label in labels.items())+'} '+repr(float(value)))
+
+# Format stage reports as a Prometheus textfile. Each entry is a pair of labels, such as the script and product, and the
+# stages reported for them
+def prometheusText(entries):
+    lines = []
+    for metric, field, helpText in PROMETHEUS_METRICS:
+        lines += ['# HELP '+PROMETHEUS_PREFIX+metric+' '+helpText, '# TYPE '+PROMETHEUS_PREFIX+metric+' gauge']
+        lines += [prometheusLine(metric, dict(labels, stage=name), record[field]) for labels, stages in entries
+                  for name, record in stages.items()]
+    lines += ['# HELP '+PROMETHEUS_PREFIX+'items_per_second Items, such as pixels or tiles, processed per second of the stage',
+              '# TYPE '+PROMETHEUS_PREFIX+'items_per_second gauge']
+    lines += [prometheusLine('items_per_second', dict(labels, stage=name, item=key), record[key+'PerSecond']) for labels, stages in entries
+              for name, record in stages.items() for key in record['counts']]
+    return('\n'.join(lines)+'\n')
+
+# Write stage reports to a JSON report and a Prometheus textfile, if requested. Each entry is a pair of labels and the
+# stages reported for them, so that a batch of files can be written to one report
+def writeReports(metricsFile, prometheusFile, entries):
+    if metricsFile:
+        reports = [{'labels': labels, 'stages': stages} for labels, stages in entries]
+        writeFile(metricsFile, json.dumps({'peakRssBytes': peakRss(), 'reports': reports}, indent=2))
+        logger.info('Wrote stage metrics to '+metricsFile)
+    if prometheusFile:
+        writeFile(prometheusFile, prometheusText(entries))
+        logger.info('Wrote stage metrics Prometheus textfile '+prometheusFile)
+
+# Write the cProfile file of each profiled stage, named after the labels and the stage
+def dumpProfiles(labels):
+    if not settings['profileDir'] or not stageProfilers:
+        return
+    os.makedirs(settings['profileDir'], exist_ok=True)
+    prefix = '.'.join(str(value) for value in labels.values())
+    for name, profiler in stageProfilers.items():
+        profiler.dump_stats(os.path.join(settings['profileDir'], (prefix+'.' if prefix else '')+name+'.prof'))
+    logger.info('Wrote stage profiles to '+settings['profileDir'])
+
+# Log the recorded stages, and write them to a JSON report, a Prometheus textfile, and cProfile files, if requested
+def writeMetrics(metricsFile=None, prometheusFile=None, labels=None):
+    labels = labels or {}
+    logStages()
+    writeReports(metricsFile, prometheusFile, [(labels, report())])
+    dumpProfiles(labels)
+
+# Add the arguments that set how stage metrics are written
+def addArguments(parser):
+    parser.add_argument("--metricsFILE", "--metricsFile", help="Stage metrics JSON report path", action="store", dest="metricsFile", default=os.getenv('METRICS_FILE'))
+    parser.add_argument("--prometheusFILE", "--prometheusFile", help="Stage metrics Prometheus textfile path", action="store", dest="prometheusFile", default=os.getenv('PROMETHEUS_FILE'))
+    parser.add_argument("--profileDIR", "--profileDir", help="Directory path of cProfile files, one per stage", action="store", dest="profileDir", default=os.getenv('PROFILE_DIR'))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import io, time
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+# Tile formats, where png is RGBA PNG, png8 is indexed PNG with a palette alpha (tRNS) chunk, and webp is lossless WebP
+TILE_FORMATS = ('png', 'png8', 'webp')
+
+# MBTiles format metadata value of each tile format
+MBTILES_FORMATS = {'png': 'png', 'png8': 'png', 'webp': 'webp'}
+
+# Largest number of colors of an indexed PNG
+MAX_COLORS = 256
+
+# Value encodings of data tiles, which hold the values of pixels instead of their colors, so that they can be styled by
+# the client. terrainrgb packs 24 bit codes into the red, green and blue of the tile format, like Mapbox Terrain-RGB, with
+# transparent pixels without a value, and uint16 writes 16 bit codes as grayscale PNG, with code 0 for pixels without a
+# value. The value of a code is offset + scale * code
+VALUE_ENCODINGS = ('terrainrgb', 'uint16')
+
+# Default scale and offset of each value encoding, so that tiles of every product have the same codes. Terrain-RGB codes
+# go from -10000 to 6777.215 in 1 mm steps, and 16 bit codes from -19.998 to 111.07 in 2 mm steps
+VALUE_SCALES = {'terrainrgb': (0.001, -10000.0), 'uint16': (0.002, -20.0)}
+
+# Largest code of each value encoding
+MAX_CODES = {'terrainrgb': 2 ** 24 - 1, 'uint16': 2 ** 16 - 1}
+
+# Encode RGBA pixels as a PNG image
+def encodePng(rgba, optimize=False):
+    buf = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buf, 'PNG', optimize=optimize)
+    return(buf.getvalue())
+
+# Encode palette indices as an indexed PNG image, with the palette alpha stored in a tRNS chunk. Only the palette entries
+# used by the tile are written, so smaller tiles get a smaller palette and bit depth
+def encodeIndexedPng(index, palette, optimize=False):
+    used, inverse = np.unique(index, return_inverse=True)
+    colors = palette[used]
+    image = Image.fromarray(inverse.reshape(index.shape).astype(np.uint8), 'P')
+    image.putpalette(colors[:, :3].tobytes())
+    buf = io.BytesIO()
+    image.save(buf, 'PNG', optimize=optimize, transparency=colors[:, 3].tobytes(), bits=paletteBits(len(colors)))
+    return(buf.getvalue())
+
+# Get the smallest PNG bit depth that holds a number of palette entries
+def paletteBits(ncolors):
+    for bits in (1, 2, 4):
+        if ncolors <= 2 ** bits:
+            return(bits)
+    return(8)
+
+# Convert RGBA pixels to palette indices and a palette, or None if they have more than MAX_COLORS colors. Transparent
+# pixels all get the same palette entry
+def rgbaToIndexed(rgba):
+    rgba = np.where(rgba[..., 3:4] == 0, 0, rgba).astype(np.uint8)
+    packed = np.ascontiguousarray(rgba).view(np.uint32)[..., 0]
+    colors, inverse = np.unique(packed, return_inverse=True)
+    if len(colors) > MAX_COLORS:
+        return(None)
+    return(inverse.reshape(packed.shape), colors.view(np.uint8).reshape(-1, 4))
+
+# Quantize values to the codes of a value encoding, clipping them to the codes of the encoding. Pixels without a value get
+# code 0, which uint16 leaves for them
+def valueCodes(block, encoding, scale, offset):
+    block = np.asarray(block, dtype=np.float64)
+    valid = np.isfinite(block)
+    low = 0 if encoding == 'terrainrgb' else 1
+    codes = np.clip(np.round((np.where(valid, block, offset) - offset) / scale), low, MAX_CODES[encoding])
+    return(np.where(valid, codes, 0).astype(np.uint32), valid)
+
+# Encode values as Terrain-RGB pixels, with the 24 bit code of a value in red, green and blue
+def terrainRgb(block, scale, offset):
+    codes, valid = valueCodes(block, 'terrainrgb', scale, offset)
+    rgba = np.zeros(codes.shape + (4,), dtype=np.uint8)
+    rgba[..., 0] = codes >> 16
+    rgba[..., 1] = (codes >> 8) & 0xff
+    rgba[..., 2] = codes & 0xff
+    rgba[..., 3] = np.where(valid, 255, 0)
+    return(rgba)
+
+# Encode values as a 16 bit grayscale PNG image
+def encodeUint16Png(block, scale, offset, optimize=False):
+    codes, _ = valueCodes(block, 'uint16', scale, offset)
+    buf = io.BytesIO()
+    Image.fromarray(codes.astype(np.uint16), 'I;16').save(buf, 'PNG', optimize=optimize)
+    return(buf.getvalue())
+
+# Get the mbtiles metadata of a value encoding, which tells clients how to decode the values of the tiles
+def valueMetadata(encoding, scale, offset):
+    if encoding == 'terrainrgb':
+        formula = 'value = offset + scale * (red * 65536 + green * 256 + blue)'
+        nodata = 'transparent pixels'
+    else:
+        formula = 'value = offset + scale * gray'
+        nodata = 'gray 0'
+    return({'encoding': encoding, 'scale': scale, 'offset': offset, 'formula': formula, 'nodata': nodata})
+
+# Encode RGBA pixels as a lossless WebP image
+def encodeWebp(rgba, optimize=False):
+    buf = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buf, 'WEBP', lossless=True, quality=100 if optimize else 75, method=6 if optimize else 4)
+    return(buf.getvalue())
+
+# Encodes tiles in one tile format, and keeps count of the tiles, bytes and time spent encoding
+class TileEncoder:
+    def __init__(self, tileFormat='png', optimize=False):
+        '''
+        tileFormat: one of TILE_FORMATS
+        optimize: spend more time compressing each tile, for smaller tiles
+        '''
+        if tileFormat not in TILE_FORMATS:
+            raise Exception('Incorrect tile format '+tileFormat)
+        self.tileFormat = tileFormat
+        self.optimize = optimize
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    # Get the MBTiles format metadata value of the tiles
+    def mbtilesFormat(self):
+        return(MBTILES_FORMATS[self.tileFormat])
+
+    # Encode RGBA pixels. Indexed PNG tiles with more than MAX_COLORS colors, which mean pyramid reductions can make, are
+    # written as RGBA PNG tiles
+    def encode(self, rgba):
+        start = time.perf_counter()
+        if self.tileFormat == 'png8':
+            indexed = rgbaToIndexed(rgba)
+            if indexed is not None:
+                data = encodeIndexedPng(indexed[0], indexed[1], self.optimize)
+            else:
+                data = encodePng(rgba, self.optimize)
+        elif self.tileFormat == 'webp':
+            data = encodeWebp(rgba, self.optimize)
+        else:
+            data = encodePng(rgba, self.optimize)
+        return(self.record(data, start))
+
+    # Encode palette indices of a lookup table palette, which skips finding the colors of indexed PNG tiles
+    def encodeIndexed(self, index, palette):
+        if self.tileFormat != 'png8':
+            return(self.encode(palette[index]))
+        start = time.perf_counter()
+        return(self.record(encodeIndexedPng(index, palette, self.optimize), start))
+
+    # Encode the values of pixels with a value encoding. Terrain-RGB tiles are written in the tile format, which is
+    # lossless, and 16 bit tiles are always written as PNG
+    def encodeValues(self, block, encoding, scale, offset):
+        if encoding == 'terrainrgb':
+            return(self.encode(terrainRgb(block, scale, offset)))
+        start = time.perf_counter()
+        return(self.record(encodeUint16Png(block, scale, offset, self.optimize), start))
+
+    # Count an encoded tile
+    def record(self, data, start):
+        self.seconds += time.perf_counter() - start
+        self.count += 1
+        self.bytes += len(data)
+        return(data)
+
+    # Get encoding statistics
+    def stats(self):
+        return({'format': self.tileFormat, 'optimize': self.optimize, 'tiles': self.count, 'bytes': self.bytes,
+                'bytesPerTile': self.bytes / max(self.count, 1), 'seconds': self.seconds,
+                'tilesPerSecond': self.count / self.seconds if self.seconds > 0 else 0.0})
+
+    # Log encoding statistics
+    def logStats(self):
+        stats = self.stats()
+        logger.info('Encoded '+str(stats['tiles'])+' '+self.tileFormat+' tiles, '+str(int(stats['bytesPerTile']))+' bytes per tile, '
+                    +'{:.1f}'.format(stats['tilesPerSecond'])+' tiles per second')
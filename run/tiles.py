@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import numpy as np
+
+# Size of web mercator tiles in pixels
+TILE_SIZE = 256
+
+# Latitude limit of web mercator
+MAX_LATITUDE = 85.0511287798066
+
+# Convert longitudes and latitudes to fractional XYZ tile coordinates at a zoom level
+def lonlatToTile(lon, lat, z):
+    n = 2 ** z
+    lat = np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE)
+    tx = (np.asarray(lon) + 180.0) / 360.0 * n
+    ty = (1.0 - np.log(np.tan(np.radians(lat)) + 1.0 / np.cos(np.radians(lat))) / np.pi) / 2.0 * n
+    return(tx, ty)
+
+# Convert fractional XYZ tile coordinates to longitudes and latitudes at a zoom level
+def tileToLonlat(tx, ty, z):
+    n = 2 ** z
+    lon = np.asarray(tx) / n * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1.0 - 2.0 * np.asarray(ty) / n))))
+    return(lon, lat)
+
+# Get the west, south, east, north bounds of a tile in longitude and latitude
+def tileBounds(z, x, y):
+    west, north = tileToLonlat(x, y, z)
+    east, south = tileToLonlat(x + 1, y + 1, z)
+    return(float(west), float(south), float(east), float(north))
+
+# Get longitudes of pixel column centers and latitudes of pixel row centers of a tile, with rows from north to south
+def tilePixelCenters(z, x, y, size=TILE_SIZE):
+    offsets = (np.arange(size) + 0.5) / size
+    lons, _ = tileToLonlat(x + offsets, y, z)
+    _, lats = tileToLonlat(x, y + offsets, z)
+    return(lons, lats)
+
+# Get the range of tile columns and rows covering a longitude and latitude extent at a zoom level
+def tileRange(west, south, east, north, z):
+    n = 2 ** z
+    tx0, ty0 = lonlatToTile(west, north, z)
+    tx1, ty1 = lonlatToTile(east, south, z)
+    x0 = int(np.clip(np.floor(tx0), 0, n - 1))
+    x1 = int(np.clip(np.floor(tx1), 0, n - 1))
+    y0 = int(np.clip(np.floor(ty0), 0, n - 1))
+    y1 = int(np.clip(np.floor(ty1), 0, n - 1))
+    return(x0, y0, x1, y1)
+
+# Get the XYZ tiles covering a longitude and latitude extent at a zoom level
+def tilesCovering(west, south, east, north, z):
+    x0, y0, x1, y1 = tileRange(west, south, east, north, z)
+    return([(x, y) for y in range(y0, y1 + 1) for x in range(x0, x1 + 1)])
+
+# Convert an XYZ tile row to the TMS tile row used by MBTiles
+def tmsRow(z, y):
+    return(2 ** z - 1 - y)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import os, time
+import multiprocessing
+import numpy as np
+from loguru import logger
+
+# Import local modules
+import coverage
+
+# Number of shards per CPU, so that a CPU that finishes a small shard takes another one
+SHARDS_PER_CPU = 2
+
+# Smallest number of root tiles per shard of the split zoom level, so that shards can be balanced
+ROOTS_PER_SHARD = 4
+
+# Get the zoom level the pyramid is split at, which is the lowest zoom level with enough covered tiles to balance the
+# shards, or the top zoom level
+def splitLevel(cover, shards):
+    for z in range(cover.zmin, cover.zmax + 1):
+        if cover.count(z) >= shards * ROOTS_PER_SHARD:
+            return(z)
+    return(cover.zmax)
+
+# Get the number of covered tiles of zoom levels zsplit to zmax under each covered tile of zoom level zsplit
+def rootWeights(cover, zsplit):
+    roots = cover.keys[zsplit]
+    weights = np.zeros(len(roots), dtype=np.int64)
+    for z in range(zsplit, cover.zmax + 1):
+        tx, ty = coverage.keyToTile(cover.keys[z], z)
+        ancestors = coverage.tileToKey(tx >> (z - zsplit), ty >> (z - zsplit), zsplit)
+        weights += np.bincount(np.searchsorted(roots, ancestors), minlength=len(roots))
+    return(weights)
+
+# Split the covered tiles of zoom level zsplit into shards with about the same number of covered tiles under them. Roots
+# are taken in key order, so each shard is a band of neighbouring tiles
+def splitRoots(roots, weights, shards):
+    total = np.cumsum(weights)
+    bounds = np.searchsorted(total, total[-1] * np.arange(1, shards) / shards, side='right')
+    return([part for part in np.split(roots, bounds) if len(part)])
+
+# Plan the shards of a tile pyramid. Returns the split zoom level, and the root keys at that zoom level of each shard.
+# Shards hold the covered tiles under their roots from the split zoom level to the top zoom level, and the covered
+# tiles below the split zoom level are rendered separately
+def planShards(cover, shards):
+    zsplit = splitLevel(cover, shards)
+    parts = splitRoots(cover.keys[zsplit], rootWeights(cover, zsplit), shards)
+    logger.info('Split zoom levels '+str(zsplit)+' to '+str(cover.zmax)+' into '+str(len(parts))+' shards, of '
+                +', '.join(str(len(part)) for part in parts)+' tiles at zoom level '+str(zsplit))
+    return(zsplit, parts)
+
+# Get the coverage of a shard, which is the covered tiles under its roots from the split zoom level to the top zoom level
+def shardCoverage(cover, zsplit, roots):
+    return(coverage.partCoverage(cover, zsplit, cover.zmax, zsplit, roots))
+
+# Get the coverage of the zoom levels below the split zoom level, or None if the pyramid is split at its lowest zoom level
+def baseCoverage(cover, zsplit):
+    if zsplit == cover.zmin:
+        return(None)
+    return(coverage.partCoverage(cover, cover.zmin, zsplit - 1))
+
+# Get the file name of a shard of an mbtiles file
+def shardFile(outputFile, index):
+    return(outputFile.split('.mbtiles')[0]+'.shard'+'{:04d}'.format(index)+'.mbtiles')
+
+# Run a function on each job in a pool of cpu processes, yielding results in the order they finish. Each function writes
+# its own shard file, so the processes never wait for each other
+def runShards(function, jobs, cpu):
+    logger.info('Render '+str(len(jobs))+' shards with '+str(cpu)+' processes')
+    start = time.time()
+    with multiprocessing.Pool(min(cpu, len(jobs))) as pool:
+        for i, result in enumerate(pool.imap_unordered(function, jobs)):
+            logger.info('Rendered shard '+str(i + 1)+' of '+str(len(jobs))+' in '+'{:.1f}'.format(time.time() - start)+' seconds')
+            yield(result)
+
+# Remove shard files left by an earlier run that failed
+def removeShards(outputFile):
+    directory = os.path.dirname(os.path.abspath(outputFile))
+    prefix = os.path.basename(outputFile.split('.mbtiles')[0])+'.shard'
+    for filename in os.listdir(directory):
+        if filename.startswith(prefix) and filename.endswith('.mbtiles'):
+            os.remove(os.path.join(directory, filename))
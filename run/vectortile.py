@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+# SPDX-FileCopyrightText: 2022 Renaissance Computing Institute. All rights reserved.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# SPDX-License-Identifier: LicenseRef-RENCI
+# SPDX-License-Identifier: MIT
+
+# Import Python modules
+import gzip, struct
+import numpy as np
+
+# Size of the coordinate grid of a vector tile
+EXTENT = 4096
+
+# Mapbox Vector Tile geometry commands
+MOVE_TO = 1
+LINE_TO = 2
+CLOSE_PATH = 7
+
+# Mapbox Vector Tile polygon geometry type
+POLYGON = 3
+
+# Encode an unsigned integer as a protobuf varint
+def varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return(bytes(data))
+
+# Encode an array of unsigned integers as protobuf varints
+def varints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += values >= np.uint64(1 << (7 * k))
+    data = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    start = np.cumsum(sizes) - sizes
+    for k in range(int(sizes.max(initial=0))):
+        more = sizes > k
+        chunk = (values[more] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        data[start[more] + k] = chunk | np.where(sizes[more] > k + 1, 0x80, 0).astype(np.uint64)
+    return(data.tobytes())
+
+# Encode signed integers with zigzag encoding, so that small negative values have short varints
+def zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return(((values << 1) ^ (values >> 63)).astype(np.uint64))
+
+# Encode a protobuf field with a length delimited value
+def lengthField(number, data):
+    return(varint((number << 3) | 2)+varint(len(data))+data)
+
+# Encode a protobuf field with a varint value
+def varintField(number, value):
+    return(varint(number << 3)+varint(value))
+
+# Encode a protobuf field with packed varint values
+def packedField(number, values):
+    return(lengthField(number, varints(values)))
+
+# Encode a value of a vector tile layer, which is a string, a double or an integer
+def encodeValue(value):
+    if isinstance(value, str):
+        return(lengthField(1, value.encode()))
+    if isinstance(value, float):
+        return(varint((3 << 3) | 1)+struct.pack('<d', value))
+    return(varintField(4, int(value) & 0xffffffffffffffff))
+
+# Get twice the area of rings of tile coordinates, which is positive for rings that are clockwise, since y is down
+def ringAreas(coords, counts, starts):
+    following = np.arange(len(coords)) + 1
+    following[starts + counts - 1] = starts
+    cross = coords[:, 0] * coords[following, 1] - coords[following, 0] * coords[:, 1]
+    return(np.add.reduceat(cross, starts) if len(starts) else np.zeros(0, dtype=np.int64))
+
+# Encode polygon rings as vector tile geometry commands. Rings are given as their integer tile coordinates, without the
+# closing point, with the number of points of each ring, and whether each ring is an outer ring, which is followed by the
+# holes of its polygon. Outer rings are written clockwise and holes counterclockwise, and rings that collapse are left out,
+# with the holes of outer rings that collapse
+def encodeRings(coords, counts, outer):
+    coords = np.asarray(coords, dtype=np.int64).reshape(-1, 2)
+    counts = np.asarray(counts, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    areas = ringAreas(coords, counts, starts)
+    polygon = np.cumsum(outer) - 1
+    keep = (counts >= 3) & (areas != 0)
+    keep &= np.isin(polygon, polygon[outer & keep])
+    if not keep.any():
+        return(np.zeros(0, dtype=np.uint64))
+
+    # Order the points of the kept rings, reversing rings with the wrong orientation
+    reverse = (areas > 0) != outer
+    ring = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(len(coords)) - starts[ring]
+    order = np.where(reverse[ring], starts[ring] + counts[ring] - 1 - offset, np.arange(len(coords)))[keep[ring]]
+    counts, ring, offset = counts[keep], np.repeat(np.arange(keep.sum()), counts[keep]), offset[keep[ring]]
+
+    # Each ring is a MoveTo of its first point, a LineTo of its other points, and a ClosePath. Points are moves from the
+    # previous point, going on from ring to ring
+    sizes = 2 * counts + 3
+    out = np.zeros(int(sizes.sum()), dtype=np.uint64)
+    first = np.cumsum(sizes) - sizes
+    out[first] = MOVE_TO | (1 << 3)
+    out[first + 3] = LINE_TO | ((counts - 1) << 3)
+    out[first + sizes - 1] = CLOSE_PATH | (1 << 3)
+    params = zigzag(np.diff(np.concatenate((np.zeros((1, 2), dtype=np.int64), coords[order])), axis=0))
+    position = first[ring] + 1 + 2 * offset + (offset > 0)
+    out[position] = params[:, 0]
+    out[position + 1] = params[:, 1]
+    return(out)
+
+# Encode a vector tile layer of polygon features, given as the coords, counts and outer arguments of encodeRings and a
+# dictionary of properties, returning None if no feature has a polygon left in tile coordinates
+def encodeLayer(name, features, extent=EXTENT):
+    keys = {}
+    values = {}
+    encoded = []
+    for fid, (rings, properties) in enumerate(features):
+        geometry = encodeRings(*rings)
+        if len(geometry) == 0:
+            continue
+        tags = []
+        for key, value in properties.items():
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault((type(value).__name__, value), len(values)))
+        encoded.append(lengthField(2, varintField(1, fid + 1)+packedField(2, tags)+varintField(3, POLYGON)+packedField(4, geometry)))
+    if not encoded:
+        return(None)
+
+    return(varintField(15, 2)+lengthField(1, name.encode())+b''.join(encoded)
+           +b''.join(lengthField(3, key.encode()) for key in keys)
+           +b''.join(lengthField(4, encodeValue(value)) for _, value in values)
+           +varintField(5, extent))
+
+# Encode a gzip compressed vector tile of layers, which is how MBTiles stores pbf tiles, returning None if the tile has no
+# features
+def encodeTile(layers):
+    data = b''.join(lengthField(3, layer) for layer in layers if layer is not None)
+    if not data:
+        return(None)
+    return(gzip.compress(data, 6))